@@ -1,7 +1,7 @@
 """Primary API router that includes all versioned routers."""
 
 from fastapi import APIRouter
-from app.api.v1.endpoints import facebook, supabase_webhook
+from app.api.v1.endpoints import facebook, internal, supabase_webhook
 
 api_router = APIRouter()
 
@@ -17,3 +17,9 @@ api_router.include_router(
     prefix="/v1",
     tags=["internal-webhooks"],
 )
+
+api_router.include_router(
+    internal.router,
+    prefix="/v1",
+    tags=["internal"],
+)
@@ -1,6 +1,5 @@
 """Facebook Messenger webhook endpoints."""
 
-import asyncio
 import hashlib
 import hmac
 from fastapi import APIRouter, Query, Request, HTTPException, status
@@ -8,6 +7,7 @@ from fastapi.responses import PlainTextResponse
 from pydantic import ValidationError
 from app.core.config import settings
 from app.core.logging_config import get_logger
+from app.core.task_supervisor import task_supervisor
 from app.services.facebook_service import facebook_service
 from app.schemas.facebook import FacebookWebhookPayload
 
@@ -15,6 +15,10 @@ logger = get_logger(__name__)
 
 router = APIRouter()
 
+# Webhook processing is light (dedupe, tenant lookup, hand-off to the
+# batcher) but each delivery opens Supabase queries — bound the fan-out.
+task_supervisor.configure("webhook", limit=64, max_queue=5000)
+
 
 def _verify_signature(raw_body: bytes, signature_header: str | None) -> bool:
     """Validate the X-Hub-Signature-256 header against the raw request body.
@@ -112,9 +116,7 @@ async def receive_webhook(request: Request) -> dict[str, str]:
         )
 
     # Fire and forget — process in background so Facebook gets 200 instantly
-    task = asyncio.create_task(_process_webhook_safe(payload))
-    # Log any unhandled errors from the background task
-    task.add_done_callback(_log_task_exception)
+    task_supervisor.spawn("webhook", _process_webhook_safe(payload))
 
     return {"status": "ok"}
 
@@ -126,11 +128,3 @@ async def _process_webhook_safe(payload: FacebookWebhookPayload) -> None:
     except Exception as e:
         logger.error(f"Background webhook processing failed: {e}", exc_info=True)
 
-
-def _log_task_exception(task: asyncio.Task) -> None:
-    """Callback to log unhandled exceptions from background tasks."""
-    if task.cancelled():
-        return
-    exc = task.exception()
-    if exc:
-        logger.error(f"Unhandled error in background task: {exc}", exc_info=True)
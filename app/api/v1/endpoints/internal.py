@@ -0,0 +1,72 @@
+"""Internal operational endpoints (same shared-secret auth as the webhooks)."""
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel, Field
+
+from app.core.internal_auth import require_internal_secret
+from app.core.task_supervisor import task_supervisor
+from app.services.catalog_digest import catalog_digest
+from app.services.embedding_pipeline import embedding_pipeline
+from app.services.embedding_queue import embedding_queue
+from app.services.persistence_service import persistence_service
+from app.services.rag_service import rag_service
+from app.services.usage_service import usage_service
+
+router = APIRouter()
+
+
+class BulkEmbeddingRequest(BaseModel):
+    """Products to (re-)embed: the given ids, or the whole shop."""
+    shop_id: str
+    product_ids: list[str] | None = Field(default=None, max_length=20000)
+    # Whole-shop runs only: skip products whose embedding is already completed
+    only_missing: bool = True
+
+
+@router.get("/internal/metrics", dependencies=[Depends(require_internal_secret)])
+async def metrics() -> dict:
+    """Background-work counters of THIS process.
+
+    tasks: per-category in_flight / queued / completed / failed / dropped.
+    buffers: write-behind pending / flushed / dropped.
+    caches: hit / miss counters and sizes.
+    """
+    return {
+        "tasks": task_supervisor.stats(),
+        "buffers": {**persistence_service.stats(), **usage_service.stats()},
+        "caches": {**rag_service.stats(), "catalog_digest": catalog_digest.stats()},
+        "embeddings": {**embedding_pipeline.stats(), "queue": embedding_queue.stats()},
+    }
+
+
+@router.post("/internal/embeddings/bulk", dependencies=[Depends(require_internal_secret)])
+async def start_bulk_embedding(request: BulkEmbeddingRequest) -> dict:
+    """Embed many products (e.g. after a catalog import) in the background.
+
+    Returns the job right away; poll GET /internal/embeddings/bulk/{job_id}
+    for progress and throughput.
+    """
+    job = embedding_pipeline.start_job(request.shop_id, request.product_ids, request.only_missing)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many bulk embedding jobs queued",
+        )
+    return job.to_dict()
+
+
+@router.get("/internal/embeddings/bulk/{job_id}", dependencies=[Depends(require_internal_secret)])
+async def bulk_embedding_status(job_id: str) -> dict:
+    """Progress of a bulk embedding job (kept for a day)."""
+    job = await embedding_pipeline.job(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown job")
+    return job.to_dict()
+
+
+@router.post("/internal/embeddings/dead-letter/retry", dependencies=[Depends(require_internal_secret)])
+async def retry_dead_embeddings(shop_id: str | None = None) -> dict:
+    """Requeue dead-lettered embedding jobs (all, or one shop's)."""
+    if not embedding_queue.enabled:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Embedding queue is disabled")
+    return {"requeued": embedding_queue.requeue_dead(shop_id)}
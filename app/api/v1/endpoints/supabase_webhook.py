@@ -1,27 +1,37 @@
-"""Supabase webhook endpoint for product embedding generation.
-
-When the Next.js admin dashboard inserts a new product into Supabase,
-a database webhook fires to this endpoint. We immediately return 200 OK,
-then generate the embedding in the background and update the product row.
+"""Supabase database webhook endpoints.
+
+- products: when the Next.js admin dashboard inserts, edits or deletes a
+  product in Supabase, a database webhook fires here. We immediately return
+  200 OK, publish the change to the in-memory catalog structures, and (for
+  new or re-worded products) generate the embedding in the background — or
+  enqueue it for the embedding worker process (EMBEDDING_QUEUE_ENABLED) —
+  and update the product row.
+- threads: status changes (dashboard "Take Over" / hand back / close) are
+  pushed here so the bot goes quiet instantly instead of on its next
+  takeover poll.
 """
 
-import hmac
-
-import httpx
-from fastapi import APIRouter, BackgroundTasks, Header, HTTPException, status
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+from pydantic import BaseModel, Field, ValidationError
 
-from google.genai import types
-from app.core.config import settings
-from app.core.dependencies import genai_client, get_supabase
+from app.core.internal_auth import require_internal_secret
 from app.core.logging_config import get_logger
+from app.services import catalog_events
+from app.services.catalog_events import CatalogChange
+from app.services.embedding_pipeline import embedding_pipeline
+from app.services.embedding_queue import embedding_queue
+from app.services.persistence_service import persistence_service
+from app.services.shard_service import shard_service
 
 logger = get_logger(__name__)
 
 router = APIRouter()
 
-EMBEDDING_MODEL = "gemini-embedding-2"
-EMBEDDING_DIMENSIONS = 768
+# Columns our own embedding write touches. An UPDATE changing nothing else
+# is the echo of _generate_and_store_embedding — re-embedding it would loop.
+_EMBEDDING_WRITE_COLUMNS = {"embedding", "embedding_status", "embedding_hash", "updated_at"}
+# Columns that feed the embedding; changing one needs a fresh vector.
+_EMBEDDED_COLUMNS = {"name", "description", "attributes", "image_url"}
 
 
 # ── Payload Schema ───────────────────────────────────────────────────────
@@ -31,153 +41,185 @@ class ProductRecord(BaseModel):
     id: str
     shop_id: str
     name: str
+    price: float | None = None
     description: str | None = None
     attributes: dict | list | None = None
     image_url: str | None = None
 
 
 class SupabaseWebhookPayload(BaseModel):
-    """Supabase database webhook payload (INSERT event)."""
+    """Supabase database webhook payload (INSERT / UPDATE / DELETE).
+
+    record is the raw row (absent on DELETE) so UPDATEs can be diffed
+    column by column against old_record.
+    """
     type: str = "INSERT"
     table: str = "products"
     schema_: str = Field(default="public", alias="schema")
-    record: ProductRecord
+    record: dict | None = None
+    old_record: dict | None = None
+
+    model_config = {"populate_by_name": True}
+
+
+class ThreadRecord(BaseModel):
+    """Fields from the Supabase threads table row."""
+    id: str
+    shop_id: str
+    customer_id: str
+    status: str
+
+
+class SupabaseThreadWebhookPayload(BaseModel):
+    """Supabase database webhook payload for threads (UPDATE / DELETE)."""
+    type: str = "UPDATE"
+    table: str = "threads"
+    schema_: str = Field(default="public", alias="schema")
+    record: ThreadRecord | None = None
     old_record: dict | None = None
 
     model_config = {"populate_by_name": True}
 
 
-# ── Endpoint ─────────────────────────────────────────────────────────────
+# ── Endpoints ────────────────────────────────────────────────────────────
 
-@router.post("/internal/webhook/supabase-product")
+@router.post(
+    "/internal/webhook/supabase-product",
+    dependencies=[Depends(require_internal_secret)],
+)
 async def handle_product_webhook(
     payload: SupabaseWebhookPayload,
     background_tasks: BackgroundTasks,
-    x_internal_secret: str | None = Header(default=None),
 ) -> dict[str, str]:
     """
-    Receive a product insert webhook from Supabase.
+    Receive a products INSERT / UPDATE / DELETE webhook from Supabase.
 
     Requires the x-internal-secret header to match INTERNAL_WEBHOOK_SECRET
     (configured on the Supabase webhook). Returns 200 immediately to prevent
-    webhook timeouts. Embedding generation runs as a FastAPI BackgroundTask.
+    webhook timeouts. Embedding generation runs as a FastAPI BackgroundTask
+    for inserts and for updates that touch embedded text/image columns.
+    Every real change is published to catalog_events (search caches and
+    in-memory indexes); the echo of our own embedding write is ignored.
     """
-    if settings.internal_webhook_secret:
-        if not x_internal_secret or not hmac.compare_digest(
-            x_internal_secret, settings.internal_webhook_secret
-        ):
-            logger.warning("Internal webhook rejected — bad or missing x-internal-secret header")
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Forbidden",
-            )
-    else:
-        logger.warning(
-            "INTERNAL_WEBHOOK_SECRET is not set — /internal/webhook/supabase-product "
-            "is open to the internet. Set it and add the header to the Supabase webhook."
+    event = payload.type.upper()
+
+    if event == "DELETE":
+        old = payload.old_record or {}
+        if not old.get("id") or not old.get("shop_id"):
+            return {"status": "ignored"}
+        logger.info(f"📦 Webhook received: DELETE product={old['id']} shop={old['shop_id']}")
+        # A pending embedding would publish the deleted row again
+        if embedding_queue.enabled:
+            embedding_queue.remove(old["id"])
+        embedding_pipeline.discard(old["id"])
+        await catalog_events.publish(CatalogChange(
+            shop_id=old["shop_id"], product_id=old["id"], op="delete",
+        ))
+        return {"status": "deleted", "product_id": old["id"]}
+
+    if payload.record is None:
+        return {"status": "ignored"}
+    try:
+        product = ProductRecord.model_validate(payload.record)
+    except ValidationError as e:
+        logger.warning(f"Product webhook record failed validation: {e.error_count()} error(s)")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid product record",
         )
 
-    product = payload.record
+    needs_embedding = event == "INSERT"
+    if event == "UPDATE" and payload.old_record is not None:
+        changed = {
+            column for column in payload.record.keys() | payload.old_record.keys()
+            if payload.record.get(column) != payload.old_record.get(column)
+        }
+        if changed <= _EMBEDDING_WRITE_COLUMNS:
+            logger.debug(f"[{product.id}] Product webhook: embedding-only update — ignored")
+            return {"status": "ignored", "product_id": product.id}
+        needs_embedding = bool(changed & _EMBEDDED_COLUMNS)
+    elif event == "UPDATE":
+        needs_embedding = True
+
     logger.info(
-        f"📦 Webhook received: product={product.id} shop={product.shop_id} name=\"{product.name[:60]}\""
+        f"📦 Webhook received: {event} product={product.id} shop={product.shop_id} "
+        f"name=\"{product.name[:60]}\" re-embed={needs_embedding}"
     )
 
-    background_tasks.add_task(_generate_and_store_embedding, product)
+    # Prices/stock/text are live right away; a new vector follows if needed
+    await catalog_events.publish(CatalogChange(
+        shop_id=product.shop_id, product_id=product.id, op="upsert", row=product.model_dump(),
+    ))
+    if needs_embedding:
+        if embedding_queue.enabled:
+            # Durable: survives restarts, retried by the embedding worker process
+            embedding_queue.enqueue(product.model_dump())
+        else:
+            background_tasks.add_task(_generate_and_store_embedding, product)
 
     return {"status": "accepted", "product_id": product.id}
 
 
-# ── Background Task ─────────────────────────────────────────────────────
-
-async def _generate_and_store_embedding(product: ProductRecord) -> None:
+@router.post(
+    "/internal/webhook/supabase-thread",
+    dependencies=[Depends(require_internal_secret)],
+)
+async def handle_thread_webhook(payload: SupabaseThreadWebhookPayload) -> dict[str, str]:
     """
-    Generate a 768-dim embedding for a product and update the Supabase row.
+    Receive a threads status-change webhook from Supabase.
 
-    Steps:
-      1. Combine text fields (name, description, attributes)
-      2. Optionally fetch image bytes if image_url is present
-      3. Call gemini-embedding-2 with text (+ image if available)
-      4. Update the products table with the embedding vector
-      5. Set embedding_status to 'completed' or 'failed'
+    Authenticated like the product webhook. Updates the bot's takeover state
+    for that conversation immediately in the process that owns it — in
+    sharded mode the takeover poll TTL (TAKEOVER_CACHE_TTL) then only has
+    to catch missed deliveries; other deployments keep polling every
+    TAKEOVER_POLL_TTL seconds.
     """
-    product_id = product.id
+    record = payload.record
+    if record is None:
+        if not payload.old_record:
+            return {"status": "ignored"}
+        record = ThreadRecord.model_validate({**payload.old_record, "status": "closed"})
 
-    try:
-        # ── 1. Prepare text content ──────────────────────────────────
-        text_parts = [product.name]
-        if product.description:
-            text_parts.append(product.description)
-        if product.attributes:
-            if isinstance(product.attributes, dict):
-                attr_text = ", ".join(f"{k}: {v}" for k, v in product.attributes.items())
-            elif isinstance(product.attributes, list):
-                attr_text = ", ".join(str(a) for a in product.attributes)
-            else:
-                attr_text = str(product.attributes)
-            text_parts.append(attr_text)
-
-        combined_text = " | ".join(text_parts)[:2000]
-
-        # ── 2. Build content parts for embedding ─────────────────────
-        # Start with text content
-        contents = [combined_text]
-
-        # If image_url present, fetch and include image bytes
-        if product.image_url:
-            try:
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    img_response = await client.get(product.image_url)
-                    img_response.raise_for_status()
-                    image_bytes = img_response.content
-
-                # Detect MIME type from response headers or default to JPEG
-                content_type = img_response.headers.get("content-type", "image/jpeg")
-                mime_type = content_type.split(";")[0].strip()
-
-                # Add image as inline data part alongside the text
-                contents = types.Content(parts=[
-                    types.Part.from_text(text=combined_text),
-                    types.Part(inline_data=types.Blob(mime_type=mime_type, data=image_bytes)),
-                ])
-
-                logger.info(f"[{product_id}] Fetched image ({len(image_bytes)} bytes) for multimodal embedding")
-            except Exception as img_err:
-                logger.warning(f"[{product_id}] Failed to fetch image, falling back to text-only: {img_err}")
-                # contents stays as [combined_text] — text-only embedding
-
-        # ── 3. Generate embedding ────────────────────────────────────
-        result = await genai_client.aio.models.embed_content(
-            model=EMBEDDING_MODEL,
-            contents=contents,
-            config=types.EmbedContentConfig(output_dimensionality=EMBEDDING_DIMENSIONS),
-        )
+    old_status = (payload.old_record or {}).get("status")
+    if payload.type.upper() == "UPDATE" and old_status == record.status:
+        return {"status": "unchanged"}
 
-        embedding_vector = result.embeddings[0].values
+    psid = await persistence_service.psid_for_customer(record.shop_id, record.customer_id)
+    if not psid:
+        logger.warning(f"Thread webhook: no customer {record.customer_id} (thread={record.id})")
+        return {"status": "ignored"}
 
-        if len(embedding_vector) != EMBEDDING_DIMENSIONS:
-            raise ValueError(
-                f"Expected {EMBEDDING_DIMENSIONS}-dim vector, got {len(embedding_vector)}-dim"
-            )
+    logger.info(
+        f"[{psid}] 🧵 Thread {record.id} status {old_status or '—'} → {record.status} (shop={record.shop_id})"
+    )
+    # Sharded mode: the takeover state that matters lives in the worker
+    # process owning this conversation.
+    if shard_service.enabled:
+        await shard_service.dispatch_thread_status(record.shop_id, psid, record.id, record.status)
+    else:
+        persistence_service.apply_thread_status(record.shop_id, psid, record.id, record.status)
 
-        logger.info(f"[{product_id}] ✅ Embedding generated ({len(embedding_vector)}-dim)")
+    return {"status": "applied", "thread_id": record.id}
 
-        # ── 4. Update Supabase ───────────────────────────────────────
-        supabase = await get_supabase()
-        await supabase.table("products").update({
-            "embedding": embedding_vector,
-            "embedding_status": "completed",
-        }).eq("id", product_id).execute()
 
-        logger.info(f"[{product_id}] ✅ Product embedding saved to Supabase")
+# ── Background Task ─────────────────────────────────────────────────────
 
-    except Exception as e:
-        logger.error(f"[{product_id}] ❌ Embedding generation failed: {e}", exc_info=True)
+async def _generate_and_store_embedding(product: ProductRecord) -> None:
+    """
+    Generate a 768-dim embedding for a product and update the Supabase row.
 
-        # Mark as failed so the admin dashboard can surface the error
-        try:
-            supabase = await get_supabase()
-            await supabase.table("products").update({
-                "embedding_status": "failed",
-            }).eq("id", product_id).execute()
-        except Exception as update_err:
-            logger.error(f"[{product_id}] Failed to update embedding_status to 'failed': {update_err}")
+    Runs through embedding_pipeline: the product shares a multi-content
+    embed request (text + image) and a bulk write with other products
+    arriving around the same time, and its row ends up with
+    embedding_status 'completed' or 'failed'. Nothing is embedded when the
+    content hash (text + image URL/ETag) matches the stored embedding's.
+    """
+    outcome = await embedding_pipeline.embed_product(product.model_dump())
+    if outcome == "embedded":
+        logger.info(f"[{product.id}] ✅ Product embedding saved to Supabase")
+    elif outcome == "unchanged":
+        logger.info(f"[{product.id}] Embedded content unchanged — kept the stored embedding")
+    elif outcome == "deleted":
+        logger.info(f"[{product.id}] Product deleted before its embedding was stored")
+    else:
+        logger.error(f"[{product.id}] ❌ Embedding generation failed — marked 'failed'")
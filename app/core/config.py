@@ -37,9 +37,113 @@ class Settings(BaseSettings):
     # Incoming photos are downscaled so the longest side ≤ this before upload.
     # 768 = one Gemini billing tile (~258 tokens) per image.
     image_max_dimension: int = 768      # env IMAGE_MAX_DIMENSION
+    # Customer photos are also matched against the catalog's multimodal
+    # product embeddings; the top matches go to the model in its first turn.
+    visual_search_enabled: bool = True  # env VISUAL_SEARCH_ENABLED
+    visual_search_matches: int = 3      # env VISUAL_SEARCH_MATCHES
     max_message_length: int = 500       # chars per individual message; override via MAX_MESSAGE_LENGTH
     rate_limit_messages: int = 15       # max messages per window; override via RATE_LIMIT_MESSAGES
     rate_limit_window: int = 60         # window in seconds; override via RATE_LIMIT_WINDOW
+    # Transcript write-behind: buffered message rows from every conversation
+    # are bulk-inserted every interval, or sooner once max_rows are pending.
+    transcript_flush_interval: float = 0.3   # seconds; env TRANSCRIPT_FLUSH_INTERVAL
+    transcript_flush_max_rows: int = 50      # env TRANSCRIPT_FLUSH_MAX_ROWS
+    # LLM usage write-behind: raw llm_usage rows are bulk-inserted and the
+    # per-minute rollups incremented once per interval (or at max_rows).
+    usage_flush_interval: float = 5.0        # seconds; env USAGE_FLUSH_INTERVAL
+    usage_flush_max_rows: int = 200          # env USAGE_FLUSH_MAX_ROWS
+    # Monthly LLM token budgets per shop (bot_settings.monthly_token_budget
+    # overrides the default; 0 = unlimited). Past degrade_ratio of the limit
+    # the agent runs on the cheaper models with fewer turns and no history
+    # summarization; at the limit it stays silent.
+    default_monthly_token_budget: int = 0             # env DEFAULT_MONTHLY_TOKEN_BUDGET
+    budget_degrade_ratio: float = 0.8                 # env BUDGET_DEGRADE_RATIO
+    budget_degraded_gemini_model: str = "gemini-2.5-flash-lite"
+    budget_degraded_openai_model: str = "gpt-4.1-nano"
+    budget_degraded_max_turns: int = 3                # env BUDGET_DEGRADED_MAX_TURNS
+    budget_reconcile_interval: float = 300.0          # seconds; env BUDGET_RECONCILE_INTERVAL
+    # Shutdown: how long queued/in-flight background work (webhooks,
+    # summaries) may take to finish before it's cancelled.
+    background_drain_timeout: float = 10.0   # seconds; env BACKGROUND_DRAIN_TIMEOUT
+    # Human-takeover state is pushed by the threads webhook. The push reaches
+    # one process, so the takeover check is re-read every
+    # TAKEOVER_POLL_TTL seconds; only with sharding (SHARD_WORKERS), where
+    # it lands in the conversation's owning worker, is the long
+    # TAKEOVER_CACHE_TTL used (it then only catches a missed delivery).
+    takeover_cache_ttl: int = 300            # seconds; env TAKEOVER_CACHE_TTL
+    takeover_poll_ttl: int = 20              # seconds; env TAKEOVER_POLL_TTL
+    # Query-embedding cache for catalog search: LRU bounded by memory size,
+    # optionally persisted to a local SQLite file across restarts ("" = off).
+    query_embedding_cache_mb: int = 32              # env QUERY_EMBEDDING_CACHE_MB
+    query_embedding_cache_path: str = ""            # env QUERY_EMBEDDING_CACHE_PATH
+    query_embedding_cache_disk_rows: int = 200000   # ~3 KB each; env QUERY_EMBEDDING_CACHE_DISK_ROWS
+    query_embedding_cache_disk_days: float = 30.0   # env QUERY_EMBEDDING_CACHE_DISK_DAYS
+    # Query embeddings requested within this window (parallel search calls
+    # in one model turn) go out as a single multi-content embed request.
+    embedding_batch_window_ms: float = 5.0          # env EMBEDDING_BATCH_WINDOW_MS
+    embedding_batch_max_texts: int = 16             # env EMBEDDING_BATCH_MAX_TEXTS
+    # Product embeddings (webhook + bulk jobs): products per multi-content
+    # embed request, embed requests in flight, image downloads in flight,
+    # and how long webhook products wait to share a request.
+    embedding_bulk_batch_size: int = 16             # env EMBEDDING_BULK_BATCH_SIZE
+    embedding_bulk_workers: int = 4                 # env EMBEDDING_BULK_WORKERS
+    embedding_image_concurrency: int = 16           # env EMBEDDING_IMAGE_CONCURRENCY
+    embedding_coalesce_window_ms: float = 250.0     # env EMBEDDING_COALESCE_WINDOW_MS
+    embedding_requests_per_minute: int = 100        # token bucket per process, 0 = off; env EMBEDDING_REQUESTS_PER_MINUTE
+    # Durable embedding queue: the product webhook enqueues into a SQLite
+    # file and a spawned worker process embeds, retrying with exponential
+    # backoff and dead-lettering after max_attempts. Off: embeddings run in
+    # the web process.
+    embedding_queue_enabled: bool = False                     # env EMBEDDING_QUEUE_ENABLED
+    embedding_queue_path: str = "daamkoto_embedding_jobs.db"  # env EMBEDDING_QUEUE_PATH
+    embedding_queue_max_attempts: int = 6                     # env EMBEDDING_QUEUE_MAX_ATTEMPTS
+    embedding_retry_base_seconds: float = 10.0                # env EMBEDDING_RETRY_BASE_SECONDS
+    embedding_retry_max_seconds: float = 1800.0               # env EMBEDDING_RETRY_MAX_SECONDS
+    # Hedged catalog search: if the embedding-backed search hasn't answered
+    # after hedge_delay, a keyword-only search starts in parallel; past
+    # deadline the keyword result is served instead of nothing.
+    search_hedge_delay_ms: float = 400              # env SEARCH_HEDGE_DELAY_MS
+    search_deadline_ms: float = 2500                # env SEARCH_DEADLINE_MS
+    search_lexical_timeout_ms: float = 3000         # env SEARCH_LEXICAL_TIMEOUT_MS
+    # Products ranked per catalog search; the model sees search_page_size at
+    # a time and pages through the rest with show_more_products.
+    search_result_depth: int = 20                   # env SEARCH_RESULT_DEPTH
+    search_page_size: int = 5                       # env SEARCH_PAGE_SIZE
+    # Search-result cache per (shop, normalized query); any product change
+    # in the shop invalidates its entries, the TTL only bounds memory.
+    search_cache_ttl: int = 3600                    # seconds; env SEARCH_CACHE_TTL
+    search_cache_max_entries: int = 5000            # env SEARCH_CACHE_MAX_ENTRIES
+    # In-process vector index per shop (needs numpy): shops up to
+    # max_products rows are searched in memory instead of via the RPC.
+    # max_vectors bounds the total across shops (~3 KB per row).
+    catalog_index_enabled: bool = True              # env CATALOG_INDEX_ENABLED
+    catalog_index_max_products: int = 5000          # env CATALOG_INDEX_MAX_PRODUCTS
+    catalog_index_max_vectors: int = 50000          # env CATALOG_INDEX_MAX_VECTORS
+    catalog_index_refresh_seconds: int = 1800       # full reload; env CATALOG_INDEX_REFRESH_SECONDS
+    # Shops with at most this many products get their whole catalog (names,
+    # prices, in-stock variants, image handles) in the system instruction
+    # instead of needing search turns. 0 disables.
+    catalog_digest_max_products: int = 40           # env CATALOG_DIGEST_MAX_PRODUCTS
+    # In-memory product rows per shop (order validation, variant lookups,
+    # digest, lexical fallback). max_rows bounds the total across shops;
+    # shops above max_shop_rows are always read from the DB. Every
+    # reconcile interval one checksum RPC catches missed webhooks.
+    catalog_mirror_enabled: bool = True             # env CATALOG_MIRROR_ENABLED
+    catalog_mirror_max_rows: int = 200000           # env CATALOG_MIRROR_MAX_ROWS
+    catalog_mirror_max_shop_rows: int = 20000       # env CATALOG_MIRROR_MAX_SHOP_ROWS
+    catalog_mirror_reconcile_seconds: int = 300     # env CATALOG_MIRROR_RECONCILE_SECONDS
+    # Per-conversation state (memory, drafts, strikes, rate limits). "memory"
+    # keeps it in-process (single worker); "sqlite" shares it between every
+    # worker on the host through one WAL-mode file on local disk, which also
+    # relays catalog changes (search cache, mirror, index) between workers.
+    state_backend: str = "memory"                 # env STATE_BACKEND
+    state_sqlite_path: str = "daamkoto_state.db"  # env STATE_SQLITE_PATH
+    # Multi-process mode: the uvicorn process (run it with ONE worker) becomes
+    # a thin ingest that consistent-hashes each conversation onto one of
+    # SHARD_WORKERS spawned worker processes over a Unix socket. 0 = off.
+    shard_workers: int = 0                            # env SHARD_WORKERS
+    shard_socket_dir: str = "/tmp/daamkoto-shards"    # env SHARD_SOCKET_DIR
+    shard_shutdown_timeout: float = 20.0              # seconds per worker on exit
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -0,0 +1,39 @@
+"""Shared-secret check for the /internal/* endpoints.
+
+Supabase database webhooks (and internal jobs) send the x-internal-secret
+header; it must match INTERNAL_WEBHOOK_SECRET. Used as a route dependency:
+
+    @router.post("/internal/...", dependencies=[Depends(require_internal_secret)])
+"""
+
+import hmac
+
+from fastapi import Header, HTTPException, Request, status
+
+from app.core.config import settings
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+
+async def require_internal_secret(
+    request: Request,
+    x_internal_secret: str | None = Header(default=None),
+) -> None:
+    """Reject the request with 403 unless the internal secret matches."""
+    if settings.internal_webhook_secret:
+        if not x_internal_secret or not hmac.compare_digest(
+            x_internal_secret, settings.internal_webhook_secret
+        ):
+            logger.warning(
+                f"Internal request to {request.url.path} rejected — bad or missing x-internal-secret header"
+            )
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Forbidden",
+            )
+    else:
+        logger.warning(
+            f"INTERNAL_WEBHOOK_SECRET is not set — {request.url.path} "
+            "is open to the internet. Set it and add the header to the Supabase webhook."
+        )
@@ -12,22 +12,48 @@ OPENAI_TOOLS = [
             "name": "search_products",
             "description": (
                 "Search the product catalog for availability, price, colors, or sizes. "
-                "Each result has a 'variants' list — every size is a separate variant "
-                "with its own product_id and stock. When preparing an order, use the "
-                "product_id of the exact variant (size) the user wants."
+                "Results are compact: n name, p price, d description, img image handle, "
+                "more extra image handles, attrs (shared by all variants) and a 'v' variants "
+                "list — every size is a separate variant with its own id and stock. When "
+                "preparing an order, use the id of the exact variant (size) the user wants. "
+                "If more matches exist, 'cursor' pages through them with show_more_products."
             ),
             "parameters": {
                 "type": "object",
                 "properties": {
                     "query": {
                         "type": "string",
-                        "description": "The search string (e.g. 'red t shirt', 'sneakers under 2000')."
+                        "description": (
+                            "The search string (e.g. 'red t shirt', 'sneakers under 2000'). Price "
+                            "limits, size and color in it are applied as filters on the variants."
+                        )
                     }
                 },
                 "required": ["query"]
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "show_more_products",
+            "description": (
+                "Show the next page of products from an earlier search_products result. Use "
+                "this when the customer wants more options ('aro dekhan', 'anything else?') "
+                "instead of searching again."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "cursor": {
+                        "type": "string",
+                        "description": "The 'cursor' value from the search_products (or show_more_products) result."
+                    }
+                },
+                "required": ["cursor"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -61,7 +87,7 @@ OPENAI_TOOLS = [
                     "product_ids": {
                         "type": "array",
                         "items": {"type": "string"},
-                        "description": "The variant product_id values from search_products results (pick the variant matching the user's size), in order."
+                        "description": "The variant id values (each 'v' entry's id) from search_products results (pick the variant matching the user's size), in order."
                     },
                     "quantities": {
                         "type": "array",
@@ -123,17 +149,17 @@ OPENAI_TOOLS = [
             "name": "send_product_image",
             "description": (
                 "Send a product image to the user's chat screen. Use this when the user wants "
-                "to see an item. Only image_url values from search_products results are allowed."
+                "to see an item. Only image handles from search_products results are allowed."
             ),
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "image_url": {
+                    "image": {
                         "type": "string",
-                        "description": "The image_url field of a product from search_products results."
+                        "description": "An img (or more) handle of a product from search_products results, e.g. 'img2'."
                     }
                 },
-                "required": ["image_url"]
+                "required": ["image"]
             }
         }
     }
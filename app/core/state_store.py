@@ -0,0 +1,282 @@
+"""Pluggable backend for per-conversation state.
+
+Memory, order drafts, image whitelists, recently shown products, off-topic
+strikes and rate-limit windows used to live in module-level TTLCaches, which
+pinned the app to ONE uvicorn worker: a second worker would see a different
+draft, a different strike count and its own rate-limit budget.
+
+Every such store is now a namespaced StateStore obtained from
+get_state_store(). STATE_BACKEND selects the implementation:
+  - "memory" (default) — TTLCache per namespace, exactly the old behavior.
+  - "sqlite"           — one SQLite file in WAL mode on local disk, shared by
+                         every worker process on the host. Reads and writes
+                         are single-row primary-key operations (tens of µs),
+                         so they stay synchronous like the in-process path.
+
+Values must be JSON-serializable (sets are stored as lists — callers
+normalize on read; anything else raises TypeError). TTL semantics match
+cachetools.TTLCache: an entry expires `ttl` seconds after it was last
+WRITTEN; reads never extend it.
+
+The SQLite calls run on the event loop, so a write lock held by another
+worker is waited for at most _BUSY_TIMEOUT_MS. Past that the operation fails
+open — a read sees nothing, a write is skipped, update() returns fn(None)
+unstored — and is logged, instead of freezing every chat in the process.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable
+
+from cachetools import TTLCache
+
+from app.core.config import settings
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+_MISSING = object()
+
+# Expired rows are swept at most this often (per process) on the SQLite path.
+_PURGE_INTERVAL_SECONDS = 60.0
+# Longest the event loop waits for another worker's write lock.
+_BUSY_TIMEOUT_MS = 100
+
+
+class StateStore(ABC):
+    """A TTL'd key → JSON-value map scoped to one namespace."""
+
+    def __init__(self, namespace: str, ttl: float) -> None:
+        self.namespace = namespace
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the live value for key, or default."""
+
+    @abstractmethod
+    def set(self, key: str, value: Any) -> None:
+        """Store value and (re)start its TTL."""
+
+    @abstractmethod
+    def pop(self, key: str, default: Any = None) -> Any:
+        """Remove key and return its value (default if absent)."""
+
+    @abstractmethod
+    def update(self, key: str, fn: Callable[[Any], Any]) -> Any:
+        """Atomically replace the value with fn(current or None) and return it.
+
+        Read-modify-write for counters (strikes, rate-limit windows) — the
+        SQLite path holds a write transaction so two workers can't both
+        read the same count. Returning None from fn deletes the key.
+        """
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+
+
+class MemoryStateStore(StateStore):
+    """In-process store — one TTLCache, no serialization."""
+
+    def __init__(self, namespace: str, ttl: float, maxsize: int) -> None:
+        super().__init__(namespace, ttl)
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._cache.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        self._cache[key] = value
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        return self._cache.pop(key, default)
+
+    def update(self, key: str, fn: Callable[[Any], Any]) -> Any:
+        # No awaits anywhere in here — atomic with respect to the event loop.
+        value = fn(self._cache.get(key))
+        if value is None:
+            self._cache.pop(key, None)
+        else:
+            self._cache[key] = value
+        return value
+
+
+class _SqliteDatabase:
+    """One connection per process to the shared state file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit mode; update() opens explicit IMMEDIATE transactions.
+        self.conn = sqlite3.connect(
+            path, timeout=_BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_MS}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " ns TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " PRIMARY KEY (ns, key)"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (expires_at)")
+        self._last_purge = 0.0
+        self.busy_failures = 0
+        logger.info(f"Shared state backend ready (SQLite WAL at {path})")
+
+    def fail_open(self, namespace: str, op: str, error: sqlite3.OperationalError) -> None:
+        """Log a state operation given up on (locked past _BUSY_TIMEOUT_MS)."""
+        self.busy_failures += 1
+        if self.busy_failures == 1 or self.busy_failures % 100 == 0:
+            logger.warning(
+                f"State store {namespace}.{op} skipped ({error}) — "
+                f"{self.busy_failures} operation(s) failed open so far"
+            )
+
+    def maybe_purge(self, now: float) -> None:
+        """Drop expired rows — called under self.lock, throttled per process."""
+        if now - self._last_purge < _PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        try:
+            self.conn.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+        except sqlite3.OperationalError as e:
+            logger.debug(f"State purge skipped: {e}")
+
+
+class SqliteStateStore(StateStore):
+    """Cross-process store backed by a shared SQLite file (WAL mode)."""
+
+    def __init__(self, namespace: str, ttl: float, db: _SqliteDatabase) -> None:
+        super().__init__(namespace, ttl)
+        self._db = db
+
+    def _read(self, key: str, now: float) -> Any:
+        row = self._db.conn.execute(
+            "SELECT value FROM state WHERE ns = ? AND key = ? AND expires_at > ?",
+            (self.namespace, key, now),
+        ).fetchone()
+        return _MISSING if row is None else json.loads(row[0])
+
+    def _write(self, key: str, value: Any, now: float) -> None:
+        self._db.conn.execute(
+            "INSERT INTO state (ns, key, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (self.namespace, key, json.dumps(value, ensure_ascii=False, default=_json_default), now + self.ttl),
+        )
+
+    def _delete(self, key: str) -> None:
+        self._db.conn.execute("DELETE FROM state WHERE ns = ? AND key = ?", (self.namespace, key))
+
+    def _rollback(self) -> None:
+        if self._db.conn.in_transaction:
+            self._db.conn.execute("ROLLBACK")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._db.lock:
+            try:
+                value = self._read(key, time.time())
+            except sqlite3.OperationalError as e:
+                self._db.fail_open(self.namespace, "get", e)
+                value = _MISSING
+        return default if value is _MISSING else value
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self._db.lock:
+            try:
+                self._write(key, value, now)
+            except sqlite3.OperationalError as e:
+                self._db.fail_open(self.namespace, "set", e)
+                return
+            self._db.maybe_purge(now)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._db.lock:
+            try:
+                self._db.conn.execute("BEGIN IMMEDIATE")
+                value = self._read(key, now)
+                self._delete(key)
+                self._db.conn.execute("COMMIT")
+            except sqlite3.OperationalError as e:
+                self._rollback()
+                self._db.fail_open(self.namespace, "pop", e)
+                value = _MISSING
+            except Exception:
+                self._rollback()
+                raise
+        return default if value is _MISSING else value
+
+    def update(self, key: str, fn: Callable[[Any], Any]) -> Any:
+        now = time.time()
+        with self._db.lock:
+            try:
+                self._db.conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                # Fail open: as if the key were absent, nothing stored
+                self._db.fail_open(self.namespace, "update", e)
+                return fn(None)
+            try:
+                current = self._read(key, now)
+                value = fn(None if current is _MISSING else current)
+                if value is None:
+                    self._delete(key)
+                else:
+                    self._write(key, value, now)
+                self._db.conn.execute("COMMIT")
+            except sqlite3.OperationalError as e:
+                self._rollback()
+                self._db.fail_open(self.namespace, "update", e)
+                return fn(None)
+            except Exception:
+                self._rollback()
+                raise
+        return value
+
+
+def _json_default(obj: Any) -> Any:
+    """Sets (image whitelists) round-trip as lists; anything else is an error."""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"state values must be JSON-serializable, got {type(obj).__name__}")
+
+
+_sqlite_db: _SqliteDatabase | None = None
+
+
+def get_state_store(namespace: str, *, ttl: float, maxsize: int) -> StateStore:
+    """Return the configured store for one namespace.
+
+    maxsize bounds the in-process backend only; the SQLite backend is bounded
+    by TTL (expired rows are swept periodically).
+    """
+    global _sqlite_db
+    backend = settings.state_backend.lower().strip()
+    if backend == "sqlite":
+        if _sqlite_db is None:
+            _sqlite_db = _SqliteDatabase(settings.state_sqlite_path)
+        return SqliteStateStore(namespace, ttl, _sqlite_db)
+    if backend != "memory":
+        logger.warning(f"Unknown STATE_BACKEND={backend!r} — using in-process memory")
+    return MemoryStateStore(namespace, ttl, maxsize)
@@ -0,0 +1,166 @@
+"""Supervised fire-and-forget background tasks.
+
+Webhook processing and history summarization used to be bare
+asyncio.create_task() calls: unbounded (a traffic spike opened as many
+Supabase requests as there were messages), untracked, and simply dropped
+when the process exited.
+
+Every such task now goes through task_supervisor.spawn(category, coro):
+  - each category has a concurrency limit; work beyond it waits in a
+    bounded FIFO queue (overflow is dropped and counted, never blocks the
+    caller)
+  - per-category metrics: in_flight, queued, completed, failed, dropped
+  - drain(timeout) waits for in-flight AND queued work at shutdown, then
+    cancels whatever is left when the deadline passes
+
+Failures are logged (or handed to the caller's on_error), never raised.
+"""
+
+import asyncio
+from collections import deque
+from typing import Callable, Coroutine, Iterable
+
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Used for a category nobody configured explicitly.
+_DEFAULT_LIMIT = 16
+_DEFAULT_MAX_QUEUE = 1000
+
+
+class _Category:
+    """Limit, queue and counters for one kind of background work."""
+
+    def __init__(self, name: str, limit: int, max_queue: int) -> None:
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.queue: deque = deque()
+        self.running: set[asyncio.Task] = set()
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": len(self.running),
+            "queued": len(self.queue),
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+class TaskSupervisor:
+    """Runs background coroutines under per-category concurrency limits."""
+
+    def __init__(self) -> None:
+        self._categories: dict[str, _Category] = {}
+
+    def configure(self, category: str, *, limit: int, max_queue: int = _DEFAULT_MAX_QUEUE) -> None:
+        """Set the concurrency limit and queue bound of one category."""
+        existing = self._categories.get(category)
+        if existing is None:
+            self._categories[category] = _Category(category, limit, max_queue)
+        else:
+            existing.limit = max(1, limit)
+            existing.max_queue = max_queue
+
+    def _category(self, name: str) -> _Category:
+        cat = self._categories.get(name)
+        if cat is None:
+            cat = self._categories[name] = _Category(name, _DEFAULT_LIMIT, _DEFAULT_MAX_QUEUE)
+        return cat
+
+    def spawn(
+        self,
+        category: str,
+        coro: Coroutine,
+        *,
+        on_error: Callable[[BaseException], None] | None = None,
+    ) -> bool:
+        """Run coro now, or queue it if the category is at its limit.
+
+        Returns False if the queue was full and the work was dropped.
+        on_error replaces the default error log for this task's failure.
+        """
+        cat = self._category(category)
+        if len(cat.running) < cat.limit:
+            self._start(cat, coro, on_error)
+            return True
+        if len(cat.queue) >= cat.max_queue:
+            coro.close()
+            cat.dropped += 1
+            if cat.dropped == 1 or cat.dropped % 100 == 0:
+                logger.warning(f"Background '{category}' queue full — dropped {cat.dropped} task(s) so far")
+            return False
+        cat.queue.append((coro, on_error))
+        return True
+
+    def _start(self, cat: _Category, coro: Coroutine, on_error: Callable[[BaseException], None] | None) -> None:
+        task = asyncio.create_task(coro)
+        cat.running.add(task)
+        task.add_done_callback(lambda t: self._on_done(cat, t, on_error))
+
+    def _on_done(
+        self,
+        cat: _Category,
+        task: asyncio.Task,
+        on_error: Callable[[BaseException], None] | None,
+    ) -> None:
+        cat.running.discard(task)
+        if task.cancelled():
+            cat.failed += 1
+        elif (exc := task.exception()) is not None:
+            cat.failed += 1
+            if on_error is not None:
+                on_error(exc)
+            else:
+                logger.error(f"Background '{cat.name}' task failed: {exc}", exc_info=exc)
+        else:
+            cat.completed += 1
+        while cat.queue and len(cat.running) < cat.limit:
+            coro, next_on_error = cat.queue.popleft()
+            self._start(cat, coro, next_on_error)
+
+    async def drain(self, timeout: float, categories: Iterable[str] | None = None) -> None:
+        """Wait up to `timeout` seconds for running and queued work to finish.
+
+        Anything still pending at the deadline is cancelled (queued work is
+        discarded) and reported.
+        """
+        cats = [self._categories[c] for c in categories if c in self._categories] \
+            if categories is not None else list(self._categories.values())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            running = [t for cat in cats for t in cat.running]
+            if not running:
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # Finishing tasks start queued ones — loop until both are empty.
+            await asyncio.wait(running, timeout=remaining)
+
+        leftover = sum(len(cat.running) + len(cat.queue) for cat in cats)
+        if leftover:
+            logger.warning(f"Background drain timed out after {timeout:g}s — cancelling {leftover} task(s)")
+            for cat in cats:
+                while cat.queue:
+                    coro, _ = cat.queue.popleft()
+                    coro.close()
+                    cat.dropped += 1
+                for task in list(cat.running):
+                    task.cancel()
+            pending = [t for cat in cats for t in cat.running]
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict[str, dict]:
+        return {name: cat.stats() for name, cat in self._categories.items()}
+
+
+task_supervisor = TaskSupervisor()
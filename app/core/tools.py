@@ -17,18 +17,38 @@ def search_products(query: str) -> list[dict]:
     """Search the product catalog for availability, price, colors, or sizes.
 
     Args:
-        query: The search string (e.g. 'red t shirt', 'sneakers under 2000').
+        query: The search string (e.g. 'red t shirt', 'sneakers under 2000'). Price
+            limits, size and color in it are applied as filters on the variants.
 
     Returns:
-        List of matching products with name, price, description, image_url and a
-        'variants' list. EVERY SIZE IS A SEPARATE VARIANT with its own product_id
-        and stock — when preparing an order, use the product_id of the exact
-        variant (size) the user wants.
+        Compact products: n name, p price, d description, img image handle,
+        more extra image handles, attrs (shared by all variants) and a 'v'
+        variants list. EVERY SIZE IS A SEPARATE VARIANT with its own id and
+        stock — when preparing an order, use the id of the exact variant
+        (size) the user wants. If more matches exist, 'cursor' pages through
+        them with show_more_products.
     """
     # Stub — real logic is in _execute_tool → RagService.search_catalog()
     return []
 
 
+def show_more_products(cursor: str) -> list[dict]:
+    """Show the next page of products from an earlier search_products result.
+
+    Use this when the customer wants more options ('aro dekhan', 'anything else?')
+    instead of searching again.
+
+    Args:
+        cursor: The 'cursor' value from the search_products (or show_more_products) result.
+
+    Returns:
+        The next products in the same compact format, plus a new 'cursor' if
+        even more remain.
+    """
+    # Stub — real logic is in _execute_tool → AgentService._tool_show_more_products()
+    return []
+
+
 def get_company_policy(topic: str) -> str:
     """Retrieve store info written by the owner: shipping, returns, operating hours,
     store location/address, about the business, and contact details.
@@ -58,7 +78,7 @@ def prepare_order(
     confirm_order only after they clearly say yes.
 
     Args:
-        product_ids: The variant product_id values from search_products results
+        product_ids: The variant id values (each 'v' entry's id) from search_products results
             (pick the variant matching the user's size), in order.
         quantities: Quantity for each product, same order as product_ids.
         delivery_address: The complete delivery address provided by the user.
@@ -95,13 +115,13 @@ def check_order_status(order_number: str) -> dict:
     return {}
 
 
-def send_product_image(image_url: str) -> dict:
+def send_product_image(image: str) -> dict:
     """Send a product image to the user's chat screen. Use this when the user wants to see an item.
 
-    Only image_url values that came back from search_products results are allowed.
+    Only image handles that came back from search_products results are allowed.
 
     Args:
-        image_url: The image_url field of a product from search_products results.
+        image: An img (or more) handle of a product from search_products results, e.g. 'img2'.
 
     Returns:
         Status indicating if the image was successfully dispatched.
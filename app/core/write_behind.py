@@ -0,0 +1,198 @@
+"""Write-behind buffer for fire-and-forget database writes.
+
+Hot-path code calls add() (sync, O(1)); a single background task flushes
+the accumulated items every `interval` seconds, or as soon as `max_items`
+are pending, through one bulk write. drain() flushes whatever is left —
+called from the app lifespan so a deploy doesn't drop queued writes.
+
+Flush failures are logged, never raised: the buffered data is
+observability/transcript data, not part of the reply path.
+  - A row/data error (PostgreSQL class 22 / 23: bad value, constraint
+    violation) splits the batch in halves until the failing items are
+    isolated, so one bad row doesn't lose the rest; those items are retried
+    on the next cycles (up to _MAX_ATTEMPTS) and then dropped.
+  - Anything else (timeout, 5xx, connection refused) is the backend, not
+    the rows: the whole batch goes back to the front of the queue and
+    flushing pauses with exponential backoff (up to _MAX_BACKOFF_SECONDS),
+    so an outage costs one request per backoff, not one per half-batch.
+    Items are dropped after _MAX_TRANSIENT_ATTEMPTS such failures.
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Flush attempts per item before it is dropped (row errors / outages).
+_MAX_ATTEMPTS = 3
+_MAX_TRANSIENT_ATTEMPTS = 8
+_MAX_BACKOFF_SECONDS = 30.0
+
+
+def _is_row_error(error: Exception) -> bool:
+    """True for errors caused by the rows themselves (PostgREST APIError code 22xxx / 23xxx)."""
+    code = getattr(error, "code", None)
+    return isinstance(code, str) and code[:2] in ("22", "23")
+
+
+class WriteBehindBuffer:
+    """Collects items and hands them to `flush_fn` in batches."""
+
+    def __init__(
+        self,
+        name: str,
+        flush_fn: Callable[[list], Awaitable[None]],
+        *,
+        interval: float,
+        max_items: int,
+        max_pending: int = 10000,
+    ) -> None:
+        self.name = name
+        self._flush_fn = flush_fn
+        self._interval = interval
+        self._max_items = max(1, max_items)
+        # Bounded: if the DB is down for minutes, shed the oldest items
+        # instead of growing without limit.
+        self._pending: deque = deque(maxlen=max_pending)
+        # (attempts so far, item) — failed items waiting for the next cycle
+        self._retry: list[tuple[int, Any]] = []
+        self._max_pending = max_pending
+        # Backend outage: no flush before _resume_at (monotonic)
+        self._backoff = 0.0
+        self._resume_at = 0.0
+        self._wake = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        self.flushed = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def add(self, item: Any) -> None:
+        """Queue one item; returns immediately."""
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"{self.name}: buffer full — dropped {self.dropped} item(s) so far")
+        self._pending.append(item)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= self._max_items:
+            self._wake.set()
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._closed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self._closing:
+                    return  # drain() flushes
+            await self._flush_pending()
+            if not self._pending and not self._retry and not self._closing:
+                # Idle: let the task end; the next add() restarts it.
+                return
+
+    async def _flush_pending(self) -> None:
+        retry, self._retry = self._retry, []
+        while retry or self._pending:
+            if retry:
+                batch, retry = retry[:self._max_items], retry[self._max_items:]
+            else:
+                batch = [(0, self._pending.popleft()) for _ in range(min(self._max_items, len(self._pending)))]
+            error = await self._flush_batch(batch)
+            if error is not None:
+                # Backend down: put the batch back in front and pause
+                self._retry = self._requeue(batch, error) + retry + self._retry
+                self._trim_retry()
+                self._backoff = min(_MAX_BACKOFF_SECONDS, max(self._interval, 1.0, self._backoff * 2))
+                self._resume_at = time.monotonic() + self._backoff
+                logger.error(f"{self.name}: flush failed ({error}) — retrying in {self._backoff:.0f}s")
+                return
+        self._backoff = 0.0
+
+    def _requeue(self, batch: list[tuple[int, Any]], error: Exception) -> list[tuple[int, Any]]:
+        kept = [(attempts + 1, item) for attempts, item in batch if attempts + 1 < _MAX_TRANSIENT_ATTEMPTS]
+        if len(kept) < len(batch):
+            self.failed += len(batch) - len(kept)
+            logger.error(
+                f"{self.name}: {len(batch) - len(kept)} item(s) dropped after "
+                f"{_MAX_TRANSIENT_ATTEMPTS} failed flushes: {error}"
+            )
+        return kept
+
+    def _trim_retry(self) -> None:
+        excess = len(self._retry) - self._max_pending
+        if excess > 0:
+            del self._retry[-excess:]  # newest go first, like a full buffer
+            self.dropped += excess
+
+    async def _flush_batch(self, batch: list[tuple[int, Any]], *, top: bool = True) -> Exception | None:
+        """Write a batch; returns the error if the backend (not a row) failed at the top level."""
+        try:
+            await self._flush_fn([item for _, item in batch])
+            self.flushed += len(batch)
+            self.flushes += 1
+            return None
+        except Exception as e:
+            if not _is_row_error(e):
+                if top:
+                    return e
+                # Outage mid-bisection: retry these on a later cycle
+                self._retry.extend(self._requeue(batch, e))
+                return None
+            if top:
+                logger.error(f"{self.name}: flush of {len(batch)} item(s) failed: {e}")
+            if len(batch) == 1:
+                attempts, item = batch[0]
+                if attempts + 1 < _MAX_ATTEMPTS:
+                    self._retry.append((attempts + 1, item))
+                else:
+                    self.failed += 1
+                    logger.error(f"{self.name}: item dropped after {_MAX_ATTEMPTS} failed flushes: {e}")
+                return None
+        # Isolate the failing item(s); the rest still gets written
+        middle = len(batch) // 2
+        await self._flush_batch(batch[:middle], top=False)
+        await self._flush_batch(batch[middle:], top=False)
+        return None
+
+    async def drain(self) -> None:
+        """Stop the background loop and flush everything still pending."""
+        self._closing = True
+        self._wake.set()
+        self._closed.set()
+        if self._task is not None and not self._task.done():
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._flush_pending()
+        if self._retry:
+            # One last try for items that failed during the final flush
+            await self._flush_pending()
+        if self._retry:
+            self.failed += len(self._retry)
+            logger.error(f"{self.name}: {len(self._retry)} item(s) still failing at shutdown — dropped")
+            self._retry = []
+        if self.flushes:
+            logger.info(f"{self.name}: drained — {self.flushed} item(s) in {self.flushes} flush(es)")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "dropped": self.dropped,
+            "retrying": len(self._retry),
+            "failed": self.failed,
+        }
@@ -2,11 +2,21 @@
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from app.core.config import settings
 from app.core.logging_config import setup_logging, get_logger
+from app.core.task_supervisor import task_supervisor
 from app.api.router import api_router
 from app.services.rag_service import rag_service
 from app.services.agent_service import agent_service
+from app.services import catalog_events
 from app.services.batching_service import message_batcher
+from app.services.budget_service import budget_service
+from app.services.catalog_mirror import catalog_mirror
+from app.services.embedding_pipeline import embedding_pipeline
+from app.services.embedding_queue import embedding_worker
+from app.services.persistence_service import persistence_service
+from app.services.shard_service import shard_service
+from app.services.usage_service import usage_service
 
 # Initialize logging FIRST — before any other module logs anything
 setup_logging()
@@ -18,11 +28,25 @@ async def lifespan(app: FastAPI):
     logger.info("Starting up and initializing services...")
     agent_service.initialize()
     await rag_service.initialize()
+    shard_service.start()
+    catalog_events.start_relay()
+    embedding_worker.start()
     logger.info("All services initialized successfully.")
     yield
     # Shutdown: Clean up resources if needed
     logger.info("Shutting down...")
+    # Accepted webhooks first — they feed the batcher / shard workers.
+    await task_supervisor.drain(settings.background_drain_timeout, categories=("webhook",))
+    await shard_service.stop()
+    await embedding_worker.stop()
+    await catalog_events.stop_relay()
     await message_batcher.shutdown()
+    await task_supervisor.drain(settings.background_drain_timeout)
+    await catalog_mirror.shutdown()
+    await embedding_pipeline.shutdown()
+    await persistence_service.shutdown()
+    await usage_service.shutdown()
+    await budget_service.shutdown()
     logger.info("Shutdown complete.")
 
 app = FastAPI(
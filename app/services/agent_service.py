@@ -8,9 +8,12 @@ import httpx
 from cachetools import TTLCache
 from app.core.config import settings
 from app.core.logging_config import get_logger
+from app.core.state_store import get_state_store
+from app.core.task_supervisor import task_supervisor
 from app.core.tenant_context import TenantContext
 from app.core.tools import (
     search_products,
+    show_more_products,
     get_company_policy,
     prepare_order,
     confirm_order,
@@ -20,7 +23,12 @@ from app.core.tools import (
 from app.core.dependencies import get_supabase
 from app.services.memory_service import memory_service
 from app.services.messaging_service import messaging_service
+from app.services.budget_service import budget_service
+from app.services.catalog_digest import catalog_digest
+from app.services.catalog_mirror import catalog_mirror
+from app.services.image_service import downscale_image
 from app.services.persistence_service import persistence_service
+from app.services.result_encoding import encode_products, estimate_tokens
 from app.services.scope_guard import scope_guard, OFFTOPIC_TAG
 from app.services.tenant_config import get_ai_config
 from app.services.usage_service import usage_service
@@ -90,24 +98,33 @@ PLATFORM_RULES = (
     "- Show only the BEST match first (1 product). Send its image using 'send_product_image', mention name and price.\n"
     "- Then ask: 'Want to see more options?' or 'Ar dekhben?' (match their language).\n"
     "- Only show the next product when they ask for it.\n"
+    "- When they've seen this page and want MORE options ('aro dekhan', 'anything else?'), call "
+    "'show_more_products' with the cursor from the last result — never repeat or rephrase the search.\n"
     "- NEVER dump a list of 3-4 products at once. One at a time, conversationally.\n"
     "- If only 1 result exists, just show that one.\n\n"
 
     "## PRODUCT LINKS\n"
-    "- If a variant's attributes include a product_url, you may paste that EXACT link on its own line when showing the product — Messenger will preview it.\n"
+    "- If a product's attrs (or one of its variants) include a product_url, you may paste that EXACT link on its own line when showing the product — Messenger will preview it.\n"
     "- NEVER invent, modify, or guess a URL. If the store's data has no product_url, there is no link — the sale happens right here in the chat.\n\n"
 
+    "## SEARCH RESULT FORMAT\n"
+    "search_products returns compact products: n = name, p = price (BDT), d = description, "
+    "img = image handle, more = extra image handles, attrs = attributes shared by ALL its variants, "
+    "v = variants. Each variant has its own id plus only the attributes that differ (size, stock…); "
+    "a variant with its own p has a different price.\n\n"
+
     "## VARIANTS & STOCK\n"
-    "- Each product in search results has a 'variants' list — every variant (size, model, flavor…) is its OWN product_id with its own attributes and stock.\n"
-    "- The attributes shown per variant are the store's real data (size, color, fabric, warranty — whatever this store tracks). Use them to answer product questions instead of guessing.\n"
+    "- Every variant (size, model, flavor…) in a product's 'v' list is its OWN id with its own attributes and stock.\n"
+    "- The attributes (attrs + the variant's own) are the store's real data (size, color, fabric, warranty — whatever this store tracks). Use them to answer product questions instead of guessing.\n"
     "- Before preparing an order, pin down WHICH variant the user wants. If they haven't said (e.g. no size given), ask, and mention which options are actually available (stock > 0).\n"
-    "- In prepare_order, use the product_id of the EXACT variant the user chose — never a different variant's id.\n"
+    "- In prepare_order, use the id of the EXACT variant the user chose — never a different variant's id.\n"
     "- If the requested variant is missing or out of stock, say so honestly and offer the ones in stock.\n"
     "- Don't recite stock numbers unless asked; just treat stock 0 as unavailable.\n\n"
 
     "## WHEN THE CUSTOMER SENDS A PHOTO\n"
     "- First work out WHY they sent it — the photo and any text around it are ONE request.\n"
-    "- If it shows a product (clothing, accessory, anything sellable): identify it precisely "
+    "- If a [VISUAL SEARCH] list came with the photo and one of its products is the item, answer from it directly.\n"
+    "- If it shows a product (clothing, accessory, anything sellable) and no visual match fits: identify it precisely "
     "(item type, color, print/design, notable details) and call 'search_products' with that description. "
     "Then show the closest match and be honest about whether it's the exact item or just similar.\n"
     "- If they sent a photo with text like 'ache eta?' or 'do you have this' — the photo IS the product they mean. Search for it.\n"
@@ -117,14 +134,15 @@ PLATFORM_RULES = (
 
     "## IMAGE RULES\n"
     "- NEVER paste image URLs in your text. The user can't click image links on Messenger.\n"
-    "- Use the 'send_product_image' tool with the image_url from search results.\n"
-    "- If the user wants MORE photos of a product, send one from its more_image_urls list.\n"
+    "- Use the 'send_product_image' tool with the product's img handle from search results (e.g. 'img2').\n"
+    "- If the user wants MORE photos of a product, send one from its 'more' handles.\n"
     "- Send the image BEFORE or alongside your text about that product.\n"
     "- Max 1 image per reply.\n\n"
 
     "## WHEN TO USE TOOLS\n"
     "- 'search_products': When user asks about any product, color, size, price, or says something like 'show me', 'ache?', 'dekhan'.\n"
-    "- 'send_product_image': Right after getting search results, send the best match's image. Use the image_url field from results.\n"
+    "- 'show_more_products': When the user wants more options than the last search returned.\n"
+    "- 'send_product_image': Right after getting search results, send the best match's image. Use its img handle from results.\n"
     "- 'get_company_policy': When user asks about shipping, return policy, operating hours, delivery time.\n"
     "- 'prepare_order': Once the user has given items, quantities, delivery address, and contact number.\n"
     "- 'confirm_order': ONLY after the user explicitly confirms the prepared order (see order rules below).\n"
@@ -133,7 +151,7 @@ PLATFORM_RULES = (
     "## ORDER FLOW (STRICT TWO-STEP)\n"
     "When a user wants to buy:\n"
     "1. Ask for missing details in ONE message: which item(s) (from search results), quantity, size/variant if relevant, delivery address, contact number.\n"
-    "2. Call 'prepare_order' with the product_id values from search results. It returns the validated summary and exact total.\n"
+    "2. Call 'prepare_order' with the variant id values from search results. It returns the validated summary and exact total.\n"
     "3. Relay that summary and ask 'Confirm korben?' / 'Shall I place this order?'\n"
     "4. ONLY call 'confirm_order' after the user explicitly says yes ('yes', 'haan', 'confirm', 'go ahead').\n"
     "5. NEVER call confirm_order in the same turn as prepare_order. The user must confirm in between.\n\n"
@@ -183,29 +201,63 @@ CROSSED_REPLY_NOTE = (
     "information. If it asks something new, answer normally.]"
 )
 
+# Appended to the customer's turn when visual search matched their photo
+# against the catalog, so an "ache eta?" photo is answered in the first LLM
+# turn instead of describe → search_products → answer.
+VISUAL_MATCHES_NOTE = (
+    "[VISUAL SEARCH — catalog products that LOOK most like the customer's photo, best first, "
+    "in search_products format: {products}. If the photo shows one of these, answer from this "
+    "list directly (send its img, give name and price) — no need to call search_products. These "
+    "are only the closest-looking items: be honest if none is the exact item, and ignore this "
+    "list if the photo is a screenshot or not a product.]"
+)
+
 # Order drafts awaiting explicit user confirmation.
 # Keyed by "{shop_id}:{sender_id}". 15-minute TTL: an unconfirmed draft dies quietly.
-_order_drafts: TTLCache = TTLCache(maxsize=2000, ttl=900)
+# Drafts, image whitelists and recent products live on the shared state
+# backend (STATE_BACKEND) so any worker can confirm an order another prepared.
+_order_drafts = get_state_store("order_drafts", ttl=900, maxsize=2000)
 
-# Image URLs the model is allowed to send — only ones returned by
-# search_products for this conversation. Blocks prompt-injected/hallucinated URLs.
-_allowed_images: TTLCache = TTLCache(maxsize=2000, ttl=3600)
+# Images the model is allowed to send — only ones returned by search_products
+# for this conversation, as handle -> URL ({"img1": "https://…"}). The model
+# only ever sees the handles; send_product_image resolves them here, which
+# also blocks prompt-injected/hallucinated URLs.
+_allowed_images = get_state_store("allowed_images", ttl=3600, maxsize=2000)
 
 # Products already surfaced to this conversation by search_products
 # (name/price/sizes). History summarization is text-only and lossy — this is
 # durable ground truth injected via _conversation_state() so the bot never
 # forgets a product it already showed (e.g. adding an earlier polo to an order).
-_recent_products: TTLCache = TTLCache(maxsize=2000, ttl=3600)
+_recent_products = get_state_store("recent_products", ttl=3600, maxsize=2000)
+
+# Ranked search results beyond the first page, per conversation, so "show
+# more" follow-ups cost no embedding and no vector query:
+# {"cursor_seq": n, "cursors": {"r3": {"query": ..., "products": [...]}}}.
+# Only the newest _MAX_CURSORS lists are kept.
+_search_cursors = get_state_store("search_cursors", ttl=1800, maxsize=2000)
+_MAX_CURSORS = 3
 
 # Customer profile snippets, keyed by "{shop_id}:{sender_id}".
 _profile_cache: TTLCache = TTLCache(maxsize=2000, ttl=120)
 
+# Estimated tokens saved by the compact search-result encoding during the
+# current run, keyed like memory; process() pops it into the llm_usage row.
+_encoding_savings: TTLCache = TTLCache(maxsize=2000, ttl=600)
+
 
 def _conversation_key(tenant: TenantContext) -> str:
     """Memory/draft key. PSIDs are page-scoped, so namespace by shop."""
     return f"{tenant.shop_id}:{tenant.sender_id}"
 
 
+def _image_handles(mem_key: str) -> dict[str, str]:
+    """This conversation's handle -> URL map (older list entries migrated)."""
+    stored = _allowed_images.get(mem_key) or {}
+    if isinstance(stored, list):
+        return {f"img{i}": url for i, url in enumerate(stored, 1)}
+    return dict(stored)
+
+
 def _conversation_state(mem_key: str) -> str:
     """Compact durable state appended to the system instruction each run.
 
@@ -254,6 +306,13 @@ def _conversation_state(mem_key: str) -> str:
     )
 
 
+# ReAct loop cap per run. Degraded token budgets use BUDGET_DEGRADED_MAX_TURNS.
+MAX_TURNS = 5
+
+# Summaries are LLM calls — a handful at a time is plenty.
+task_supervisor.configure("summary", limit=4, max_queue=200)
+
+
 class AgentService:
     """Agent orchestrator for handling user messages and tool execution."""
 
@@ -264,6 +323,7 @@ class AgentService:
         # Provide the actual Python functions. The SDK parses their signatures and docstrings.
         self.tools = [
             search_products,
+            show_more_products,
             get_company_policy,
             prepare_order,
             confirm_order,
@@ -317,44 +377,19 @@ class AgentService:
         mime_type = (response.headers.get("content-type") or "").split(";")[0].strip().lower()
         if not mime_type.startswith("image/"):
             mime_type = "image/jpeg"
-        return cls._downscale_image(image_bytes, mime_type)
-
-    @staticmethod
-    def _downscale_image(image_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
-        """Downscale oversized photos so the longest side ≤ image_max_dimension.
-
-        Gemini bills images per 768×768 tile (~258 tokens each) — a full-res FB
-        photo can be ~6 tiles. Capping at one tile makes every image minimum
-        price (and shrinks the base64 payload on the OpenAI path) with no
-        practical loss for product identification. Falls back to the original
-        bytes on any decode failure (animated/unsupported formats)."""
-        try:
-            import io
-            from PIL import Image
-
-            img = Image.open(io.BytesIO(image_bytes))
-            max_dim = settings.image_max_dimension
-            if max(img.size) <= max_dim:
-                return image_bytes, mime_type
-
-            orig_size = img.size
-            img.thumbnail((max_dim, max_dim))
-            buf = io.BytesIO()
-            if img.mode in ("RGBA", "LA", "P"):
-                img.save(buf, format="PNG")  # keep transparency (stickers/screenshots)
-                out_mime = "image/png"
+        return downscale_image(image_bytes, mime_type)
+
+    async def _download_images(self, sender_id: str, image_urls: list[str]) -> list[tuple[bytes, str] | None]:
+        """Download (and downscale) every photo once per run; None where one failed."""
+        results = await asyncio.gather(*(self._download_image(u) for u in image_urls), return_exceptions=True)
+        images: list[tuple[bytes, str] | None] = []
+        for url, result in zip(image_urls, results):
+            if isinstance(result, BaseException):
+                logger.error(f"[{sender_id}] Failed to download image {url[:100]}: {result}")
+                images.append(None)
             else:
-                img.convert("RGB").save(buf, format="JPEG", quality=85)
-                out_mime = "image/jpeg"
-            out = buf.getvalue()
-            logger.info(
-                f"📉 Image downscaled {orig_size[0]}x{orig_size[1]} → {img.size[0]}x{img.size[1]} "
-                f"({len(image_bytes)//1024}KB → {len(out)//1024}KB)"
-            )
-            return out, out_mime
-        except Exception as e:
-            logger.warning(f"Image downscale failed, using original: {e}")
-            return image_bytes, mime_type
+                images.append(result)
+        return images
 
     # ─────────────────────────────────────────────────────────────────────
     #  Tool execution bridge
@@ -376,6 +411,8 @@ class AgentService:
         try:
             if call_name == "search_products":
                 result = await self._tool_search_products(call_args, tenant)
+            elif call_name == "show_more_products":
+                result = self._tool_show_more_products(call_args, tenant)
             elif call_name == "get_company_policy":
                 result = await self._tool_get_company_policy(tenant)
             elif call_name == "prepare_order":
@@ -414,35 +451,101 @@ class AgentService:
 
         if not products:
             return {"message": "No relevant products found in the catalog."}
+        return self._page(products, tenant, query=call_args.get("query", ""))
 
-        # Whitelist the returned image URLs for send_product_image
+    def _tool_show_more_products(self, call_args: dict, tenant: TenantContext) -> dict:
         key = _conversation_key(tenant)
-        allowed: set = _allowed_images.get(key) or set()
+        state = _search_cursors.get(key) or {}
+        cursor = (call_args.get("cursor") or "").strip()
+        entry = (state.get("cursors") or {}).get(cursor)
+        if entry is None:
+            return {"message": "That result list has expired or does not exist — call search_products again."}
+        state["cursors"].pop(cursor)
+        _search_cursors[key] = state
+        return self._page(entry["products"], tenant, query=entry["query"])
+
+    def _page(self, products: list[dict], tenant: TenantContext, *, query: str) -> dict:
+        """First SEARCH_PAGE_SIZE products for the model; the rest behind a cursor."""
+        page_size = max(1, settings.search_page_size)
+        page, rest = products[:page_size], products[page_size:]
+        result: dict = {"products_found": self._present_products(page, tenant)}
+        if rest:
+            key = _conversation_key(tenant)
+            state = _search_cursors.get(key) or {"cursor_seq": 0, "cursors": {}}
+            state["cursor_seq"] += 1
+            cursor = f"r{state['cursor_seq']}"
+            state["cursors"][cursor] = {"query": query, "products": rest}
+            # Oldest cursors go first (dicts keep insertion order)
+            for stale in list(state["cursors"])[:-_MAX_CURSORS]:
+                state["cursors"].pop(stale)
+            _search_cursors[key] = state
+            result["cursor"] = cursor
+            result["more"] = len(rest)
+        return result
+
+    def _present_products(self, products: list[dict], tenant: TenantContext, *, shown: bool = True) -> list[dict]:
+        """search_catalog products → the compact form the model sees.
+
+        Whitelists their images under handles, records them for
+        _conversation_state() (unless shown=False: the model sees them but
+        the customer hasn't yet) and counts the encoding's token savings.
+        """
+        # Whitelist every returned image (variants' and gallery) under a short
+        # handle; the model only sees handles, send_product_image resolves them.
+        key = _conversation_key(tenant)
+        handles = _image_handles(key)
+        by_url = {url: handle for handle, url in handles.items()}
+
+        def handle_for(url: str) -> str:
+            if url not in by_url:
+                n = len(handles) + 1
+                while f"img{n}" in handles:
+                    n += 1
+                by_url[url] = f"img{n}"
+                handles[by_url[url]] = url
+            return by_url[url]
 
         for p in products:
-            # Whitelist every variant's image, but only expose the primary one
             for url in p.pop("all_image_urls", []):
-                allowed.add(url)
-            if p.get("image_url"):
-                allowed.add(p["image_url"])
+                handle_for(url)
             if isinstance(p.get("description"), str):
                 p["description"] = p["description"][:100] + ("..." if len(p["description"]) > 100 else "")
 
-        _allowed_images[key] = allowed
-
         # Record surfaced products so _conversation_state() keeps them alive
         # across lossy history summarization. Dedupe by name, newest wins.
-        recent = _recent_products.get(key) or []
-        for p in products:
-            sizes = "/".join(
-                str(v.get("size")) for v in (p.get("variants") or []) if v.get("size")
-            )
-            entry = {"name": p.get("name"), "price": p.get("price"), "sizes": sizes}
-            recent = [r for r in recent if r.get("name") != entry["name"]]
-            recent.append(entry)
-        _recent_products[key] = recent[-8:]
-
-        return {"products_found": products}
+        if shown:
+            recent = _recent_products.get(key) or []
+            for p in products:
+                sizes = "/".join(
+                    str(v.get("size")) for v in (p.get("variants") or []) if v.get("size")
+                )
+                entry = {"name": p.get("name"), "price": p.get("price"), "sizes": sizes}
+                recent = [r for r in recent if r.get("name") != entry["name"]]
+                recent.append(entry)
+            _recent_products[key] = recent[-8:]
+
+        encoded = encode_products(products, handle_for)
+        _allowed_images[key] = handles
+
+        # What the verbose shape (full keys, URLs, repeated attributes) would
+        # have cost in history vs. what is sent
+        saved = estimate_tokens(products) - estimate_tokens(encoded)
+        if saved > 0:
+            _encoding_savings[key] = _encoding_savings.get(key, 0) + saved
+            logger.debug(f"[{tenant.sender_id}] Compact search result: ~{saved} tokens saved")
+        return encoded
+
+    async def _visual_matches(self, image: tuple[bytes, str], tenant: TenantContext) -> str:
+        """VISUAL_MATCHES_NOTE for a customer photo, or '' if nothing matched."""
+        from app.services.rag_service import rag_service
+        image_bytes, mime_type = image
+        products = await rag_service.search_by_image(image_bytes, mime_type, tenant.shop_id)
+        if not products:
+            return ""
+        # Candidates for the model, not products the customer has seen — kept
+        # out of the ALREADY SHOWN list
+        encoded = self._present_products(products, tenant, shown=False)
+        return VISUAL_MATCHES_NOTE.format(products=json.dumps(encoded, ensure_ascii=False))
 
     async def _tool_get_company_policy(self, tenant: TenantContext) -> dict:
         try:
@@ -479,7 +582,7 @@ class AgentService:
         notes = (call_args.get("notes") or "").strip()
 
         if not product_ids:
-            return {"error": "No product_ids given. Use the product_id values from search_products results."}
+            return {"error": "No product_ids given. Use the variant id values from search_products results."}
         if len(quantities) != len(product_ids):
             return {"error": "product_ids and quantities must have the same length."}
         if not delivery_address:
@@ -494,20 +597,24 @@ class AgentService:
         if any(q < 1 or q > 50 for q in quantities):
             return {"error": "Each quantity must be between 1 and 50."}
 
-        # Validate against the catalog — the LLM can only order real products of THIS shop
-        supabase = await get_supabase()
-        db_result = await supabase.table("products") \
-            .select("id, name, price, attributes") \
-            .eq("shop_id", tenant.shop_id) \
-            .in_("id", product_ids) \
-            .execute()
-
-        found = {row["id"]: row for row in (db_result.data or [])}
+        # Validate against the catalog — the LLM can only order real products of THIS shop.
+        # The mirror answers without a round trip; the DB is asked only for ids
+        # it doesn't hold (shop not mirrored yet, or a row newer than its webhook).
+        found = catalog_mirror.lookup(tenant.shop_id, product_ids) or {}
+        unknown = [pid for pid in dict.fromkeys(product_ids) if pid not in found]
+        if unknown:
+            supabase = await get_supabase()
+            db_result = await supabase.table("products") \
+                .select("id, name, price, attributes") \
+                .eq("shop_id", tenant.shop_id) \
+                .in_("id", unknown) \
+                .execute()
+            found.update({row["id"]: row for row in (db_result.data or [])})
         missing = [pid for pid in product_ids if pid not in found]
         if missing:
             return {
                 "error": f"These product_ids don't exist in this store's catalog: {missing}. "
-                         "Use exact product_id values from search_products results."
+                         "Use exact variant id values from search_products results."
             }
 
         items = []
@@ -623,6 +730,7 @@ class AgentService:
             # Draft consumed — a second confirm_order call can't double-book
             _order_drafts.pop(key, None)
             _profile_cache.pop(key, None)
+            persistence_service.invalidate_profile(tenant.shop_id, tenant.sender_id)
 
             logger.info(
                 f"[{tenant.sender_id}] 📋 Order created: {order_number} "
@@ -648,13 +756,10 @@ class AgentService:
         try:
             supabase = await get_supabase()
 
-            cust = await supabase.table("customers") \
-                .select("id") \
-                .eq("shop_id", tenant.shop_id) \
-                .eq("messenger_psid", tenant.sender_id) \
-                .limit(1) \
-                .execute()
-            if not cust.data:
+            customer_id = await persistence_service.find_customer_id(
+                tenant.shop_id, tenant.sender_id
+            )
+            if not customer_id:
                 return {"message": "No orders found for this customer yet."}
 
             db_result = await supabase.table("orders") \
@@ -665,7 +770,7 @@ class AgentService:
                 ) \
                 .eq("order_number", order_num) \
                 .eq("shop_id", tenant.shop_id) \
-                .eq("customer_id", cust.data[0]["id"]) \
+                .eq("customer_id", customer_id) \
                 .limit(1) \
                 .execute()
 
@@ -677,19 +782,21 @@ class AgentService:
             return {"error": "Failed to look up the order. Please try again."}
 
     async def _tool_send_product_image(self, call_args: dict, tenant: TenantContext) -> dict:
-        url = (call_args.get("image_url") or "").strip()
-        if not url or url.lower() in ["none", "null", "undefined"]:
-            logger.warning(f"[{tenant.sender_id}] send_product_image called with invalid URL: '{url}'")
-            return {"status": "Failed: You must provide a valid image_url string."}
+        ref = (call_args.get("image") or call_args.get("image_url") or "").strip()
+        if not ref or ref.lower() in ["none", "null", "undefined"]:
+            logger.warning(f"[{tenant.sender_id}] send_product_image called with invalid image: '{ref}'")
+            return {"status": "Failed: You must provide an image handle (e.g. 'img1') from search_products results."}
 
-        # Only URLs that came back from search_products may be sent — blocks
+        # Only images that came back from search_products may be sent — blocks
         # hallucinated or prompt-injected URLs going out under the shop's name.
-        allowed = _allowed_images.get(_conversation_key(tenant)) or set()
-        if url not in allowed:
-            logger.warning(f"[{tenant.sender_id}] send_product_image blocked non-catalog URL: {url[:100]}")
+        # A raw catalog URL (older history) is accepted too.
+        handles = _image_handles(_conversation_key(tenant))
+        url = handles.get(ref) or (ref if ref in handles.values() else None)
+        if url is None:
+            logger.warning(f"[{tenant.sender_id}] send_product_image blocked unknown image: {ref[:100]}")
             return {
-                "status": "Failed: That URL is not from this store's search results. "
-                          "Use the exact image_url field from search_products output."
+                "status": "Failed: That image is not from this store's search results. "
+                          "Use an img handle from search_products output."
             }
 
         success = await messaging_service.send_image(
@@ -715,16 +822,13 @@ class AgentService:
 
         profile_context = ""
         try:
-            supabase = await get_supabase()
-            result = await supabase.table("customers") \
-                .select("name, preferred_sizes, last_delivery_address, contact_number") \
-                .eq("messenger_psid", tenant.sender_id) \
-                .eq("shop_id", tenant.shop_id) \
-                .maybe_single() \
-                .execute()
+            # Usually served from the conversation_bootstrap snapshot the
+            # takeover check already fetched — no extra round trip.
+            profile = await persistence_service.get_customer_profile(
+                tenant.shop_id, tenant.sender_id
+            )
 
-            if result and result.data:
-                profile = result.data
+            if profile:
                 parts = []
                 if profile.get("name"):
                     parts.append(f"Name: {profile['name']}")
@@ -763,6 +867,17 @@ class AgentService:
         request_start = time.perf_counter()
         mem_key = _conversation_key(tenant)
 
+        # Token budget — in-memory ledger, no DB round trip.
+        budget = budget_service.policy(tenant.shop_id)
+        if budget.blocked:
+            logger.warning(f"[{sender_id}] 💸 Monthly token budget exhausted (shop={tenant.shop_id}) — staying silent")
+            return ""
+        if self.provider == "openai":
+            model = settings.budget_degraded_openai_model if budget.degraded else settings.openai_model
+        else:
+            model = settings.budget_degraded_gemini_model if budget.degraded else settings.gemini_model
+        max_turns = settings.budget_degraded_max_turns if budget.degraded else MAX_TURNS
+
         # Rehydrate memory from the DB after a restart or TTL eviction, so the
         # bot doesn't lose the thread mid-conversation.
         if not memory_service.get_history(mem_key):
@@ -773,33 +888,67 @@ class AgentService:
                 memory_service.seed_history(mem_key, transcript)
                 logger.info(f"[{sender_id}] 💧 Rehydrated {len(transcript)} messages from DB")
 
-        # Compose the per-request system instruction: tenant persona + platform
-        # rules + customer profile. Passed as a parameter (never stored on self)
-        # so concurrent conversations can't leak profiles into each other.
-        ai_config = await get_ai_config(tenant.shop_id)
-        profile_context = await self._get_customer_profile(tenant)
-        greeting_hint = (
-            f"\n\n[If this is the start of the conversation, open with: \"{ai_config['greeting_message']}\"]"
-            if ai_config["greeting_message"] else ""
-        )
-        system_instruction = (
-            CORE_IDENTITY
-            + ai_config["system_prompt"]
-            + PLATFORM_RULES
-            + (SPLIT_RULES if tenant.allow_split_replies else "")
-            + greeting_hint
-            + profile_context
-            + _conversation_state(mem_key)
-            + (CROSSED_REPLY_NOTE if crossed else "")
+        # Photos are downloaded once here and shared by visual search and the
+        # provider call. Visual search runs while the prompt is assembled.
+        images = await self._download_images(sender_id, image_urls) if image_urls else []
+        first_image = next((img for img in images if img is not None), None)
+        visual_task = (
+            asyncio.create_task(self._visual_matches(first_image, tenant))
+            if first_image is not None and settings.visual_search_enabled else None
         )
 
+        try:
+            # Compose the per-request system instruction: tenant persona + platform
+            # rules + customer profile. Passed as a parameter (never stored on self)
+            # so concurrent conversations can't leak profiles into each other.
+            ai_config = await get_ai_config(tenant.shop_id)
+            profile_context = await self._get_customer_profile(tenant)
+            # Small shops: the whole catalog rides in the prompt (no search turn).
+            # Its image handles must resolve in send_product_image.
+            digest = catalog_digest.get(tenant.shop_id)
+            if digest is not None and digest.images:
+                handles = _image_handles(mem_key)
+                if any(handles.get(h) != url for h, url in digest.images.items()):
+                    _allowed_images[mem_key] = {**handles, **digest.images}
+            greeting_hint = (
+                f"\n\n[If this is the start of the conversation, open with: \"{ai_config['greeting_message']}\"]"
+                if ai_config["greeting_message"] else ""
+            )
+            system_instruction = (
+                CORE_IDENTITY
+                + ai_config["system_prompt"]
+                + PLATFORM_RULES
+                # Shop-stable up to here — kept as one prefix for prompt caching
+                + (digest.text if digest is not None else "")
+                + (SPLIT_RULES if tenant.allow_split_replies else "")
+                + greeting_hint
+                + profile_context
+                + _conversation_state(mem_key)
+                + (CROSSED_REPLY_NOTE if crossed else "")
+            )
+        except BaseException:
+            # Never leave the visual search running, or its error unretrieved
+            if visual_task is not None:
+                visual_task.cancel()
+                visual_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            raise
+
+        visual_note = ""
+        if visual_task is not None:
+            try:
+                visual_note = await visual_task
+            except Exception as e:
+                logger.error(f"[{sender_id}] Visual search failed: {e}", exc_info=True)
+
         if self.provider == "openai":
             reply, tokens = await self._process_openai(
-                mem_key, sender_id, message_text, image_urls, tenant, system_instruction
+                mem_key, sender_id, message_text, images, tenant, system_instruction,
+                model=model, max_turns=max_turns, visual_note=visual_note,
             )
         else:
             reply, tokens = await self._process_gemini(
-                mem_key, sender_id, message_text, image_urls, tenant, system_instruction
+                mem_key, sender_id, message_text, images, tenant, system_instruction,
+                model=model, max_turns=max_turns, visual_note=visual_note,
             )
 
         total_ms = (time.perf_counter() - request_start) * 1000
@@ -810,7 +959,7 @@ class AgentService:
             shop_id=tenant.shop_id,
             sender_psid=tenant.sender_id,
             provider=self.provider,
-            model=settings.openai_model if self.provider == "openai" else settings.gemini_model,
+            model=model,
             kind="chat",
             prompt_tokens=tokens["prompt"],
             completion_tokens=tokens["completion"],
@@ -819,7 +968,9 @@ class AgentService:
             message_chars=len(message_text or ""),
             reply_chars=len(reply or ""),
             latency_ms=int(total_ms),
+            tool_tokens_saved=_encoding_savings.pop(mem_key, 0),
         )
+        budget_service.record(tenant.shop_id, tokens["total"])
 
         # Legacy safety net only — the model is no longer told to self-silence,
         # but if the token ever appears, honor/strip it.
@@ -849,13 +1000,23 @@ class AgentService:
             f"\"{reply_preview}\""
         )
 
-        if memory_service.visible_len(mem_key) > settings.summarize_threshold and mem_key not in self._summarizing:
+        if (
+            not budget.degraded
+            and memory_service.visible_len(mem_key) > settings.summarize_threshold
+            and mem_key not in self._summarizing
+        ):
             self._summarizing.add(mem_key)
-            task = asyncio.create_task(self._summarize_history_task(mem_key, sender_id))
-            task.add_done_callback(lambda t, k=mem_key: self._summarizing.discard(k))
+            if not task_supervisor.spawn("summary", self._summarize_guarded(mem_key, sender_id)):
+                self._summarizing.discard(mem_key)
 
         return reply
 
+    async def _summarize_guarded(self, mem_key: str, sender_id: str):
+        try:
+            await self._summarize_history_task(mem_key, sender_id)
+        finally:
+            self._summarizing.discard(mem_key)
+
     async def _summarize_history_task(self, mem_key: str, sender_id: str):
         """Background task to summarize older history to save tokens."""
         history = memory_service.get_history(mem_key)
@@ -892,7 +1053,7 @@ class AgentService:
                     prods = resp.get("products_found")
                     if isinstance(prods, list) and prods:
                         names = ", ".join(
-                            f"{x.get('name')} ({x.get('price')} BDT)"
+                            f"{x.get('n', x.get('name'))} ({x.get('p', x.get('price'))} BDT)"
                             for x in prods[:5] if isinstance(x, dict)
                         )
                         text_convo += f"[catalog showed: {names}]\n"
@@ -951,6 +1112,7 @@ class AgentService:
                     turns=1,
                     latency_ms=0,
                 )
+                budget_service.record(shop_id, sum_prompt_tokens + sum_completion_tokens)
 
             if summary:
                 logger.info(f"[{sender_id}] Replaced history with summary: {summary}")
@@ -969,9 +1131,13 @@ class AgentService:
         mem_key: str,
         sender_id: str,
         message_text: str,
-        image_urls: list[str] | None,
+        images: list[tuple[bytes, str] | None],
         tenant: TenantContext,
         system_instruction: str,
+        *,
+        model: str,
+        max_turns: int = MAX_TURNS,
+        visual_note: str = "",
     ) -> tuple[str, dict]:
         """Returns (reply, tokens). An empty reply means an internal error
         occurred — the caller stays SILENT toward the user (errors are only
@@ -993,40 +1159,45 @@ class AgentService:
         parts = []
         if message_text:
             parts.append(types.Part.from_text(text=message_text))
-        elif image_urls:
+        elif images:
             # No text with the photo — nudge the model to infer intent
             parts.append(types.Part.from_text(
                 text="[The customer sent the following photo(s) with no text — infer their intent using the photo rules.]"
             ))
 
-        if image_urls:
-            for url in image_urls:
-                try:
-                    import tempfile
-                    import os
+        for image in images:
+            if image is None:
+                parts.append(types.Part.from_text(text="[User attached an image but the system failed to download it]"))
+                continue
+            try:
+                import tempfile
+                import os
 
-                    image_bytes, mime_type = await self._download_image(url)
+                image_bytes, mime_type = image
 
-                    # Write to temp file because the SDK upload function requires a valid file path or supported file-like object
-                    temp_file_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4().hex}.img")
-                    with open(temp_file_path, "wb") as f:
-                        f.write(image_bytes)
+                # Write to temp file because the SDK upload function requires a valid file path or supported file-like object
+                temp_file_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4().hex}.img")
+                with open(temp_file_path, "wb") as f:
+                    f.write(image_bytes)
 
-                    try:
-                        uploaded_file = await self.gemini_client.aio.files.upload(
-                            file=temp_file_path,
-                            config={'mime_type': mime_type}
-                        )
-                    finally:
-                        os.remove(temp_file_path)
+                try:
+                    uploaded_file = await self.gemini_client.aio.files.upload(
+                        file=temp_file_path,
+                        config={'mime_type': mime_type}
+                    )
+                finally:
+                    os.remove(temp_file_path)
 
-                    # Use the Cloud URI so your server's context memory RAM stays tiny!
-                    parts.append(types.Part.from_uri(file_uri=uploaded_file.uri, mime_type=mime_type))
-                    logger.info(f"[{sender_id}] 📷 Uploaded image to Gemini Cloud: {uploaded_file.uri}")
+                # Use the Cloud URI so your server's context memory RAM stays tiny!
+                parts.append(types.Part.from_uri(file_uri=uploaded_file.uri, mime_type=mime_type))
+                logger.info(f"[{sender_id}] 📷 Uploaded image to Gemini Cloud: {uploaded_file.uri}")
 
-                except Exception as e:
-                    logger.error(f"[{sender_id}] Failed to upload image: {e}", exc_info=True)
-                    parts.append(types.Part.from_text(text="[User attached an image but the system failed to download it]"))
+            except Exception as e:
+                logger.error(f"[{sender_id}] Failed to upload image: {e}", exc_info=True)
+                parts.append(types.Part.from_text(text="[User attached an image but the system failed to download it]"))
+
+        if visual_note:
+            parts.append(types.Part.from_text(text=visual_note))
 
         if not parts:
             parts.append(types.Part.from_text(text="[Empty message]"))
@@ -1056,7 +1227,6 @@ class AgentService:
         )
 
         # 4. Agent Execution Loop
-        MAX_TURNS = 5
         total_prompt = 0
         total_completion = 0
         turns_used = 0
@@ -1071,12 +1241,12 @@ class AgentService:
                 "tools": tools_used,
             }
 
-        for turn in range(MAX_TURNS):
-            is_final_turn = turn == MAX_TURNS - 1
-            logger.debug(f"[{sender_id}] Gemini agent loop — turn {turn + 1}/{MAX_TURNS}")
+        for turn in range(max_turns):
+            is_final_turn = turn == max_turns - 1
+            logger.debug(f"[{sender_id}] Gemini agent loop — turn {turn + 1}/{max_turns}")
             try:
                 response = await self.gemini_client.aio.models.generate_content(
-                    model=settings.gemini_model,
+                    model=model,
                     contents=history,
                     config=final_turn_config if is_final_turn else config
                 )
@@ -1143,7 +1313,7 @@ class AgentService:
 
         # Unreachable in practice — the final turn forbids tool calls, so it
         # always returns text above. Kept as a safety net.
-        logger.warning(f"[{sender_id}] Agent exceeded max turns ({MAX_TURNS}) — staying silent")
+        logger.warning(f"[{sender_id}] Agent exceeded max turns ({max_turns}) — staying silent")
         return "", _usage()
 
     # ─────────────────────────────────────────────────────────────────────
@@ -1155,9 +1325,13 @@ class AgentService:
         mem_key: str,
         sender_id: str,
         message_text: str,
-        image_urls: list[str] | None,
+        images: list[tuple[bytes, str] | None],
         tenant: TenantContext,
         system_instruction: str,
+        *,
+        model: str,
+        max_turns: int = MAX_TURNS,
+        visual_note: str = "",
     ) -> tuple[str, dict]:
         """Returns (reply, tokens). An empty reply means an internal error
         occurred — the caller stays SILENT toward the user (errors are only
@@ -1176,9 +1350,9 @@ class AgentService:
         logger.debug(f"[{sender_id}] Loaded {len(messages) - 1} history entries (excl. system)")
 
         # 2. Build user message
-        if image_urls:
-            # Multimodal message with images — download and base64-encode because
-            # Facebook CDN URLs are temporary/restricted and OpenAI can't fetch them.
+        if images:
+            # Multimodal message with images — base64-encoded because Facebook
+            # CDN URLs are temporary/restricted and OpenAI can't fetch them.
             import base64
             content_parts = []
             if message_text:
@@ -1189,16 +1363,17 @@ class AgentService:
                     "type": "text",
                     "text": "[The customer sent the following photo(s) with no text — infer their intent using the photo rules.]",
                 })
-            for url in image_urls:
-                try:
-                    image_bytes, mime_type = await self._download_image(url)
-                    b64 = base64.b64encode(image_bytes).decode("utf-8")
-                    data_uri = f"data:{mime_type};base64,{b64}"
-                    content_parts.append({"type": "image_url", "image_url": {"url": data_uri}})
-                    logger.info(f"[{sender_id}] 📷 Downloaded image for OpenAI ({len(image_bytes)} bytes, {mime_type})")
-                except Exception as e:
-                    logger.error(f"[{sender_id}] Failed to download image for OpenAI: {e}", exc_info=True)
+            for image in images:
+                if image is None:
                     content_parts.append({"type": "text", "text": "[User sent an image but the system failed to download it]"})
+                    continue
+                image_bytes, mime_type = image
+                b64 = base64.b64encode(image_bytes).decode("utf-8")
+                data_uri = f"data:{mime_type};base64,{b64}"
+                content_parts.append({"type": "image_url", "image_url": {"url": data_uri}})
+                logger.info(f"[{sender_id}] 📷 Attached image for OpenAI ({len(image_bytes)} bytes, {mime_type})")
+            if visual_note:
+                content_parts.append({"type": "text", "text": visual_note})
             user_msg = {"role": "user", "content": content_parts}
         elif message_text:
             user_msg = {"role": "user", "content": message_text}
@@ -1213,7 +1388,6 @@ class AgentService:
         messages.append(user_msg)
 
         # 3. Agent Execution Loop
-        MAX_TURNS = 5
         total_prompt = 0
         total_completion = 0
         turns_used = 0
@@ -1228,12 +1402,12 @@ class AgentService:
                 "tools": tools_used,
             }
 
-        for turn in range(MAX_TURNS):
-            is_final_turn = turn == MAX_TURNS - 1
-            logger.debug(f"[{sender_id}] OpenAI agent loop — turn {turn + 1}/{MAX_TURNS}")
+        for turn in range(max_turns):
+            is_final_turn = turn == max_turns - 1
+            logger.debug(f"[{sender_id}] OpenAI agent loop — turn {turn + 1}/{max_turns}")
             try:
                 response = await self.openai_client.chat.completions.create(
-                    model=settings.openai_model,
+                    model=model,
                     messages=messages,
                     tools=OPENAI_TOOLS,
                     # The final turn forbids tools, forcing a text answer instead
@@ -1329,7 +1503,7 @@ class AgentService:
                 })
 
         # Unreachable in practice — the final turn forbids tool calls. Safety net.
-        logger.warning(f"[{sender_id}] Agent exceeded max turns ({MAX_TURNS}) — staying silent")
+        logger.warning(f"[{sender_id}] Agent exceeded max turns ({max_turns}) — staying silent")
         return "", _usage()
 
     @staticmethod
@@ -0,0 +1,173 @@
+"""Per-shop monthly LLM token budgets.
+
+usage_service records what a shop spent; this module decides what it may
+still spend. The hot path never waits on the DB:
+
+  - An in-process ledger holds each shop's tokens for the current calendar
+    month (UTC). AgentService.record()s every run's token total right after
+    the run, so the ledger is current within this process.
+  - policy(shop_id) is a couple of dict lookups. It returns:
+      normal   — below BUDGET_DEGRADE_RATIO of the limit
+      degraded — cheaper model, fewer agent turns, no history summarization
+      blocked  — at/over the limit: the bot stays silent (logged once)
+  - A background loop reconciles the ledger with llm_usage every
+    BUDGET_RECONCILE_INTERVAL seconds through the shop_token_usage RPC. The
+    RPC also returns bot_settings.monthly_token_budget, so a limit edited in
+    the dashboard applies on the next reconcile. A shop seen for the first
+    time wakes the loop so its real month-to-date total arrives within
+    seconds, not minutes.
+
+Limits: bot_settings.monthly_token_budget per shop, else
+DEFAULT_MONTHLY_TOKEN_BUDGET; 0 / NULL = unlimited. If the migration hasn't
+been run, every shop stays on the platform default (a warning is logged
+once) and the ledger counts this process's usage only.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from app.core.config import settings
+from app.core.dependencies import get_supabase
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class BudgetPolicy:
+    """What the agent may spend on one run."""
+    level: str               # "normal" | "degraded" | "blocked"
+    degraded: bool = False   # use the cheaper model / turn cap, skip summaries
+
+    @property
+    def blocked(self) -> bool:
+        return self.level == "blocked"
+
+
+NORMAL = BudgetPolicy("normal")
+DEGRADED = BudgetPolicy("degraded", degraded=True)
+BLOCKED = BudgetPolicy("blocked", degraded=True)
+
+
+def _current_period() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m")
+
+
+class BudgetService:
+
+    def __init__(self) -> None:
+        self._period = _current_period()
+        # shop_id -> tokens used this period (as far as this process knows)
+        self._used: dict[str, int] = {}
+        # shop_id -> per-shop override from bot_settings (None = platform default)
+        self._limits: dict[str, int | None] = {}
+        # Last level reported per shop, so transitions are logged once
+        self._levels: dict[str, str] = {}
+        self._task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+        self._rpc_supported = True
+
+    def _limit(self, shop_id: str) -> int:
+        limit = self._limits.get(shop_id)
+        return settings.default_monthly_token_budget if limit is None else limit
+
+    def policy(self, shop_id: str) -> BudgetPolicy:
+        """O(1) budget decision for one agent run."""
+        if shop_id not in self._used:
+            self._used[shop_id] = 0
+            self._ensure_reconciler(wake=True)
+
+        limit = self._limit(shop_id)
+        if limit <= 0:
+            return NORMAL
+        used = self._used[shop_id]
+        if used >= limit:
+            result = BLOCKED
+        elif used >= limit * settings.budget_degrade_ratio:
+            result = DEGRADED
+        else:
+            result = NORMAL
+
+        if self._levels.get(shop_id, "normal") != result.level:
+            self._levels[shop_id] = result.level
+            log = logger.warning if result.level != "normal" else logger.info
+            log(f"💸 shop={shop_id} token budget {result.level} — {used:,}/{limit:,} tokens this month")
+        return result
+
+    def record(self, shop_id: str, tokens: int) -> None:
+        """Add one run's tokens to the shop's ledger."""
+        if not tokens:
+            return
+        self._roll_period()
+        self._used[shop_id] = self._used.get(shop_id, 0) + int(tokens)
+        self._ensure_reconciler()
+
+    def _roll_period(self) -> None:
+        period = _current_period()
+        if period != self._period:
+            logger.info(f"Token budgets: new period {period} — ledger reset")
+            self._period = period
+            self._used = {shop_id: 0 for shop_id in self._used}
+            self._levels.clear()
+
+    def _ensure_reconciler(self, wake: bool = False) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._reconcile_loop())
+        if wake:
+            self._wake.set()
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=settings.budget_reconcile_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Token budget reconcile failed: {e}")
+            # Coalesce a burst of first-seen shops into one RPC
+            await asyncio.sleep(1.0)
+
+    async def reconcile(self) -> None:
+        """Pull month-to-date totals and per-shop limits for known shops."""
+        self._roll_period()
+        if not self._rpc_supported or not self._used:
+            return
+        month_start = datetime.now(timezone.utc).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        supabase = await get_supabase()
+        try:
+            result = await supabase.rpc("shop_token_usage", {
+                "p_shop_ids": list(self._used),
+                "p_since": month_start.isoformat(),
+            }).execute()
+        except Exception as e:
+            if "shop_token_usage" in str(e):
+                self._rpc_supported = False
+                logger.warning(
+                    f"shop_token_usage RPC unavailable ({e}) — run the 20261019_token_budgets.sql "
+                    "migration. Budgets now use DEFAULT_MONTHLY_TOKEN_BUDGET and this process's usage only."
+                )
+                return
+            raise
+
+        for row in result.data or []:
+            shop_id = row["shop_id"]
+            # max(): rows still in the usage write-behind buffer are in the
+            # ledger but not yet in llm_usage.
+            self._used[shop_id] = max(int(row.get("total_tokens") or 0), self._used.get(shop_id, 0))
+            budget = row.get("monthly_token_budget")
+            self._limits[shop_id] = None if budget is None else int(budget)
+
+    async def shutdown(self) -> None:
+        """Stop the reconcile loop. Called during app shutdown."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+budget_service = BudgetService()
@@ -0,0 +1,120 @@
+"""Whole-catalog digest in the system instruction for small shops.
+
+Many shops sell 10–50 products. For them a search_products turn (LLM call →
+embedding + search → LLM call) buys nothing the model couldn't have known
+up front. CatalogDigest keeps, per small shop, one compact line per product
+— name, price, image handle, and the in-stock variants with their ids — and
+agent_service puts it in the system instruction right after PLATFORM_RULES,
+so the model can show products and prepare orders with no search turn.
+
+  - Rows come from catalog_mirror (lazy load, webhook updates, checksum
+    reconcile); until the shop is mirrored (and for shops with more than
+    CATALOG_DIGEST_MAX_PRODUCTS products) get() returns None and the agent
+    searches as before.
+  - Rendered once per mirror version, i.e. only after the catalog changed.
+  - Cache-friendly: the digest text only changes when the catalog does, so
+    CORE_IDENTITY + persona + PLATFORM_RULES + digest stays a stable prompt
+    prefix that the providers' implicit prompt caching can reuse.
+
+Image handles are "c1", "c2", … per shop (stable until the catalog
+changes); Digest.images maps them to URLs for the conversation's
+send_product_image whitelist.
+"""
+
+from dataclasses import dataclass
+
+from app.core.config import settings
+from app.core.logging_config import get_logger
+from app.services.catalog_mirror import catalog_mirror
+from app.services.catalog_rows import group_variants
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class Digest:
+    """Rendered digest text plus the image handles it mentions."""
+    text: str
+    images: dict[str, str]   # "c1" -> URL
+    products: int
+
+
+def _in_stock(variant: dict) -> bool:
+    stock = variant.get("stock")
+    try:
+        return stock is None or int(stock) > 0
+    except (TypeError, ValueError):
+        return True
+
+
+def render(rows: list[dict]) -> Digest:
+    """Digest of a shop's product rows (grouped into products by name)."""
+    names = sorted({row["name"] for row in rows}, key=str.casefold)
+    products = group_variants(names, rows)
+    images: dict[str, str] = {}
+    lines = []
+    for product in products:
+        parts = [product["name"]]
+        if product.get("price") is not None:
+            parts.append(f"{product['price']} BDT")
+        if product.get("image_url"):
+            handle = f"c{len(images) + 1}"
+            images[handle] = product["image_url"]
+            parts.append(handle)
+        variants = []
+        for v in product["variants"]:
+            if not _in_stock(v):
+                continue
+            label = f"{v['size']}=" if v.get("size") else ""
+            price = f"@{v['price']}" if v.get("price") is not None else ""
+            variants.append(f"{label}{v['product_id']}{price}")
+        parts.append(", ".join(variants) if variants else "OUT OF STOCK")
+        lines.append(" | ".join(str(p) for p in parts))
+    text = (
+        f"\n\n## STORE CATALOG (all {len(products)} products — trusted, current)\n"
+        "name | price | img handle | in-stock variants as size=id (@price if different)\n"
+        + "\n".join(lines)
+        + "\nThis is the complete catalog: answer availability/price questions, send images "
+        "(send_product_image with the c-handle) and prepare orders (variant ids) straight from "
+        "it. Call search_products only for details not listed here (description, fabric …)."
+    )
+    return Digest(text=text, images=images, products=len(products))
+
+
+class CatalogDigest:
+    """Per-shop digests for shops small enough to list in full."""
+
+    def __init__(self) -> None:
+        # shop_id -> (mirror version, digest)
+        self._rendered: dict[str, tuple[int, Digest]] = {}
+        self.served = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.catalog_digest_max_products > 0
+
+    def get(self, shop_id: str) -> Digest | None:
+        """The shop's digest, or None (not mirrored yet / too big / disabled)."""
+        if not self.enabled:
+            return None
+        mirror = catalog_mirror.get(shop_id)
+        if mirror is None or mirror.product_count > settings.catalog_digest_max_products:
+            self._rendered.pop(shop_id, None)
+            return None
+        cached = self._rendered.get(shop_id)
+        if cached is None or cached[0] != mirror.version:
+            cached = (mirror.version, render(list(mirror.rows.values())))
+            self._rendered[shop_id] = cached
+            logger.info(f"Catalog digest: rendered {cached[1].products} products for shop={shop_id}")
+        self.served += 1
+        return cached[1]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "shops": len(self._rendered),
+            "served": self.served,
+        }
+
+
+catalog_digest = CatalogDigest()
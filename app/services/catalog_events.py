@@ -0,0 +1,186 @@
+"""Catalog change notifications for every process that serves searches.
+
+The product webhook publishes one CatalogChange per product write; the
+in-memory catalog structures (vector index, mirror, search cache, ...)
+subscribe and update themselves incrementally instead of reloading the shop.
+
+The webhook lands in ONE process, so publish() also delivers the change to
+the others:
+  - sharded mode: the webhook runs in the ingest process while searches run
+    in the workers, so the change is broadcast to every worker, which
+    re-publishes it locally (shard_service event kind "catalog");
+  - STATE_BACKEND=sqlite (plain uvicorn --workers N): the change is
+    appended to a relay table in the shared state file, which every worker
+    polls every _RELAY_SECONDS and delivers locally (start_relay()).
+  - otherwise (memory backend) there is one worker and delivery is local.
+
+Subscribers are plain sync callables; one raising is logged and never
+stops the others.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+from app.core.config import settings
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+_RELAY_SECONDS = 1.0
+# Relayed changes are kept this long (a worker that lags further reloads on reconcile).
+_RELAY_HISTORY_SECONDS = 600.0
+
+
+@dataclass(frozen=True)
+class CatalogChange:
+    """One product row written or removed."""
+    shop_id: str
+    product_id: str
+    op: str                                 # "upsert" | "delete"
+    row: dict | None = None                 # products columns (no embedding)
+    embedding: list[float] | None = None    # set when the row has a fresh vector
+
+
+_subscribers: list[Callable[[CatalogChange], None]] = []
+
+
+def subscribe(fn: Callable[[CatalogChange], None]) -> None:
+    """Register fn to be called with every CatalogChange in this process."""
+    _subscribers.append(fn)
+
+
+def notify(change: CatalogChange) -> None:
+    """Deliver a change to this process's subscribers."""
+    for fn in _subscribers:
+        try:
+            fn(change)
+        except Exception as e:
+            logger.error(f"Catalog subscriber {getattr(fn, '__qualname__', fn)} failed: {e}", exc_info=True)
+
+
+async def publish(change: CatalogChange, *, relay: bool = True) -> None:
+    """Deliver a change wherever searches run (local, every shard worker or every worker).
+
+    relay=False skips the cross-worker relay for a change every worker
+    already receives on its own (the embedding queue's relay).
+    """
+    from app.services.shard_service import shard_service
+
+    if shard_service.enabled:
+        try:
+            await shard_service.broadcast(f"catalog:{change.shop_id}", {
+                "kind": "catalog", "change": asdict(change),
+            })
+        except Exception as e:
+            logger.error(f"Catalog change broadcast failed ({change.op} {change.product_id}): {e}")
+        return
+    notify(change)
+    if relay and _relay.running:
+        try:
+            await asyncio.to_thread(_relay.append, change)
+        except Exception as e:
+            logger.error(f"Catalog change relay failed ({change.op} {change.product_id}): {e}")
+
+
+class _Relay:
+    """Catalog changes shared between uvicorn workers through the state file."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._task: asyncio.Task | None = None
+        self._last_purge = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                settings.state_sqlite_path, timeout=5.0, isolation_level=None, check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS catalog_relay ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, origin INTEGER NOT NULL,"
+                " change TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def append(self, change: CatalogChange) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            conn.execute(
+                "INSERT INTO catalog_relay (origin, change, created_at) VALUES (?, ?, ?)",
+                (os.getpid(), json.dumps(asdict(change), ensure_ascii=False), now),
+            )
+            if now - self._last_purge >= 60.0:
+                self._last_purge = now
+                conn.execute("DELETE FROM catalog_relay WHERE created_at <= ?", (now - _RELAY_HISTORY_SECONDS,))
+
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._db().execute("SELECT coalesce(max(seq), 0) FROM catalog_relay").fetchone()[0]
+
+    def since(self, seq: int) -> tuple[int, list[CatalogChange]]:
+        """Changes other processes appended after seq."""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT seq, origin, change FROM catalog_relay WHERE seq > ? ORDER BY seq LIMIT 500", (seq,),
+            ).fetchall()
+        if not rows:
+            return seq, []
+        own = os.getpid()
+        return rows[-1][0], [CatalogChange(**json.loads(c)) for _, origin, c in rows if origin != own]
+
+    def start(self) -> None:
+        if settings.state_backend.lower().strip() != "sqlite" or self.running:
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self) -> None:
+        seq = await asyncio.to_thread(self.last_seq)
+        logger.info(f"Catalog changes relayed between workers through {settings.state_sqlite_path}")
+        while True:
+            await asyncio.sleep(_RELAY_SECONDS)
+            try:
+                seq, changes = await asyncio.to_thread(self.since, seq)
+                for change in changes:
+                    notify(change)
+            except Exception as e:
+                logger.error(f"Catalog change relay poll failed: {e}")
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+_relay = _Relay()
+
+
+def start_relay() -> None:
+    """Relay changes between uvicorn workers (STATE_BACKEND=sqlite, not sharded).
+
+    Called from the app lifespan after shard_service.start().
+    """
+    from app.services.shard_service import shard_service
+
+    if not shard_service.enabled:
+        _relay.start()
+
+
+async def stop_relay() -> None:
+    """Stop polling the relay. Called during app shutdown."""
+    await _relay.stop()
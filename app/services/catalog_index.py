@@ -0,0 +1,304 @@
+"""Optional in-process vector index per shop.
+
+Most shops have a few thousand product rows at most, so their whole catalog
+fits in one contiguous float32 matrix. A search is then one matrix-vector
+product in process (sub-millisecond) instead of the match_products_hybrid
+RPC + variant-expansion query round trips.
+
+  - Lazy: a shop's rows are loaded (paged, in the background) the first
+    time it searches; until the load finishes, and for shops above
+    CATALOG_INDEX_MAX_PRODUCTS, search() returns None and RagService uses
+    the RPC as before.
+  - Kept in sync by catalog_events (product webhook), and fully reloaded
+    every CATALOG_INDEX_REFRESH_SECONDS to catch a missed delivery.
+  - Bounded: shops are evicted least-recently-searched first once the
+    total exceeds CATALOG_INDEX_MAX_VECTORS rows (~3 KB each).
+  - numpy is imported lazily; without it (or with CATALOG_INDEX_ENABLED
+    off) the index stays disabled and nothing changes.
+
+Rows are stored L2-normalized, so the dot product IS cosine similarity.
+Each shop also carries a BM25 keyword index (lexical_index) over the same
+rows; the two rankings are merged with reciprocal-rank fusion, which is the
+in-process equivalent of match_products_hybrid's FTS + vector blend.
+"""
+
+import asyncio
+import json
+import time
+
+from cachetools import LRUCache
+
+from app.core.config import settings
+from app.core.dependencies import get_supabase
+from app.core.logging_config import get_logger
+from app.services import catalog_events
+from app.services.catalog_events import CatalogChange
+from app.services.lexical_index import Bm25Index, document_tokens, rrf, tokenize
+
+logger = get_logger(__name__)
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency — RPC search only
+    np = None
+
+# Candidates taken from EACH ranking before fusion.
+_FUSION_DEPTH = 30
+
+# Columns kept per row — everything search results are built from.
+_ROW_COLUMNS = "id, name, price, description, image_url, attributes"
+_PAGE_SIZE = 1000
+# Spare rows allocated when a shop's matrix first has to grow.
+_MIN_CAPACITY = 64
+# gemini-embedding-2 output size (rag_service.EMBEDDING_DIMENSIONS)
+_DIMENSIONS = 768
+
+
+def _parse_vector(raw) -> "np.ndarray | None":
+    """pgvector arrives from PostgREST as the text '[0.1,0.2,...]'."""
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    vec = np.asarray(raw, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else None
+
+
+class _ShopIndex:
+    """One shop's rows, their normalized embedding matrix and BM25 index."""
+
+    def __init__(self, rows: list[dict], vectors: list) -> None:
+        self.rows = rows
+        # Rows [0, len(rows)) are live; the rest is spare capacity so upserts
+        # append in place and only reallocate (doubling) when it runs out.
+        self._buffer = np.vstack(vectors) if vectors else np.zeros((0, _DIMENSIONS), dtype=np.float32)
+        self.position = {row["id"]: i for i, row in enumerate(rows)}
+        self.lexical = Bm25Index()
+        for row in rows:
+            self.lexical.add(row["id"], document_tokens(row))
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def matrix(self) -> "np.ndarray":
+        return self._buffer[:len(self.rows)]
+
+    def upsert(self, row: dict, vector) -> None:
+        self.lexical.add(row["id"], document_tokens(row))
+        i = self.position.get(row["id"])
+        if i is not None:
+            self.rows[i] = row
+            self.matrix[i] = vector
+            return
+        n = len(self.rows)
+        if n == len(self._buffer):
+            grown = np.zeros((max(2 * n, _MIN_CAPACITY), _DIMENSIONS), dtype=np.float32)
+            grown[:n] = self._buffer
+            self._buffer = grown
+        self._buffer[n] = vector
+        self.position[row["id"]] = n
+        self.rows.append(row)
+
+    def update_fields(self, product_id: str, fields: dict) -> None:
+        i = self.position.get(product_id)
+        if i is None:
+            return
+        self.rows[i] = {**self.rows[i], **{k: v for k, v in fields.items() if k in self.rows[i]}}
+        self.lexical.add(product_id, document_tokens(self.rows[i]))
+
+    def remove(self, product_id: str) -> None:
+        self.lexical.remove(product_id)
+        i = self.position.pop(product_id, None)
+        if i is None:
+            return
+        n = len(self.rows)
+        self._buffer[i:n - 1] = self._buffer[i + 1:n]
+        del self.rows[i]
+        self.position = {row["id"]: j for j, row in enumerate(self.rows)}
+
+    def _names_by(self, row_order) -> list[str]:
+        """Distinct product names in best-row-first order, up to _FUSION_DEPTH."""
+        names: list[str] = []
+        for i in row_order:
+            name = self.rows[i]["name"]
+            if name not in names:
+                names.append(name)
+                if len(names) >= _FUSION_DEPTH:
+                    break
+        return names
+
+    def search(self, query, query_text: str, match_count: int) -> tuple[list[str], list[dict]]:
+        """Top product NAMES (vector ⊕ BM25 via RRF), plus all their rows."""
+        if not self.rows:
+            return [], []
+        scores = self.matrix @ query
+        # Over-fetch rows: several top rows are usually sizes of one product
+        k = min(len(scores), _FUSION_DEPTH * 4)
+        top = np.argpartition(-scores, k - 1)[:k]
+        vector_names = self._names_by(top[np.argsort(-scores[top])])
+
+        names = rrf([vector_names, self._keyword_names(query_text)])[:match_count]
+        return names, self._rows_named(names)
+
+    def search_lexical(self, query_text: str, match_count: int) -> tuple[list[str], list[dict]]:
+        names = self._keyword_names(query_text)[:match_count]
+        return names, self._rows_named(names)
+
+    def _keyword_names(self, query_text: str) -> list[str]:
+        keyword_scores = self.lexical.score(tokenize(query_text))
+        keyword_rows = sorted(keyword_scores, key=keyword_scores.__getitem__, reverse=True)
+        return self._names_by(self.position[doc_id] for doc_id in keyword_rows)
+
+    def _rows_named(self, names: list[str]) -> list[dict]:
+        wanted = set(names)
+        return [row for row in self.rows if row["name"] in wanted]
+
+
+class CatalogIndex:
+    """Per-shop in-memory indexes with lazy loading and incremental updates."""
+
+    def __init__(self) -> None:
+        self._shops: LRUCache = LRUCache(maxsize=settings.catalog_index_max_vectors, getsizeof=lambda ix: max(len(ix), 1))
+        self._loading: dict[str, asyncio.Task] = {}
+        # shop_id -> monotonic time it was found too big (re-checked on refresh)
+        self._oversized: dict[str, float] = {}
+        # Changes published while a shop loads, replayed onto the fresh index
+        self._buffered: dict[str, list[CatalogChange]] = {}
+        self.hits = 0
+        self.fallbacks = 0
+        catalog_events.subscribe(self._on_change)
+
+    @property
+    def enabled(self) -> bool:
+        return np is not None and settings.catalog_index_enabled
+
+    def search(
+        self, shop_id: str, query_text: str, query_embedding: list[float], match_count: int,
+    ) -> tuple[list[str], list[dict]] | None:
+        """(names, variant rows) from memory, or None → use the RPC."""
+        if not self.enabled:
+            return None
+        index = self._shops.get(shop_id)
+        if index is None or time.monotonic() - index.loaded_at > settings.catalog_index_refresh_seconds:
+            self._schedule_load(shop_id)
+        if index is None:
+            self.fallbacks += 1
+            return None
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(query))
+        if not norm or index.matrix.shape[1:] != query.shape:
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        return index.search(query / norm, query_text, match_count)
+
+    def search_lexical(self, shop_id: str, query_text: str, match_count: int) -> tuple[list[str], list[dict]] | None:
+        """BM25-only (names, variant rows) — no embedding needed. None if not loaded."""
+        if not self.enabled:
+            return None
+        index = self._shops.get(shop_id)
+        if index is None:
+            return None
+        return index.search_lexical(query_text, match_count)
+
+    def _schedule_load(self, shop_id: str) -> None:
+        if shop_id in self._loading:
+            return
+        flagged = self._oversized.get(shop_id)
+        if flagged is not None and time.monotonic() - flagged < settings.catalog_index_refresh_seconds:
+            return
+        task = asyncio.create_task(self._load(shop_id))
+        self._loading[shop_id] = task
+        task.add_done_callback(lambda t, s=shop_id: self._load_done(s))
+
+    def _load_done(self, shop_id: str) -> None:
+        self._loading.pop(shop_id, None)
+        self._buffered.pop(shop_id, None)  # load failed / shop too big
+
+    async def _load(self, shop_id: str) -> None:
+        started = time.perf_counter()
+        supabase = await get_supabase()
+        rows: list[dict] = []
+        vectors: list = []
+        offset = 0
+        try:
+            while True:
+                page = await supabase.table("products") \
+                    .select(f"{_ROW_COLUMNS}, embedding") \
+                    .eq("shop_id", shop_id) \
+                    .not_.is_("embedding", "null") \
+                    .order("id") \
+                    .range(offset, offset + _PAGE_SIZE - 1) \
+                    .execute()
+                data = page.data or []
+                for row in data:
+                    vector = _parse_vector(row.pop("embedding", None))
+                    if vector is not None:
+                        rows.append(row)
+                        vectors.append(vector)
+                if len(rows) > settings.catalog_index_max_products:
+                    self._oversized[shop_id] = time.monotonic()
+                    self._shops.pop(shop_id, None)
+                    logger.info(
+                        f"Catalog index: shop={shop_id} has >{settings.catalog_index_max_products} "
+                        "products — staying on the search RPC"
+                    )
+                    return
+                if len(data) < _PAGE_SIZE:
+                    break
+                offset += _PAGE_SIZE
+        except Exception as e:
+            logger.error(f"Catalog index load failed for shop={shop_id}: {e}")
+            return
+
+        self._oversized.pop(shop_id, None)
+        index = _ShopIndex(rows, vectors)
+        for change in self._buffered.pop(shop_id, []):
+            self._apply(index, change)
+        self._shops[shop_id] = index
+        logger.info(
+            f"Catalog index: loaded {len(rows)} rows for shop={shop_id} "
+            f"in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+
+    def _on_change(self, change: CatalogChange) -> None:
+        if not self.enabled:
+            return
+        if change.shop_id in self._loading:
+            # The load may have read this row before the change; replay it after
+            self._buffered.setdefault(change.shop_id, []).append(change)
+        index = self._shops.get(change.shop_id)
+        if index is None:
+            return  # not loaded — the next load reads the current rows
+        self._apply(index, change)
+        # Re-account the shop's size against the LRU bound
+        self._shops[change.shop_id] = index
+
+    @staticmethod
+    def _apply(index: _ShopIndex, change: CatalogChange) -> None:
+        if change.op == "delete" or not change.row:
+            index.remove(change.product_id)
+        elif change.embedding:
+            vector = _parse_vector(change.embedding)
+            if vector is not None and vector.shape == (_DIMENSIONS,):
+                row = {k: change.row.get(k) for k in ("id", "name", "price", "description", "image_url", "attributes")}
+                row["id"] = change.product_id
+                index.upsert(row, vector)
+        else:
+            # Row edited without a new vector: refresh the fields, keep the vector
+            index.update_fields(change.product_id, change.row)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "shops": len(self._shops),
+            "vectors": self._shops.currsize,
+            "hits": self.hits,
+            "fallbacks": self.fallbacks,
+        }
+
+
+catalog_index = CatalogIndex()
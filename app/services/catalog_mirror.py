@@ -0,0 +1,288 @@
+"""In-process mirror of each active shop's product rows.
+
+prepare_order validated every draft with a products query, the legacy
+search path re-read variant rows by name, and the catalog digest loaded the
+shop on its own — the same few hundred rows read thousands of times an
+hour. CatalogMirror keeps them in memory per shop:
+
+  - rows by id, and ids by variant group (the same md5(shop:name) key
+    products.variant_group_id uses), plus a BM25 keyword index over them;
+  - lazy: a shop is loaded (paged, in the background) the first time it is
+    asked for; until then callers get None and query the DB as before;
+  - fed by catalog_events (product webhook INSERT / UPDATE / DELETE);
+  - reconciled every CATALOG_MIRROR_RECONCILE_SECONDS: one catalog_checksum
+    RPC for all loaded shops, and only shops whose checksum moved since
+    their last load are reloaded (a shop that took webhook edits reloads
+    once; an untouched catalog is never re-read). Without the RPC
+    (migration not run) shops are simply reloaded on that interval.
+  - bounded: least-recently-used shops are dropped once the total exceeds
+    CATALOG_MIRROR_MAX_ROWS.
+
+Readers get plain dicts and must not mutate them.
+"""
+
+import asyncio
+import hashlib
+import itertools
+import time
+import uuid
+
+from cachetools import LRUCache
+
+from app.core.config import settings
+from app.core.dependencies import get_supabase
+from app.core.logging_config import get_logger
+from app.services import catalog_events
+from app.services.catalog_events import CatalogChange
+from app.services.lexical_index import Bm25Index, document_tokens, tokenize
+
+logger = get_logger(__name__)
+
+_ROW_COLUMNS = ("id", "name", "price", "description", "image_url", "attributes")
+_PAGE_SIZE = 1000
+# Versions come from one process-wide counter: a reloaded shop never reuses
+# a version its previous mirror had, so readers' caches can't go stale.
+_versions = itertools.count(1)
+
+
+def variant_group_id(shop_id: str, name: str) -> str:
+    """Same key as the products_set_variant_group_id trigger."""
+    digest = hashlib.md5(f"{shop_id}:{(name or '').strip(' ').lower()}".encode()).hexdigest()
+    return str(uuid.UUID(digest))
+
+
+class ShopMirror:
+    """One shop's product rows with id / variant-group / keyword lookups."""
+
+    def __init__(self, shop_id: str, rows: list[dict], checksum: str | None) -> None:
+        self.shop_id = shop_id
+        self.rows: dict[str, dict] = {}
+        self.groups: dict[str, set[str]] = {}
+        self.lexical = Bm25Index()
+        # Changes on every change or reload — lets readers cache derived data (digest)
+        self.version = next(_versions)
+        self.checksum = checksum
+        self.loaded_at = time.monotonic()
+        for row in rows:
+            self.upsert(row)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def product_count(self) -> int:
+        return len(self.groups)
+
+    def upsert(self, row: dict) -> None:
+        self.remove(row["id"])
+        group = variant_group_id(self.shop_id, row["name"])
+        self.rows[row["id"]] = {**row, "variant_group_id": group}
+        self.groups.setdefault(group, set()).add(row["id"])
+        self.lexical.add(row["id"], document_tokens(row))
+        self.version = next(_versions)
+
+    def remove(self, product_id: str) -> None:
+        row = self.rows.pop(product_id, None)
+        if row is None:
+            return
+        members = self.groups.get(row["variant_group_id"])
+        if members is not None:
+            members.discard(product_id)
+            if not members:
+                del self.groups[row["variant_group_id"]]
+        self.lexical.remove(product_id)
+        self.version = next(_versions)
+
+    def family(self, name: str) -> list[dict]:
+        """Every variant row of the product called `name`."""
+        ids = self.groups.get(variant_group_id(self.shop_id, name)) or ()
+        return sorted((self.rows[i] for i in ids), key=lambda r: r["id"])
+
+    def rows_named(self, names: list[str]) -> list[dict]:
+        """Variant rows of several products, labelled with the given names."""
+        return [{**row, "name": name} for name in names for row in self.family(name)]
+
+    def search_lexical(self, query_text: str, match_count: int) -> tuple[list[str], list[dict]]:
+        """BM25-only (names best first, their variant rows)."""
+        scores = self.lexical.score(tokenize(query_text))
+        names: list[str] = []
+        for doc_id in sorted(scores, key=scores.__getitem__, reverse=True):
+            name = self.rows[doc_id]["name"]
+            if name not in names:
+                names.append(name)
+                if len(names) >= match_count:
+                    break
+        return names, self.rows_named(names)
+
+
+class CatalogMirror:
+    """Per-shop row mirrors with lazy loading and checksum reconcile."""
+
+    def __init__(self) -> None:
+        self._shops: LRUCache = LRUCache(maxsize=settings.catalog_mirror_max_rows, getsizeof=lambda m: max(len(m), 1))
+        self._loading: dict[str, asyncio.Task] = {}
+        # shop_id -> monotonic time it was found too big (re-checked on reconcile)
+        self._oversized: dict[str, float] = {}
+        self._task: asyncio.Task | None = None
+        # Flipped off (with a warning) if the catalog_checksum RPC is missing
+        self._checksum_supported = True
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        catalog_events.subscribe(self._on_change)
+
+    @property
+    def enabled(self) -> bool:
+        return settings.catalog_mirror_enabled
+
+    def get(self, shop_id: str) -> ShopMirror | None:
+        """The shop's mirror, or None (loading / too big / disabled)."""
+        if not self.enabled:
+            return None
+        mirror = self._shops.get(shop_id)
+        if mirror is None:
+            self.misses += 1
+            self._schedule_load(shop_id)
+            return None
+        self.hits += 1
+        return mirror
+
+    def lookup(self, shop_id: str, product_ids: list[str]) -> dict[str, dict] | None:
+        """id -> row for the ids the mirror holds, or None if the shop isn't loaded."""
+        mirror = self.get(shop_id)
+        if mirror is None:
+            return None
+        return {pid: mirror.rows[pid] for pid in product_ids if pid in mirror.rows}
+
+    def _schedule_load(self, shop_id: str) -> None:
+        if shop_id in self._loading:
+            return
+        flagged = self._oversized.get(shop_id)
+        if flagged is not None and time.monotonic() - flagged < settings.catalog_mirror_reconcile_seconds:
+            return
+        task = asyncio.create_task(self._load(shop_id))
+        self._loading[shop_id] = task
+        task.add_done_callback(lambda t, s=shop_id: self._loading.pop(s, None))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._reconcile_loop())
+
+    async def _load(self, shop_id: str, checksum: str | None = None) -> None:
+        started = time.perf_counter()
+        supabase = await get_supabase()
+        rows: list[dict] = []
+        offset = 0
+        try:
+            if checksum is None:
+                # Taken BEFORE the rows: a write in between makes the next
+                # reconcile see a moved checksum and reload, never miss it.
+                checksum = (await self._checksums([shop_id])).get(shop_id)
+            while True:
+                page = await supabase.table("products") \
+                    .select(", ".join(_ROW_COLUMNS)) \
+                    .eq("shop_id", shop_id) \
+                    .order("id") \
+                    .range(offset, offset + _PAGE_SIZE - 1) \
+                    .execute()
+                data = page.data or []
+                rows.extend(data)
+                if len(rows) > settings.catalog_mirror_max_shop_rows:
+                    self._oversized[shop_id] = time.monotonic()
+                    self._shops.pop(shop_id, None)
+                    logger.info(
+                        f"Catalog mirror: shop={shop_id} has >{settings.catalog_mirror_max_shop_rows} "
+                        "rows — reading products from the DB"
+                    )
+                    return
+                if len(data) < _PAGE_SIZE:
+                    break
+                offset += _PAGE_SIZE
+        except Exception as e:
+            logger.error(f"Catalog mirror load failed for shop={shop_id}: {e}")
+            return
+
+        self._oversized.pop(shop_id, None)
+        self._shops[shop_id] = ShopMirror(shop_id, rows, checksum)
+        logger.info(
+            f"Catalog mirror: loaded {len(rows)} rows for shop={shop_id} "
+            f"in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+
+    def _on_change(self, change: CatalogChange) -> None:
+        if not self.enabled:
+            return
+        mirror = self._shops.get(change.shop_id)
+        if mirror is None:
+            return  # not loaded — the next load reads the current rows
+        if change.op == "delete" or not change.row:
+            mirror.remove(change.product_id)
+        else:
+            row = {k: change.row.get(k) for k in _ROW_COLUMNS}
+            row["id"] = change.product_id
+            mirror.upsert(row)
+        # Re-account the shop's size against the LRU bound
+        self._shops[change.shop_id] = mirror
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.catalog_mirror_reconcile_seconds)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Catalog mirror reconcile failed: {e}")
+
+    async def reconcile(self) -> None:
+        """Reload every loaded shop whose catalog changed behind our back."""
+        shop_ids = list(self._shops.keys())
+        if not shop_ids:
+            return
+        if not self._checksum_supported:
+            for shop_id in shop_ids:
+                self.reloads += 1
+                await self._load(shop_id)
+            return
+
+        checksums = await self._checksums(shop_ids)
+        for shop_id in shop_ids:
+            checksum = checksums.get(shop_id)  # absent: the shop has no rows left
+            mirror = self._shops.get(shop_id)
+            if mirror is None or checksum == mirror.checksum:
+                continue
+            self.reloads += 1
+            await self._load(shop_id, checksum)
+
+    async def _checksums(self, shop_ids: list[str]) -> dict[str, str]:
+        """shop_id -> catalog checksum ({} once the RPC is known missing)."""
+        if not self._checksum_supported:
+            return {}
+        supabase = await get_supabase()
+        try:
+            result = await supabase.rpc("catalog_checksum", {"p_shop_ids": shop_ids}).execute()
+        except Exception as e:
+            if "catalog_checksum" not in str(e):
+                raise
+            self._checksum_supported = False
+            logger.warning(
+                f"catalog_checksum RPC unavailable ({e}) — run the 20261019_catalog_checksum.sql "
+                "migration. Mirrors are now fully reloaded every reconcile interval."
+            )
+            return {}
+        return {row["shop_id"]: row.get("checksum") for row in result.data or []}
+
+    async def shutdown(self) -> None:
+        """Stop the reconcile loop. Called during app shutdown."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "shops": len(self._shops),
+            "rows": self._shops.currsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+        }
+
+
+catalog_mirror = CatalogMirror()
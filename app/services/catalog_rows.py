@@ -0,0 +1,81 @@
+"""Product rows → the shapes search results are built from.
+
+Shared by every search path (RPC, in-process index) and by the lexical
+index, which tokenizes exactly the attributes the agent is shown.
+"""
+
+import json
+
+# Attribute schemas differ per store (clothing has size/stock/fabric, another
+# shop may have voltage/warranty/flavor) — so pass EVERY key to the agent and
+# only bound the size: values truncated, at most _MAX_ATTR_KEYS keys.
+_MAX_ATTR_VALUE_CHARS = 80
+_MAX_ATTR_KEYS = 16
+
+
+def compact_attributes(attrs) -> dict:
+    """Bound a product's attributes JSON for the agent without assuming a schema."""
+    if not isinstance(attrs, dict):
+        return {}
+    out = {}
+    for key, value in attrs.items():
+        if value is None or value == "":
+            continue
+        if key == "additional_images":
+            continue  # exposed at product level as more_image_urls (untruncated)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        if isinstance(value, str) and key != "product_url" and len(value) > _MAX_ATTR_VALUE_CHARS:
+            value = value[:_MAX_ATTR_VALUE_CHARS] + "…"
+        out[str(key)] = value
+        if len(out) >= _MAX_ATTR_KEYS:
+            break
+    return out
+
+
+def extra_images(attrs) -> list[str]:
+    """Extra gallery URLs from attributes.additional_images, if the store has them."""
+    if not isinstance(attrs, dict):
+        return []
+    raw = attrs.get("additional_images")
+    if isinstance(raw, str):
+        raw = [u.strip() for u in raw.replace(",", " ").split() if u.strip()]
+    if not isinstance(raw, list):
+        return []
+    return [u for u in raw if isinstance(u, str) and u.startswith("http")][:3]
+
+
+def group_variants(names: list[str], rows: list[dict]) -> list[dict]:
+    """Group variant rows into one product per NAME, in `names` order."""
+    grouped: dict[str, dict] = {}
+    for row in rows:
+        name = row["name"]
+        group = grouped.setdefault(name, {
+            "name": name,
+            "price": row.get("price"),
+            "description": row.get("description", ""),
+            "image_url": row.get("image_url") or "",
+            "more_image_urls": [],
+            "all_image_urls": [],
+            "variants": [],
+        })
+        if row.get("image_url"):
+            if not group["image_url"]:
+                group["image_url"] = row["image_url"]
+            if row["image_url"] not in group["all_image_urls"]:
+                group["all_image_urls"].append(row["image_url"])
+        # Gallery images from attributes — usable with send_product_image
+        if not group["more_image_urls"]:
+            extra = extra_images(row.get("attributes"))
+            group["more_image_urls"] = extra
+            group["all_image_urls"].extend(u for u in extra if u not in group["all_image_urls"])
+
+        if len(group["variants"]) >= 12:
+            continue  # runaway safety — no real product has more sizes
+        variant = {"product_id": row["id"], **compact_attributes(row.get("attributes"))}
+        if row.get("price") is not None and row["price"] != group["price"]:
+            variant["price"] = row["price"]
+        group["variants"].append(variant)
+
+    # Preserve best-match order
+    return [grouped[n] for n in names if n in grouped]
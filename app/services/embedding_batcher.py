@@ -0,0 +1,92 @@
+"""Micro-batching of query embeddings.
+
+When the model asks for several searches in one turn ("red polo and black
+pant"), _execute_tool runs them concurrently and each used to make its own
+embed_content request. EmbeddingBatcher collects the texts requested within
+EMBEDDING_BATCH_WINDOW_MS (or until EMBEDDING_BATCH_MAX_TEXTS are waiting)
+and sends them as ONE multi-content embed_content call — one round trip and
+one quota unit per turn instead of N. Identical texts in a window are
+embedded once.
+
+A failed batch resolves every waiter with [] (logged), the same contract as
+RagService.get_text_embedding: search degrades to "no results", never raises.
+"""
+
+import asyncio
+
+from google.genai import types
+
+from app.core.dependencies import genai_client
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class EmbeddingBatcher:
+
+    def __init__(self, model: str, dimensions: int, *, window_ms: float, max_texts: int) -> None:
+        self._model = model
+        self._dimensions = dimensions
+        self._window = window_ms / 1000
+        self._max_texts = max(1, max_texts)
+        # text -> future shared by every caller asking for it in this window
+        self._pending: dict[str, asyncio.Future] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._inflight: set[asyncio.Task] = set()  # strong refs until done
+        self.batches = 0
+        self.texts = 0
+        self.requests = 0
+
+    async def embed(self, text: str) -> list[float]:
+        """Embedding for text (truncated to 2000 chars), batched with its neighbours."""
+        text = text[:2000]
+        self.requests += 1
+        future = self._pending.get(text)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[text] = future
+            if len(self._pending) >= self._max_texts:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self._window, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.create_task(self._embed_batch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _embed_batch(self, batch: dict[str, asyncio.Future]) -> None:
+        texts = list(batch)
+        self.batches += 1
+        self.texts += len(texts)
+        try:
+            result = await genai_client.aio.models.embed_content(
+                model=self._model,
+                contents=texts,
+                config=types.EmbedContentConfig(output_dimensionality=self._dimensions),
+            )
+            vectors = [e.values for e in result.embeddings]
+            if len(vectors) != len(texts):
+                raise ValueError(f"expected {len(texts)} embeddings, got {len(vectors)}")
+        except Exception as e:
+            logger.error(f"Embedding generation error ({len(texts)} text(s)): {repr(e)}")
+            vectors = [[] for _ in texts]
+        if len(texts) > 1:
+            logger.debug(f"Embedded {len(texts)} queries in one request")
+        for future, vector in zip(batch.values(), vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "texts": self.texts,
+            "batches": self.batches,
+            "texts_per_batch": round(self.texts / self.batches, 2) if self.batches else 0.0,
+        }
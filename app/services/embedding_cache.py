@@ -0,0 +1,139 @@
+"""Query-text → embedding cache for catalog search.
+
+Customers and the model repeat the same searches constantly ("polo shirt",
+"black panjabi", a product name re-searched to get its product_ids); each
+used to cost a Gemini embed_content round trip.
+
+  - Keys are normalize_query() output plus the embedding model/dims, so
+    "Black  Punjabi" and "black panjabi" share an entry and a model change
+    never serves a stale vector.
+  - Values are array('f') (float32, ~3 KB at 768 dims) in an LRU bounded by
+    BYTES (QUERY_EMBEDDING_CACHE_MB), not entry count.
+  - Optional persistence (QUERY_EMBEDDING_CACHE_PATH): a local SQLite file
+    written through on every new embedding and read on a memory miss, so a
+    restart doesn't start cold. Synchronous like the state store — single-row
+    primary-key operations on local disk. Bounded too: rows older than
+    QUERY_EMBEDDING_CACHE_DISK_DAYS, and the oldest beyond
+    QUERY_EMBEDDING_CACHE_DISK_ROWS, are pruned at most every few minutes.
+  - Counters: hits, disk_hits, misses, hit_rate, bytes, entries.
+"""
+
+import sqlite3
+import threading
+import time
+from array import array
+
+from cachetools import LRUCache
+
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+# Per-entry bookkeeping on top of the raw float32 payload (key, array header).
+_ENTRY_OVERHEAD_BYTES = 200
+
+# The disk table is pruned at most this often (per process).
+_PURGE_INTERVAL_SECONDS = 600.0
+
+
+def _entry_size(value: array) -> int:
+    return len(value) * value.itemsize + _ENTRY_OVERHEAD_BYTES
+
+
+class EmbeddingCache:
+    """Byte-bounded LRU of embeddings with optional SQLite write-through."""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        path: str | None = None,
+        *,
+        max_disk_rows: int = 200000,
+        max_disk_age: float = 30 * 86400,
+    ) -> None:
+        self._max_disk_rows = max_disk_rows
+        self._max_disk_age = max_disk_age
+        self._last_purge = 0.0
+        self._lru: LRUCache = LRUCache(maxsize=max(max_bytes, 1), getsizeof=_entry_size)
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        if path:
+            try:
+                self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                    " key TEXT PRIMARY KEY,"
+                    " vec BLOB NOT NULL,"
+                    " created_at REAL NOT NULL"
+                    ") WITHOUT ROWID"
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS query_embeddings_created ON query_embeddings (created_at)"
+                )
+                logger.info(f"Query-embedding cache persisted at {path}")
+            except sqlite3.Error as e:
+                logger.warning(f"Query-embedding cache file {path} unusable ({e}) — memory only")
+                self._conn = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> list[float] | None:
+        value = self._lru.get(key)
+        if value is not None:
+            self.hits += 1
+            return value.tolist()
+        if self._conn is not None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT vec FROM query_embeddings WHERE key = ?", (key,)
+                ).fetchone()
+            if row is not None:
+                value = array("f")
+                value.frombytes(row[0])
+                self._lru[key] = value
+                self.disk_hits += 1
+                return value.tolist()
+        self.misses += 1
+        return None
+
+    def set(self, key: str, embedding: list[float]) -> None:
+        value = array("f", embedding)
+        self._lru[key] = value
+        if self._conn is not None:
+            now = time.time()
+            try:
+                with self._lock:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO query_embeddings (key, vec, created_at) VALUES (?, ?, ?)",
+                        (key, value.tobytes(), now),
+                    )
+                    self._maybe_purge(now)
+            except sqlite3.Error as e:
+                logger.debug(f"Query-embedding cache write failed: {e}")
+
+    def _maybe_purge(self, now: float) -> None:
+        """Drop expired rows, then the oldest over the row bound — called under self._lock."""
+        if now - self._last_purge < _PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        self._conn.execute("DELETE FROM query_embeddings WHERE created_at <= ?", (now - self._max_disk_age,))
+        self._conn.execute(
+            "DELETE FROM query_embeddings WHERE created_at <= ("
+            " SELECT created_at FROM query_embeddings ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+            (self._max_disk_rows,),
+        )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "entries": len(self._lru),
+            "bytes": self._lru.currsize,
+            "max_bytes": self._lru.maxsize,
+        }
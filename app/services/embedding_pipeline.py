@@ -0,0 +1,572 @@
+"""Batched product (catalog) embedding — webhook inserts and bulk imports.
+
+The product webhook used to embed each product on its own: a fresh
+httpx.AsyncClient per image, one embed_content call and one UPDATE per row.
+A merchant importing 3,000 products fired 3,000 of those at once. Every
+product embedding now goes through EmbeddingPipeline:
+
+  - one pooled image client (keep-alive per image host), at most
+    EMBEDDING_IMAGE_CONCURRENCY downloads in flight; images are downscaled
+    to IMAGE_MAX_DIMENSION (one tile) before they are inlined;
+  - products are embedded EMBEDDING_BULK_BATCH_SIZE at a time in ONE
+    multi-content embed_content call (text + image per product), with at
+    most EMBEDDING_BULK_WORKERS calls in flight;
+  - a batch is written back with ONE bulk_update_product_embeddings RPC
+    (per-row UPDATEs until that migration is applied);
+  - webhook products arriving within EMBEDDING_COALESCE_WINDOW_MS share a
+    batch, so an import through the webhook coalesces instead of fanning out;
+  - bulk jobs (POST /internal/embeddings/bulk) embed a list of products or
+    a whole shop and report progress and throughput while they run;
+  - unchanged products are skipped: each embedding is stored with a hash of
+    what went into it (model, text, image URL + ETag/Last-Modified from a
+    HEAD request). A product whose hash matches its stored one keeps its
+    vector — a price or stock edit costs one HEAD, not an embed call and
+    an image download. Stock/price/quantity attributes are not part of the
+    embedded text, so those edits never change the hash.
+
+Embed requests pass a token bucket (EMBEDDING_REQUESTS_PER_MINUTE) so an
+import queues behind the quota instead of tripping it. A product whose
+embedding fails is marked embedding_status='failed' — except for callers
+that retry (the durable embedding_queue), which mark it only once they give
+up. Nothing here raises into the webhook.
+"""
+
+import asyncio
+import hashlib
+import time
+import uuid
+from dataclasses import dataclass, field
+
+import httpx
+from cachetools import TTLCache
+from google.genai import types
+
+from app.core.config import settings
+from app.core.dependencies import genai_client, get_supabase
+from app.core.logging_config import get_logger
+from app.core.task_supervisor import task_supervisor
+from app.services import catalog_events
+from app.services.catalog_events import CatalogChange
+from app.services.embedding_queue import embedding_queue
+from app.services.image_service import downscale_image
+
+logger = get_logger(__name__)
+
+EMBEDDING_MODEL = "gemini-embedding-2"
+EMBEDDING_DIMENSIONS = 768
+
+_PRODUCT_COLUMNS = "id, shop_id, name, price, description, attributes, image_url"
+_PAGE_SIZE = 1000
+# Attributes that change with every sale/price edit and say nothing about
+# what the product is — left out of the embedded text (and so the hash).
+_VOLATILE_ATTRIBUTES = {"stock", "price", "quantity", "sale_price", "compare_at_price"}
+# An image that couldn't be downscaled (undecodable format) and is bigger
+# than this is left out rather than inlined into a multi-product request.
+_MAX_INLINE_IMAGE_BYTES = 1024 * 1024
+# _write's error for a row that matched no product (deleted meanwhile)
+_DELETED = "product no longer exists"
+
+# Pooled across all product images; images come from a handful of CDNs
+_image_client = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    follow_redirects=True,
+)
+
+task_supervisor.configure("embedding_bulk", limit=2, max_queue=20)
+
+
+def product_text(product: dict) -> str:
+    """Text half of a product's embedding: name | description | attributes."""
+    text_parts = [product["name"]]
+    if product.get("description"):
+        text_parts.append(product["description"])
+    attributes = product.get("attributes")
+    if attributes:
+        if isinstance(attributes, dict):
+            attr_text = ", ".join(
+                f"{k}: {v}" for k, v in attributes.items() if str(k).lower() not in _VOLATILE_ATTRIBUTES
+            )
+        elif isinstance(attributes, list):
+            attr_text = ", ".join(str(a) for a in attributes)
+        else:
+            attr_text = str(attributes)
+        if attr_text:
+            text_parts.append(attr_text)
+    return " | ".join(text_parts)[:2000]
+
+
+class TokenBucket:
+    """`per_minute` tokens a minute, up to `burst` saved; waiters go in turn."""
+
+    def __init__(self, per_minute: float, burst: int) -> None:
+        self._rate = per_minute / 60
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self) -> None:
+        if self._rate <= 0:
+            return  # unlimited
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+                self.waited += wait
+                await asyncio.sleep(wait)
+
+
+async def _no_version() -> str:
+    return ""
+
+
+def content_hash(text: str, image_url: str | None, image_version: str) -> str:
+    """Stable hash of everything an embedding is computed from."""
+    source = "\n".join((EMBEDDING_MODEL, str(EMBEDDING_DIMENSIONS), text, image_url or "", image_version))
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class BulkJob:
+    """Progress of one bulk embedding run."""
+    id: str
+    shop_id: str
+    status: str = "queued"          # queued | running | completed | failed | enqueued
+    total: int = 0
+    embedded: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+    failed: int = 0
+    batches: int = 0
+    error: str | None = None
+    # Products handed to the embedding queue — progress is read from it
+    queued_ids: list[str] = field(default_factory=list, repr=False)
+    started_at: float | None = None
+    finished_at: float | None = None
+    created_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        processed = self.embedded + self.unchanged + self.deleted + self.failed
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - processed
+        return {
+            "job_id": self.id,
+            "shop_id": self.shop_id,
+            "status": self.status,
+            "total": self.total,
+            "embedded": self.embedded,
+            "unchanged": self.unchanged,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "batches": self.batches,
+            "progress": round(processed / self.total, 3) if self.total else (1.0 if self.finished_at else 0.0),
+            "elapsed_seconds": round(elapsed, 1),
+            "products_per_minute": round(rate * 60, 1),
+            "eta_seconds": (
+                round(remaining / rate) if rate > 0 and self.status in ("running", "enqueued") else None
+            ),
+            "error": self.error,
+        }
+
+
+class EmbeddingPipeline:
+
+    def __init__(self) -> None:
+        self._image_slots = asyncio.Semaphore(max(1, settings.embedding_image_concurrency))
+        self._embed_slots = asyncio.Semaphore(max(1, settings.embedding_bulk_workers))
+        # Webhook products waiting to share a batch: (product, future)
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._inflight: set[asyncio.Task] = set()  # strong refs until done
+        self._jobs: TTLCache = TTLCache(maxsize=200, ttl=86400)
+        self._quota = TokenBucket(settings.embedding_requests_per_minute, burst=settings.embedding_bulk_workers)
+        # Flipped off (with a warning) if the bulk RPC / hash column is missing
+        self._bulk_supported = True
+        self._hash_supported = True
+        self.products = 0
+        self.unchanged = 0
+        self.head_requests = 0
+        self.failures = 0
+        self.requests = 0
+        self.images = 0
+
+    # ── Single products (webhook) ────────────────────────────────────
+
+    async def embed_product(self, product: dict) -> str:
+        """Embed and store one product, batched with its neighbours.
+
+        Returns "embedded", "unchanged", "deleted" or "failed" (see process_batch).
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((product, future))
+        if len(self._pending) >= settings.embedding_bulk_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                settings.embedding_coalesce_window_ms / 1000, self._flush,
+            )
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run_pending(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    def discard(self, product_id: str) -> None:
+        """Drop a deleted product still waiting for its batch."""
+        kept = []
+        for product, future in self._pending:
+            if product["id"] != product_id:
+                kept.append((product, future))
+            elif not future.done():
+                future.set_result("deleted")
+        self._pending = kept
+
+    async def _run_pending(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        try:
+            outcomes, _ = await self.process_batch([product for product, _ in batch])
+        except Exception as e:
+            logger.error(f"Product embedding batch failed: {e}", exc_info=True)
+            outcomes = ["failed"] * len(batch)
+        for (_, future), outcome in zip(batch, outcomes):
+            if not future.done():
+                future.set_result(outcome)
+
+    # ── Batches ──────────────────────────────────────────────────────
+
+    async def _image_version(self, url: str) -> str:
+        """ETag / Last-Modified of an image from a HEAD request ("" if none)."""
+        async with self._image_slots:
+            self.head_requests += 1
+            try:
+                response = await _image_client.head(url)
+                response.raise_for_status()
+            except Exception:
+                return ""  # hash falls back to the URL alone
+        return response.headers.get("etag") or response.headers.get("last-modified") or ""
+
+    async def _stored_hashes(self, products: list[dict]) -> dict[str, str]:
+        """id -> embedding_hash of products whose embedding is completed."""
+        if not self._hash_supported:
+            return {}
+        supabase = await get_supabase()
+        try:
+            result = await supabase.table("products") \
+                .select("id, embedding_hash, embedding_status") \
+                .in_("id", [p["id"] for p in products]) \
+                .execute()
+        except Exception as e:
+            if "embedding_hash" not in str(e):
+                logger.error(f"Reading embedding hashes failed: {e}")
+                return {}
+            self._hash_supported = False
+            logger.warning(
+                f"products.embedding_hash unavailable ({e}) — run the 20261019_embedding_hash.sql "
+                "migration. Every product event is re-embedded."
+            )
+            return {}
+        return {
+            row["id"]: row["embedding_hash"] for row in result.data or []
+            if row.get("embedding_hash") and row.get("embedding_status") == "completed"
+        }
+
+    async def _fetch_image(self, url: str, product_id: str) -> tuple[bytes, str] | None:
+        async with self._image_slots:
+            try:
+                response = await _image_client.get(url)
+                response.raise_for_status()
+            except Exception as e:
+                logger.warning(f"[{product_id}] Failed to fetch image, falling back to text-only: {e}")
+                return None
+        self.images += 1
+        mime_type = response.headers.get("content-type", "image/jpeg").split(";")[0].strip()
+        # Up to a batch of these go inline in one request — one tile each
+        image_bytes, mime_type = await asyncio.to_thread(downscale_image, response.content, mime_type)
+        if len(image_bytes) > _MAX_INLINE_IMAGE_BYTES:
+            logger.warning(
+                f"[{product_id}] Image still {len(image_bytes) // 1024}KB after downscaling, "
+                "falling back to text-only"
+            )
+            return None
+        return image_bytes, mime_type
+
+    async def _contents(self, product: dict, text: str) -> types.Content:
+        parts = [types.Part.from_text(text=text)]
+        if product.get("image_url"):
+            image = await self._fetch_image(product["image_url"], product["id"])
+            if image is not None:
+                parts.append(types.Part(inline_data=types.Blob(mime_type=image[1], data=image[0])))
+        return types.Content(parts=parts)
+
+    async def _embed(self, products: list[dict], texts: list[str]) -> tuple[list[list[float] | None], str | None]:
+        """One multi-content request; a vector (or None) per product, and the request's error."""
+        contents = await asyncio.gather(*(self._contents(p, t) for p, t in zip(products, texts)))
+        async with self._embed_slots:
+            await self._quota.acquire()
+            self.requests += 1
+            try:
+                result = await genai_client.aio.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=list(contents),
+                    config=types.EmbedContentConfig(output_dimensionality=EMBEDDING_DIMENSIONS),
+                )
+                vectors = [e.values for e in result.embeddings]
+                if len(vectors) != len(products):
+                    raise ValueError(f"expected {len(products)} embeddings, got {len(vectors)}")
+            except Exception as e:
+                logger.error(f"Embedding generation failed for {len(products)} product(s): {e}")
+                return [None] * len(products), str(e)[:500]
+        return [v if v is not None and len(v) == EMBEDDING_DIMENSIONS else None for v in vectors], None
+
+    async def process_batch(
+        self, products: list[dict], *, mark_failed: bool = True,
+    ) -> tuple[list[str], dict[str, str]]:
+        """Embed products, store the vectors (or 'failed'), publish the changes.
+
+        Returns one outcome per product — "embedded", "unchanged" (content
+        hash matches the stored embedding's), "deleted" (the row is gone) or
+        "failed" (embed call or vector write failed; only stored vectors are
+        published) — and the
+        error of each failed product by id. Callers that retry pass
+        mark_failed=False and call mark_failed() when they give up.
+        """
+        texts = [product_text(p) for p in products]
+        stored = await self._stored_hashes(products)
+        # Validators are needed for new products too: the hash stored with
+        # their first embedding is what the next event compares against.
+        versions = await asyncio.gather(*(
+            self._image_version(p["image_url"]) if p.get("image_url") and self._hash_supported
+            else _no_version()
+            for p in products
+        ))
+        hashes = [
+            content_hash(text, p.get("image_url"), version)
+            for p, text, version in zip(products, texts, versions)
+        ]
+
+        todo = [i for i, p in enumerate(products) if stored.get(p["id"]) != hashes[i]]
+        outcomes = ["unchanged"] * len(products)
+        errors: dict[str, str] = {}
+        if todo:
+            vectors, embed_error = await self._embed([products[i] for i in todo], [texts[i] for i in todo])
+            write_errors = await self._store(
+                [products[i] for i in todo], vectors, [hashes[i] for i in todo], mark_failed=mark_failed,
+            )
+            for i, vector in zip(todo, vectors):
+                product_id = products[i]["id"]
+                if vector is None:
+                    outcomes[i] = "failed"
+                    errors[product_id] = embed_error or "no valid embedding returned"
+                    continue
+                if write_errors.get(product_id) == _DELETED:
+                    # Publishing would put the deleted product back in the indexes
+                    outcomes[i] = "deleted"
+                    continue
+                if product_id in write_errors:
+                    # Not stored: nothing to publish, the DB still has the old vector
+                    outcomes[i] = "failed"
+                    errors[product_id] = write_errors[product_id]
+                    continue
+                outcomes[i] = "embedded"
+                # In-memory catalog structures pick up the new row + vector
+                await catalog_events.publish(CatalogChange(
+                    shop_id=products[i]["shop_id"],
+                    product_id=products[i]["id"],
+                    op="upsert",
+                    row=products[i],
+                    embedding=list(vector),
+                ))
+        self.products += outcomes.count("embedded")
+        self.unchanged += outcomes.count("unchanged")
+        self.failures += outcomes.count("failed")
+        return outcomes, errors
+
+    async def mark_failed(self, product_ids: list[str]) -> None:
+        """Set embedding_status='failed' (the vector, if any, is kept)."""
+        await self._write([
+            {"id": pid, "embedding": None, "embedding_status": "failed", "embedding_hash": None}
+            for pid in product_ids
+        ])
+
+    async def _store(
+        self, products: list[dict], vectors: list[list[float] | None], hashes: list[str],
+        *, mark_failed: bool = True,
+    ) -> dict[str, str]:
+        """Write vectors (and 'failed' rows if mark_failed); returns errors by id of rows not written."""
+        rows = [
+            {"id": p["id"], "embedding": list(v), "embedding_status": "completed", "embedding_hash": h}
+            if v is not None
+            else {"id": p["id"], "embedding": None, "embedding_status": "failed", "embedding_hash": None}
+            for p, v, h in zip(products, vectors, hashes)
+            if v is not None or mark_failed
+        ]
+        if not rows:
+            return {}
+        return await self._write(rows)
+
+    async def _write(self, rows: list[dict]) -> dict[str, str]:
+        """Store rows in one RPC (or row by row); returns errors by id of rows not written.
+
+        A row whose product is gone gets the _DELETED error.
+        """
+        supabase = await get_supabase()
+        if self._bulk_supported:
+            try:
+                result = await supabase.rpc("bulk_update_product_embeddings", {"p_rows": rows}).execute()
+            except Exception as e:
+                if "bulk_update_product_embeddings" not in str(e):
+                    logger.error(f"Bulk embedding write failed ({len(rows)} rows): {e}")
+                    return {row["id"]: f"embedding write failed: {e}"[:500] for row in rows}
+                self._bulk_supported = False
+                logger.warning(
+                    f"bulk_update_product_embeddings unavailable ({e}) — run the "
+                    "20261019_bulk_product_embeddings.sql migration. Writing embeddings row by row."
+                )
+            else:
+                if not isinstance(result.data, list):
+                    return {}  # pre-20261020 function: a row count, ids unknown
+                updated = {str(next(iter(r.values()))) if isinstance(r, dict) else str(r) for r in result.data}
+                return {row["id"]: _DELETED for row in rows if row["id"] not in updated}
+
+        async def update(row: dict) -> str | None:
+            """None once written, else the error."""
+            values = {"embedding_status": row["embedding_status"]}
+            if row["embedding"] is not None:
+                values["embedding"] = row["embedding"]
+                if self._hash_supported:
+                    values["embedding_hash"] = row["embedding_hash"]
+            try:
+                result = await supabase.table("products").update(values).eq("id", row["id"]).execute()
+            except Exception as e:
+                logger.error(f"[{row['id']}] Failed to store embedding ({row['embedding_status']}): {e}")
+                return f"embedding write failed: {e}"[:500]
+            return _DELETED if result.data == [] else None
+
+        results = await asyncio.gather(*(update(row) for row in rows))
+        return {row["id"]: error for row, error in zip(rows, results) if error is not None}
+
+    # ── Bulk jobs ────────────────────────────────────────────────────
+
+    def start_job(self, shop_id: str, product_ids: list[str] | None, only_missing: bool) -> BulkJob | None:
+        """Queue a bulk run; None if too many are already queued."""
+        job = BulkJob(id=uuid.uuid4().hex[:12], shop_id=shop_id)
+        if not task_supervisor.spawn("embedding_bulk", self._run_job(job, product_ids, only_missing)):
+            return None
+        self._jobs[job.id] = job
+        return job
+
+    async def job(self, job_id: str) -> BulkJob | None:
+        """A bulk job, its counts refreshed from the queue while the worker runs it."""
+        job = self._jobs.get(job_id)
+        if job is not None and job.status == "enqueued":
+            progress = await asyncio.to_thread(embedding_queue.progress, job.queued_ids)
+            # The queue keeps no per-product outcome: embedded counts unchanged ones too
+            job.failed = progress["dead"]
+            job.embedded = job.total - progress["queued"] - progress["dead"]
+            if not progress["queued"]:
+                job.status = "completed"
+                job.finished_at = time.time()
+        return job
+
+    async def _select(self, shop_id: str, product_ids: list[str] | None, only_missing: bool) -> list[dict]:
+        supabase = await get_supabase()
+        rows: list[dict] = []
+        if product_ids is not None:
+            for start in range(0, len(product_ids), 200):
+                result = await supabase.table("products") \
+                    .select(_PRODUCT_COLUMNS) \
+                    .eq("shop_id", shop_id) \
+                    .in_("id", product_ids[start:start + 200]) \
+                    .execute()
+                rows.extend(result.data or [])
+            return rows
+        offset = 0
+        while True:
+            query = supabase.table("products").select(_PRODUCT_COLUMNS).eq("shop_id", shop_id)
+            if only_missing:
+                query = query.or_("embedding_status.is.null,embedding_status.neq.completed")
+            result = await query.order("id").range(offset, offset + _PAGE_SIZE - 1).execute()
+            data = result.data or []
+            rows.extend(data)
+            if len(data) < _PAGE_SIZE:
+                return rows
+            offset += _PAGE_SIZE
+
+    async def _run_job(self, job: BulkJob, product_ids: list[str] | None, only_missing: bool) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            products = await self._select(job.shop_id, product_ids, only_missing)
+            job.total = len(products)
+            if embedding_queue.enabled:
+                # The worker process embeds them; progress is read back from the queue
+                await asyncio.to_thread(embedding_queue.enqueue_many, products)
+                job.queued_ids = [p["id"] for p in products]
+                job.status = "enqueued"
+                logger.info(f"Bulk embedding job {job.id}: {job.total} products handed to the embedding queue")
+                return
+            size = max(1, settings.embedding_bulk_batch_size)
+            batches: asyncio.Queue = asyncio.Queue()
+            for start in range(0, len(products), size):
+                batches.put_nowait(products[start:start + size])
+
+            async def worker() -> None:
+                while not batches.empty():
+                    batch = batches.get_nowait()
+                    outcomes, _ = await self.process_batch(batch)
+                    job.batches += 1
+                    job.embedded += outcomes.count("embedded")
+                    job.unchanged += outcomes.count("unchanged")
+                    job.deleted += outcomes.count("deleted")
+                    job.failed += outcomes.count("failed")
+
+            # One extra worker keeps the next batch's images downloading while
+            # EMBEDDING_BULK_WORKERS embed requests are in flight
+            await asyncio.gather(*(worker() for _ in range(settings.embedding_bulk_workers + 1)))
+            job.status = "completed"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Bulk embedding job {job.id} failed: {e}", exc_info=True)
+        finally:
+            if job.status != "enqueued":  # still running in the worker; job() finishes it
+                job.finished_at = time.time()
+        summary = job.to_dict()
+        logger.info(
+            f"Bulk embedding job {job.id} {job.status}: {job.embedded}/{job.total} embedded, "
+            f"{job.unchanged} unchanged, {job.failed} failed in {summary['elapsed_seconds']}s "
+            f"({summary['products_per_minute']}/min, shop={job.shop_id})"
+        )
+
+    async def shutdown(self) -> None:
+        """Close the pooled image client. Called during app shutdown."""
+        await _image_client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "products_embedded": self.products,
+            "products_unchanged": self.unchanged,
+            "products_failed": self.failures,
+            "embed_requests": self.requests,
+            "products_per_request": round((self.products + self.failures) / self.requests, 2) if self.requests else 0.0,
+            "images_fetched": self.images,
+            "image_head_requests": self.head_requests,
+            "quota_wait_seconds": round(self._quota.waited, 1),
+            "jobs_running": sum(1 for j in self._jobs.values() if j.status == "running"),
+        }
+
+
+embedding_pipeline = EmbeddingPipeline()
@@ -0,0 +1,408 @@
+"""Durable product-embedding queue and its worker process.
+
+Product embeddings used to run as FastAPI BackgroundTasks in the web
+process: lost on restart, one transient Gemini error marked the product
+'failed' for good, and a big import competed with live chats for the event
+loop. With EMBEDDING_QUEUE_ENABLED the product webhook only enqueues:
+
+  - Jobs live in one SQLite file (WAL, like the sqlite state backend), one
+    row per product: a newer event for a queued product replaces its
+    payload instead of adding a second job.
+  - A spawned worker process claims batches under a lease (a crashed
+    worker's jobs are claimed again once it expires) and embeds them
+    through embedding_pipeline, whose token bucket holds the request rate
+    to EMBEDDING_REQUESTS_PER_MINUTE.
+  - A failed job is retried with exponential backoff and jitter
+    (EMBEDDING_RETRY_BASE_SECONDS … EMBEDDING_RETRY_MAX_SECONDS). After
+    EMBEDDING_QUEUE_MAX_ATTEMPTS it is dead-lettered — kept with its last
+    error for requeue — and only then is the product marked 'failed'.
+  - The worker's catalog changes (fresh vectors) are relayed back through
+    the file; the web process re-publishes them to catalog_events so the
+    in-memory indexes (and shard workers) pick them up.
+
+Every queue operation is a few indexed single-row statements, synchronous
+like the state store.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+from app.core.config import settings
+from app.core.logging_config import get_logger, setup_logging
+from app.services import catalog_events
+from app.services.catalog_events import CatalogChange
+
+logger = get_logger(__name__)
+
+# A claimed job not finished within this long is handed to the next claim.
+_LEASE_SECONDS = 600.0
+# Finished-job log and relayed changes are kept this long (metrics / relay).
+_HISTORY_SECONDS = 3600.0
+_POLL_SECONDS = 1.0
+_RELAY_SECONDS = 2.0
+# Bound on the ids per IN (...) list — under SQLite's variable limit.
+_IN_CHUNK = 500
+
+_ENQUEUE_SQL = (
+    "INSERT INTO jobs (product_id, shop_id, payload, status, next_attempt_at, enqueued_at) "
+    "VALUES (?, ?, ?, 'pending', ?, ?) "
+    "ON CONFLICT (product_id) DO UPDATE SET "
+    " payload = excluded.payload, version = jobs.version + 1, status = 'pending',"
+    " attempts = 0, next_attempt_at = excluded.next_attempt_at, last_error = NULL,"
+    " enqueued_at = excluded.enqueued_at"
+)
+
+
+def _enqueue_params(product: dict, now: float) -> tuple:
+    return product["id"], product["shop_id"], json.dumps(product, ensure_ascii=False), now, now
+
+
+@dataclass
+class QueuedJob:
+    product_id: str
+    shop_id: str
+    version: int
+    attempts: int
+    product: dict
+
+
+class EmbeddingQueue:
+    """The queue file: jobs, the finished-job log and the change relay."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._last_purge = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.embedding_queue_enabled
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Autocommit mode; multi-statement operations open IMMEDIATE transactions.
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " product_id TEXT PRIMARY KEY,"
+                " shop_id TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " version INTEGER NOT NULL DEFAULT 1,"
+                " status TEXT NOT NULL,"          # pending | running | dead
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " claimed_at REAL,"
+                " last_error TEXT,"
+                " enqueued_at REAL NOT NULL"
+                ")"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, next_attempt_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS finished ("
+                " finished_at REAL NOT NULL, outcome TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS finished_at ON finished (finished_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS relay ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, change TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+            logger.info(f"Embedding queue ready (SQLite WAL at {self.path})")
+        return self._conn
+
+    def _transaction(self, fn):
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return result
+
+    # ── Producer side (web process) ──────────────────────────────────
+
+    def enqueue(self, product: dict) -> None:
+        """Queue a product for embedding (replacing a queued older version)."""
+        now = time.time()
+        with self._lock:
+            self._db().execute(_ENQUEUE_SQL, _enqueue_params(product, now))
+
+    def enqueue_many(self, products: list[dict]) -> None:
+        """enqueue() for a whole bulk job in one transaction."""
+        now = time.time()
+        self._transaction(lambda conn: conn.executemany(_ENQUEUE_SQL, [_enqueue_params(p, now) for p in products]))
+
+    def progress(self, product_ids: list[str]) -> dict:
+        """How many of these products are still queued, and how many are dead-lettered."""
+        queued = dead = 0
+        with self._lock:
+            conn = self._db()
+            for start in range(0, len(product_ids), _IN_CHUNK):
+                chunk = product_ids[start:start + _IN_CHUNK]
+                rows = conn.execute(
+                    f"SELECT status, count(*) FROM jobs WHERE product_id IN ({', '.join('?' * len(chunk))}) "
+                    "GROUP BY status",
+                    chunk,
+                ).fetchall()
+                for status, count in rows:
+                    if status == "dead":
+                        dead += count
+                    else:
+                        queued += count
+        return {"queued": queued, "dead": dead}
+
+    def remove(self, product_id: str) -> None:
+        """Drop a deleted product's job (a running one finishes as a no-op)."""
+        with self._lock:
+            self._db().execute("DELETE FROM jobs WHERE product_id = ?", (product_id,))
+
+    def requeue_dead(self, shop_id: str | None = None) -> int:
+        """Give dead-lettered jobs a fresh set of attempts."""
+        query = "UPDATE jobs SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'"
+        params: tuple = (time.time(),)
+        if shop_id is not None:
+            query += " AND shop_id = ?"
+            params += (shop_id,)
+        with self._lock:
+            return self._db().execute(query, params).rowcount
+
+    # ── Worker side ──────────────────────────────────────────────────
+
+    def claim(self, limit: int) -> list[QueuedJob]:
+        """Lease up to `limit` ready jobs, oldest due first."""
+        now = time.time()
+
+        def run(conn: sqlite3.Connection) -> list[QueuedJob]:
+            rows = conn.execute(
+                "SELECT product_id, shop_id, version, attempts, payload FROM jobs "
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "   OR (status = 'running' AND claimed_at <= ?) "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (now, now - _LEASE_SECONDS, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'running', claimed_at = ? WHERE product_id = ?",
+                [(now, row[0]) for row in rows],
+            )
+            return [
+                QueuedJob(product_id=r[0], shop_id=r[1], version=r[2], attempts=r[3], product=json.loads(r[4]))
+                for r in rows
+            ]
+
+        return self._transaction(run)
+
+    def finish(self, job: QueuedJob, outcome: str, error: str | None = None) -> str:
+        """Record a job's outcome: "done", "retry" or "dead" (returned).
+
+        A job re-enqueued while it ran (newer version) stays queued as is.
+        """
+        now = time.time()
+
+        def run(conn: sqlite3.Connection) -> str:
+            conn.execute("INSERT INTO finished (finished_at, outcome) VALUES (?, ?)", (now, outcome))
+            if outcome != "failed":
+                conn.execute(
+                    "DELETE FROM jobs WHERE product_id = ? AND version = ?", (job.product_id, job.version),
+                )
+                return "done"
+            attempts = job.attempts + 1
+            if attempts >= settings.embedding_queue_max_attempts:
+                state, next_at = "dead", now
+            else:
+                delay = min(
+                    settings.embedding_retry_max_seconds,
+                    settings.embedding_retry_base_seconds * 2 ** (attempts - 1),
+                )
+                state, next_at = "retry", now + delay * random.uniform(0.8, 1.2)
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, claimed_at = NULL "
+                "WHERE product_id = ? AND version = ?",
+                ("dead" if state == "dead" else "pending", attempts, next_at, error, job.product_id, job.version),
+            )
+            return state
+
+        state = self._transaction(run)
+        self._maybe_purge(now)
+        return state
+
+    def record_change(self, change: CatalogChange) -> None:
+        """catalog_events subscriber in the worker: relay the change to the web process."""
+        if change.embedding is None:
+            return
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO relay (change, created_at) VALUES (?, ?)",
+                (json.dumps(asdict(change), ensure_ascii=False), time.time()),
+            )
+
+    def _maybe_purge(self, now: float) -> None:
+        if now - self._last_purge < 60.0:
+            return
+        self._last_purge = now
+        with self._lock:
+            try:
+                self._db().execute("DELETE FROM finished WHERE finished_at <= ?", (now - _HISTORY_SECONDS,))
+                self._db().execute("DELETE FROM relay WHERE created_at <= ?", (now - _HISTORY_SECONDS,))
+            except sqlite3.OperationalError as e:
+                logger.debug(f"Embedding queue purge skipped: {e}")
+
+    # ── Relay / metrics (web process) ────────────────────────────────
+
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._db().execute("SELECT coalesce(max(seq), 0) FROM relay").fetchone()[0]
+
+    def changes_since(self, seq: int) -> tuple[int, list[CatalogChange]]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT seq, change FROM relay WHERE seq > ? ORDER BY seq LIMIT 500", (seq,),
+            ).fetchall()
+        if not rows:
+            return seq, []
+        return rows[-1][0], [CatalogChange(**json.loads(change)) for _, change in rows]
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            counts = dict(conn.execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall())
+            oldest = conn.execute(
+                "SELECT min(enqueued_at) FROM jobs WHERE status != 'dead'"
+            ).fetchone()[0]
+            last_minute = dict(conn.execute(
+                "SELECT outcome, count(*) FROM finished WHERE finished_at > ? GROUP BY outcome", (now - 60,),
+            ).fetchall())
+        return {
+            "enabled": True,
+            "backlog": counts.get("pending", 0) + counts.get("running", 0),
+            "running": counts.get("running", 0),
+            "dead_letter": counts.get("dead", 0),
+            "oldest_job_age_seconds": round(now - oldest, 1) if oldest else 0.0,
+            "jobs_per_minute": sum(v for k, v in last_minute.items() if k != "failed"),
+            "failures_per_minute": last_minute.get("failed", 0),
+        }
+
+
+embedding_queue = EmbeddingQueue(settings.embedding_queue_path)
+
+
+class EmbeddingWorker:
+    """Web-process side: owns the worker process and relays its changes."""
+
+    def __init__(self) -> None:
+        self._process: multiprocessing.process.BaseProcess | None = None
+        self._relay: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Spawn the worker process. Called from the app lifespan."""
+        if not embedding_queue.enabled:
+            return
+        self._spawn()
+        self._relay = asyncio.create_task(self._relay_loop(embedding_queue.last_seq()))
+        logger.info(f"Embedding queue: worker process started ({settings.embedding_queue_path})")
+
+    def _spawn(self) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        self._process = ctx.Process(target=run_worker, name="daamkoto-embedder", daemon=True)
+        self._process.start()
+
+    async def _relay_loop(self, seq: int) -> None:
+        while True:
+            await asyncio.sleep(_RELAY_SECONDS)
+            try:
+                if self._process is not None and not self._process.is_alive():
+                    logger.error("Embedding worker is not running — respawning")
+                    self._spawn()
+                seq, changes = embedding_queue.changes_since(seq)
+                # Every web worker reads this relay itself — no cross-worker relay
+                for change in changes:
+                    await catalog_events.publish(change, relay=False)
+            except Exception as e:
+                logger.error(f"Embedding change relay failed: {e}")
+
+    async def stop(self) -> None:
+        """Stop relaying and let the worker finish its in-flight batches."""
+        if self._relay is not None and not self._relay.done():
+            self._relay.cancel()
+            await asyncio.gather(self._relay, return_exceptions=True)
+        proc, self._process = self._process, None
+        if proc is None:
+            return
+        if proc.is_alive():
+            proc.terminate()
+        await asyncio.to_thread(proc.join, settings.background_drain_timeout)
+        if proc.is_alive():
+            logger.warning(f"{proc.name} did not exit in time — killing (its jobs are re-claimed on restart)")
+            proc.kill()
+
+
+embedding_worker = EmbeddingWorker()
+
+
+# ── Worker process ───────────────────────────────────────────────────────
+
+def run_worker() -> None:
+    """Entry point of the spawned embedding worker."""
+    setup_logging()
+    try:
+        asyncio.run(_worker_main())
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_main() -> None:
+    from app.services.embedding_pipeline import embedding_pipeline
+
+    catalog_events.subscribe(embedding_queue.record_change)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def run_batches() -> None:
+        while not stop.is_set():
+            jobs = embedding_queue.claim(settings.embedding_bulk_batch_size)
+            if not jobs:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                outcomes, errors = await embedding_pipeline.process_batch(
+                    [job.product for job in jobs], mark_failed=False,
+                )
+            except Exception as e:
+                logger.error(f"Embedding batch crashed ({len(jobs)} jobs): {e}", exc_info=True)
+                outcomes, errors = ["failed"] * len(jobs), {job.product_id: str(e)[:500] for job in jobs}
+            dead = []
+            for job, outcome in zip(jobs, outcomes):
+                state = embedding_queue.finish(job, outcome, errors.get(job.product_id))
+                if state == "dead":
+                    dead.append(job.product_id)
+            if dead:
+                logger.error(f"Embedding queue: {len(dead)} job(s) dead-lettered after retries: {dead[:5]}")
+                await embedding_pipeline.mark_failed(dead)
+
+    logger.info(f"Embedding worker started (pid={os.getpid()})")
+    await asyncio.gather(*(run_batches() for _ in range(max(1, settings.embedding_bulk_workers))))
+    await embedding_pipeline.shutdown()
+    logger.info("Embedding worker stopped")
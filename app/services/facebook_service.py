@@ -6,6 +6,7 @@ from app.core.logging_config import get_logger
 from app.core.tenant_context import resolve_tenant, TenantNotFoundError, TenantInactiveError
 from app.schemas.facebook import FacebookWebhookPayload
 from app.services.handlers.message_router import message_router
+from app.services.shard_service import shard_service
 
 logger = get_logger(__name__)
 
@@ -97,6 +98,20 @@ class FacebookService:
                         f"attachments={att_count}"
                     )
 
+                    # Sharded mode: hand the message to the worker process that
+                    # owns this conversation (batching, locks, memory live there).
+                    # Never handled here instead: two processes would batch
+                    # and answer the same conversation.
+                    if shard_service.enabled:
+                        try:
+                            await shard_service.dispatch_message(tenant, message_dict)
+                        except Exception as e:
+                            logger.error(
+                                f"[{sender_id}] Shard dispatch failed after retries ({e}) — "
+                                f"message dropped (mid={mid})"
+                            )
+                        continue
+
                     # Route message to appropriate handler (text or image)
                     await message_router.route_message(
                         sender_id=sender_id,
@@ -0,0 +1,43 @@
+"""Image helpers shared by the agent (customer photos) and the embedding pipeline."""
+
+from app.core.config import settings
+from app.core.logging_config import get_logger
+
+logger = get_logger(__name__)
+
+
+def downscale_image(image_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
+    """Downscale oversized photos so the longest side ≤ image_max_dimension.
+
+    Gemini bills images per 768×768 tile (~258 tokens each) — a full-res FB
+    photo can be ~6 tiles. Capping at one tile makes every image minimum
+    price (and shrinks the base64 payload on the OpenAI path) with no
+    practical loss for product identification. Falls back to the original
+    bytes on any decode failure (animated/unsupported formats)."""
+    try:
+        import io
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(image_bytes))
+        max_dim = settings.image_max_dimension
+        if max(img.size) <= max_dim:
+            return image_bytes, mime_type
+
+        orig_size = img.size
+        img.thumbnail((max_dim, max_dim))
+        buf = io.BytesIO()
+        if img.mode in ("RGBA", "LA", "P"):
+            img.save(buf, format="PNG")  # keep transparency (stickers/screenshots)
+            out_mime = "image/png"
+        else:
+            img.convert("RGB").save(buf, format="JPEG", quality=85)
+            out_mime = "image/jpeg"
+        out = buf.getvalue()
+        logger.info(
+            f"📉 Image downscaled {orig_size[0]}x{orig_size[1]} → {img.size[0]}x{img.size[1]} "
+            f"({len(image_bytes)//1024}KB → {len(out)//1024}KB)"
+        )
+        return out, out_mime
+    except Exception as e:
+        logger.warning(f"Image downscale failed, using original: {e}")
+        return image_bytes, mime_type
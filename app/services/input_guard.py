@@ -13,13 +13,15 @@ Covers:
                                                mid-sentence corrupts legitimate
                                                messages like 'can this act as a raincoat?')
 
-All operations are synchronous in-memory — no I/O, safe to call without await.
+All operations are synchronous — in-memory, or a local-disk SQLite row when
+STATE_BACKEND=sqlite — safe to call without await.
 """
 
 import re
 import time
 from app.core.config import settings
 from app.core.logging_config import get_logger
+from app.core.state_store import get_state_store
 
 logger = get_logger(__name__)
 
@@ -56,15 +58,18 @@ class InputGuard:
     """
     Stateful guard that cleans and rate-limits user messages.
 
-    Rate limiting uses a fixed-window counter per sender_id stored in a plain
-    dict. The dict grows with active users but stays small (a few hundred bytes
-    per user). Old windows are lazily replaced when a new window starts, so
-    memory doesn't leak for inactive users.
+    Rate limiting uses a fixed-window counter per sender_id on the shared
+    state backend, so every worker draws from the same budget. Windows are
+    wall-clock (time.time) because monotonic clocks aren't comparable across
+    processes, and each entry expires one window after its last update, so
+    inactive users don't accumulate.
     """
 
     def __init__(self) -> None:
-        # sender_id -> (window_start: float, count: int, notified: bool)
-        self._windows: dict[str, tuple[float, int, bool]] = {}
+        # sender_id -> [window_start: float, count: int, notified: bool]
+        self._windows = get_state_store(
+            "rate_windows", ttl=settings.rate_limit_window, maxsize=10000
+        )
 
     def check(self, sender_id: str, text: str) -> tuple[str, str]:
         """
@@ -126,24 +131,25 @@ class InputGuard:
         per exhausted window, so the bot doesn't spam "slow down" replies at
         someone pasting many messages.
         """
-        now = time.monotonic()
+        now = time.time()
         window_secs: float = settings.rate_limit_window
         limit: int = settings.rate_limit_messages
+        outcome = {"allowed": True, "notify": False}
 
-        if sender_id in self._windows:
-            start, count, notified = self._windows[sender_id]
-            if now - start >= window_secs:
-                # Window expired — fresh window starting now
-                self._windows[sender_id] = (now, 1, False)
-                return True, False
+        def _step(window):
+            if window is None or now - window[0] >= window_secs:
+                # No window yet, or it expired — fresh window starting now
+                return [now, 1, False]
+            start, count, notified = window
             if count >= limit:
-                self._windows[sender_id] = (start, count, True)
-                return False, not notified
-            self._windows[sender_id] = (start, count + 1, notified)
-            return True, False
-
-        self._windows[sender_id] = (now, 1, False)
-        return True, False
+                outcome["allowed"] = False
+                outcome["notify"] = not notified
+                return [start, count, True]
+            return [start, count + 1, notified]
+
+        # Atomic read-modify-write: two workers can't both take the last slot
+        self._windows.update(sender_id, _step)
+        return outcome["allowed"], outcome["notify"]
 
 
 input_guard = InputGuard()
@@ -0,0 +1,141 @@
+"""BM25 keyword index with a Bangla/Banglish-aware tokenizer.
+
+The keyword half of match_products_hybrid runs Postgres FTS, whose English
+stemmer mangles transliterated product names ("panjabi", "punjabi",
+"panjabee" are three unrelated words to it). This index runs in process
+instead, one per shop alongside catalog_index's vectors, and is updated
+incrementally from the same catalog_events.
+
+Tokenizer: normalize_query() (case, punctuation, known Banglish spellings)
+then a phonetic fold applied to Latin-script tokens so unseen spelling
+variants still meet — aspirates dropped (ph/bh/dh/kh/gh/th/sh → p/b/d/k/g/t/s),
+z → j, w → o, doubled vowels and letters collapsed, trailing y/ee → i.
+Bangla script tokens are kept as-is. Indexed text: the product name
+(weighted x3), description, and the attribute keys/values that
+compact_attributes() exposes to the agent.
+
+Ranking fusion with the vector side is reciprocal-rank fusion (rrf()).
+"""
+
+import math
+import re
+from collections import Counter, defaultdict
+
+from app.services.catalog_rows import compact_attributes
+from app.services.query_normalizer import normalize_query
+
+# BM25 parameters (Robertson defaults)
+_K1 = 1.2
+_B = 0.75
+_NAME_WEIGHT = 3
+
+# Reciprocal-rank-fusion constant — damps the advantage of rank 1 vs rank 2.
+RRF_K = 60
+
+# Query words that say "I'm shopping", not what for.
+STOPWORDS = frozenset({
+    "a", "an", "the", "and", "or", "of", "for", "in", "with", "is", "are", "do", "you", "have",
+    "i", "me", "my", "want", "need", "show", "any", "some", "please", "pls", "plz",
+    "price", "dam", "koto", "ache", "nai", "ki", "er", "te", "ta", "ti", "gula", "guli",
+    "ekta", "dekhan", "dekhao", "dao", "den", "chai", "lagbe", "hobe", "bhai", "apu", "vai",
+})
+
+_LATIN_RE = re.compile(r"^[a-z0-9\-']+$")
+_FOLDS = (
+    ("ph", "p"), ("bh", "b"), ("dh", "d"), ("kh", "k"), ("gh", "g"), ("th", "t"),
+    ("sh", "s"), ("ch", "c"), ("z", "j"), ("w", "o"), ("ee", "i"), ("oo", "u"),
+)
+_REPEAT_RE = re.compile(r"(.)\1+")
+
+
+def _fold(token: str) -> str:
+    if not _LATIN_RE.match(token) or token.isdigit():
+        return token
+    for src, dst in _FOLDS:
+        token = token.replace(src, dst)
+    token = _REPEAT_RE.sub(r"\1", token)
+    if len(token) > 3 and token.endswith("y"):
+        token = token[:-1] + "i"
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    """Index/query tokens for a piece of text."""
+    out = []
+    for raw in normalize_query(text).replace("-", " ").split():
+        if raw in STOPWORDS or (len(raw) < 2 and not raw.isdigit()):
+            continue
+        out.append(_fold(raw))
+    return out
+
+
+def document_tokens(row: dict) -> list[str]:
+    """Tokens of one products row: name x3, description, exposed attributes."""
+    tokens = tokenize(row.get("name") or "") * _NAME_WEIGHT
+    tokens += tokenize(row.get("description") or "")
+    for key, value in compact_attributes(row.get("attributes")).items():
+        if key == "product_url":
+            continue
+        tokens += tokenize(f"{key} {value}")
+    return tokens
+
+
+class Bm25Index:
+    """Incremental BM25 over documents keyed by id."""
+
+    def __init__(self) -> None:
+        self._postings: dict[str, dict[str, int]] = defaultdict(dict)
+        self._doc_terms: dict[str, Counter] = {}
+        self._doc_len: dict[str, int] = {}
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_terms)
+
+    def add(self, doc_id: str, tokens: list[str]) -> None:
+        """Index (or re-index) one document."""
+        self.remove(doc_id)
+        terms = Counter(tokens)
+        self._doc_terms[doc_id] = terms
+        self._doc_len[doc_id] = len(tokens)
+        self._total_len += len(tokens)
+        for term, tf in terms.items():
+            self._postings[term][doc_id] = tf
+
+    def remove(self, doc_id: str) -> None:
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        self._total_len -= self._doc_len.pop(doc_id)
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[term]
+
+    def score(self, query_tokens: list[str]) -> dict[str, float]:
+        """doc_id -> BM25 score for every document matching any query token."""
+        n_docs = len(self._doc_terms)
+        if not n_docs or not query_tokens:
+            return {}
+        avgdl = self._total_len / n_docs
+        scores: dict[str, float] = defaultdict(float)
+        for term in set(query_tokens):
+            posting = self._postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                dl = self._doc_len[doc_id]
+                scores[doc_id] += idf * tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * dl / avgdl))
+        return scores
+
+
+def rrf(rankings: list[list[str]], k: int = RRF_K) -> list[str]:
+    """Reciprocal-rank fusion of several best-first rankings."""
+    fused: dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            fused[key] += 1.0 / (k + rank + 1)
+    return sorted(fused, key=fused.__getitem__, reverse=True)
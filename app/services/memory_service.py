@@ -1,15 +1,16 @@
-"""Short-term per-sender conversation memory using TTLCache.
+"""Short-term per-sender conversation memory on the shared state backend.
 
 Provider-agnostic: stores history as plain dicts internally,
 with converters for Gemini and OpenAI formats.
 """
 
 import json
-from cachetools import TTLCache
 from app.core.config import settings
+from app.core.state_store import get_state_store
 
-# TTLCache automatically ejects idle users after exactly `conversation_ttl` seconds (e.g. 5 mins)
-_cache: TTLCache = TTLCache(maxsize=1000, ttl=settings.conversation_ttl)
+# Idle conversations are ejected after exactly `conversation_ttl` seconds (e.g. 5 mins).
+# Entries are plain JSON dicts so the store can be shared between workers.
+_cache = get_state_store("memory", ttl=settings.conversation_ttl, maxsize=1000)
 
 _STALE_IMAGE_PLACEHOLDER = (
     "[customer sent a photo here — it was already analyzed earlier in this conversation]"
@@ -262,7 +263,6 @@ class MemoryService:
 
     def clear_history(self, sender_id: str) -> None:
         """Manually wipe history if needed (e.g., after order completion)."""
-        if sender_id in _cache:
-            del _cache[sender_id]
+        _cache.pop(sender_id, None)
 
 memory_service = MemoryService()
@@ -8,14 +8,41 @@ Writes every user message and bot reply to Supabase so:
 
 All writes are designed to be fired-and-forgotten from the hot path —
 failures are logged, never raised into the reply flow.
+
+Transcript rows are written behind: log_message_bg() only buffers, and a
+background flush turns everything queued across ALL conversations into one
+bulk `messages` insert plus one `threads.updated_at` bump for the touched
+threads. A reply with three bubbles and an image used to cost ~8 sequential
+PostgREST round trips; now it rides along with whatever else is pending.
+
+Ordering: every row gets a per-conversation sequence number (`messages.seq`)
+assigned in process at log time — the order the reply flow produced the
+messages — so the dashboard and transcript rehydration never show a bot
+reply above the question it answered, even when several rows share a
+created_at. Customer/thread resolution is single-flighted per conversation:
+concurrent callers await one lookup instead of racing duplicate queries
+(and duplicate inserts).
+
+Conversation bootstrap: a cold conversation used to pay ~7 serial round
+trips (takeover check, transcript rehydration, profile, order lookups all
+re-walking customers → threads). bootstrap_conversation() fetches all of it
+with ONE `conversation_bootstrap` RPC and fills the customer, thread,
+takeover, profile and transcript caches from that single response. Without
+the 20261020_conversation_bootstrap migration every caller falls back to
+the legacy query chain.
 """
 
 import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
 from cachetools import TTLCache
 
+from app.core.config import settings
 from app.core.dependencies import get_supabase
 from app.core.logging_config import get_logger
 from app.core.tenant_context import TenantContext
+from app.core.write_behind import WriteBehindBuffer
 
 logger = get_logger(__name__)
 
@@ -24,16 +51,66 @@ _customer_cache: TTLCache = TTLCache(maxsize=2000, ttl=600)
 # (shop_id, customer_id) -> thread_id
 _thread_cache: TTLCache = TTLCache(maxsize=2000, ttl=600)
 # (shop_id, psid) -> bool: is a human agent handling this thread right now?
-# Short TTL so a dashboard "Take Over" click silences the bot within ~20s.
-_takeover_cache: TTLCache = TTLCache(maxsize=2000, ttl=20)
+# Status changes are PUSHED by the threads webhook (apply_thread_status), but
+# that only updates the process that got the HTTP call. Sharded, that is the
+# conversation's owning worker and the TTL is only the safety net for a
+# missed delivery; otherwise other uvicorn workers rely on the short poll.
+_takeover_cache: TTLCache = TTLCache(
+    maxsize=2000,
+    ttl=settings.takeover_cache_ttl if settings.shard_workers > 0 else settings.takeover_poll_ttl,
+)
+# customer_id -> psid, to map thread webhooks back to a conversation
+_psid_by_customer: TTLCache = TTLCache(maxsize=5000, ttl=6 * 3600)
 # (shop_id, psid) we already tried a Graph profile-name fetch for. Long TTL:
 # when the app can't read a user's profile (unverified app, privacy), don't
 # re-hit Graph on every customer-cache miss.
 _name_fetch_attempted: TTLCache = TTLCache(maxsize=5000, ttl=6 * 3600)
+# (shop_id, psid) -> conversation_bootstrap snapshot {customer, thread, messages}.
+# Short TTL: it only has to bridge the takeover check, rehydration and
+# profile lookup of one agent run. Also remembers "no customer yet" (None).
+_bootstrap_cache: TTLCache = TTLCache(maxsize=2000, ttl=30)
+# "{shop_id}:{psid}" -> last messages.seq handed out. Outlives the customer
+# cache so a conversation keeps counting up between bursts.
+_last_seq: TTLCache = TTLCache(maxsize=10000, ttl=6 * 3600)
 
 
 class PersistenceService:
 
+    def __init__(self) -> None:
+        self._transcript = WriteBehindBuffer(
+            "transcript",
+            self._flush_messages,
+            interval=settings.transcript_flush_interval,
+            max_items=settings.transcript_flush_max_rows,
+        )
+        # In-flight customer/thread lookups, keyed like their caches
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        # Flipped off (with a warning) if the messages.seq column is missing
+        self._seq_supported = True
+        # Flipped off (with a warning) if the conversation_bootstrap RPC is missing
+        self._bootstrap_supported = True
+
+    async def _single_flight(self, key: tuple, fn: Callable[[], Awaitable[str]]) -> str:
+        """Run fn once per key at a time; concurrent callers share its result."""
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved — waiters (if any) re-raise it
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
     async def get_or_create_customer(
         self,
         shop_id: str,
@@ -51,7 +128,19 @@ class PersistenceService:
         cached = _customer_cache.get(cache_key)
         if cached:
             return cached
+        return await self._single_flight(
+            ("customer",) + cache_key,
+            lambda: self._lookup_or_create_customer(shop_id, psid, name, page_access_token),
+        )
 
+    async def _lookup_or_create_customer(
+        self,
+        shop_id: str,
+        psid: str,
+        name: str | None,
+        page_access_token: str | None,
+    ) -> str:
+        cache_key = (shop_id, psid)
         supabase = await get_supabase()
         result = await supabase.table("customers") \
             .select("id, name") \
@@ -95,6 +184,7 @@ class PersistenceService:
                 customer_id = retry.data[0]["id"]
 
         _customer_cache[cache_key] = customer_id
+        _psid_by_customer[customer_id] = psid
         return customer_id
 
     @staticmethod
@@ -123,7 +213,13 @@ class PersistenceService:
         cached = _thread_cache.get(cache_key)
         if cached:
             return cached
+        return await self._single_flight(
+            ("thread",) + cache_key,
+            lambda: self._lookup_or_create_thread(shop_id, customer_id),
+        )
 
+    async def _lookup_or_create_thread(self, shop_id: str, customer_id: str) -> str:
+        cache_key = (shop_id, customer_id)
         supabase = await get_supabase()
         result = await supabase.table("threads") \
             .select("id") \
@@ -160,6 +256,13 @@ class PersistenceService:
         if cached is not None:
             return cached
 
+        # One RPC fills the takeover cache along with everything else the
+        # agent run is about to need.
+        if await self.bootstrap_conversation(shop_id, psid) is not None:
+            cached = _takeover_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
         human_active = False
         try:
             supabase = await get_supabase()
@@ -185,47 +288,159 @@ class PersistenceService:
         _takeover_cache[cache_key] = human_active
         return human_active
 
+    async def psid_for_customer(self, shop_id: str, customer_id: str) -> str | None:
+        """Messenger PSID of a customers row (cached; one query on a miss)."""
+        cached = _psid_by_customer.get(customer_id)
+        if cached:
+            return cached
+        supabase = await get_supabase()
+        result = await supabase.table("customers") \
+            .select("messenger_psid") \
+            .eq("id", customer_id) \
+            .eq("shop_id", shop_id) \
+            .limit(1) \
+            .execute()
+        if not result.data:
+            return None
+        psid = result.data[0]["messenger_psid"]
+        _psid_by_customer[customer_id] = psid
+        return psid
+
+    @staticmethod
+    def apply_thread_status(shop_id: str, psid: str, thread_id: str, status: str) -> None:
+        """Apply a pushed thread status change (threads webhook) to the caches.
+
+        'human_active' mutes the bot from the very next batch. 'closed'
+        also forgets the cached thread so the next message opens a new one.
+        """
+        _takeover_cache[(shop_id, psid)] = status == "human_active"
+        _bootstrap_cache.pop((shop_id, psid), None)
+        if status == "closed":
+            for key, cached_thread in list(_thread_cache.items()):
+                if cached_thread == thread_id:
+                    _thread_cache.pop(key, None)
+
     def log_message_bg(
         self, tenant: TenantContext, sender_type: str, content: str
     ) -> None:
-        """Fire-and-forget persistence of one message. Never blocks the reply path."""
+        """Fire-and-forget persistence of one message. Never blocks the reply path.
+
+        created_at and seq are stamped NOW, not at flush time — rows are
+        written up to a flush interval later, and call order here IS the
+        conversation order.
+        """
         if not content:
             return
-        task = asyncio.create_task(self._log_message(tenant, sender_type, content))
-        task.add_done_callback(self._log_bg_error)
+        self._transcript.add({
+            "tenant": tenant,
+            "sender_type": sender_type,
+            "content": content[:8000],
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "seq": self._next_seq(tenant),
+        })
 
     @staticmethod
-    def _log_bg_error(task: asyncio.Task) -> None:
-        if task.cancelled():
-            return
-        exc = task.exception()
-        if exc:
-            logger.error(f"Message persistence failed: {exc}")
+    def _next_seq(tenant: TenantContext) -> int:
+        """Strictly increasing per conversation, and across restarts.
 
-    async def _log_message(
-        self, tenant: TenantContext, sender_type: str, content: str
-    ) -> None:
-        """Write one message row (live sender_type enum: 'customer' | 'bot' | 'human')."""
-        customer_id = await self.get_or_create_customer(
-            tenant.shop_id, tenant.sender_id, page_access_token=tenant.page_access_token
+        Microseconds since the epoch, bumped past the last value handed out
+        so two messages logged in the same microsecond still order. Sharded
+        mode keeps each conversation on one process, so one counter owns it.
+        """
+        key = f"{tenant.shop_id}:{tenant.sender_id}"
+        seq = max(_last_seq.get(key, 0) + 1, time.time_ns() // 1000)
+        _last_seq[key] = seq
+        return seq
+
+    async def _flush_messages(self, entries: list[dict]) -> None:
+        """Bulk-write buffered rows (live sender_type enum: 'customer' | 'bot' | 'human').
+
+        Customer/thread ids are resolved once per conversation in the batch
+        (cache hits after the first message), conversations concurrently.
+        Raises without writing anything if any step fails — the rows are
+        inserted in one statement, so the write-behind buffer can split and
+        retry the batch without duplicating rows.
+        """
+        conversations: dict[tuple[str, str], TenantContext] = {}
+        for entry in entries:
+            tenant = entry["tenant"]
+            conversations.setdefault((tenant.shop_id, tenant.sender_id), tenant)
+
+        keys = list(conversations)
+        resolved = await asyncio.gather(
+            *(self._resolve_thread(conversations[k]) for k in keys),
+            return_exceptions=True,
         )
-        thread_id = await self.get_or_create_thread(tenant.shop_id, customer_id)
+        thread_ids: dict[tuple[str, str], str] = {}
+        for key, result in zip(keys, resolved):
+            if isinstance(result, Exception):
+                # Nothing written yet: the buffer splits the batch and retries,
+                # so the other conversations' rows still go out.
+                raise RuntimeError(f"thread lookup failed for {key[1]}: {result}") from result
+            thread_ids[key] = result
+
+        rows = []
+        for entry in entries:
+            tenant = entry["tenant"]
+            thread_id = thread_ids.get((tenant.shop_id, tenant.sender_id))
+            if thread_id is None:
+                continue
+            rows.append({
+                "thread_id": thread_id,
+                "shop_id": tenant.shop_id,
+                "sender_type": entry["sender_type"],
+                "content": entry["content"],
+                "created_at": entry["created_at"],
+                "seq": entry["seq"],
+            })
+        if not rows:
+            return
 
         supabase = await get_supabase()
-        await supabase.table("messages").insert({
-            "thread_id": thread_id,
-            "shop_id": tenant.shop_id,
-            "sender_type": sender_type,
-            "content": content[:8000],
-        }).execute()
-
-        # Bump the thread so the dashboard sorts active conversations first
+        if not self._seq_supported:
+            for row in rows:
+                row.pop("seq", None)
+        try:
+            await supabase.table("messages").insert(rows).execute()
+        except Exception as e:
+            if not self._seq_supported or "seq" not in str(e):
+                raise
+            # 20261019_messages_seq migration not applied yet — keep logging
+            # transcripts, ordered by created_at only.
+            self._seq_supported = False
+            logger.warning(
+                f"messages insert with seq failed ({e}) — retrying without it. "
+                "Run the 20261019_messages_seq migration."
+            )
+            for row in rows:
+                row.pop("seq", None)
+            await supabase.table("messages").insert(rows).execute()
+
+        # Bump every touched thread once so the dashboard sorts active
+        # conversations first — one request per flush, not one per message.
+        touched = sorted(set(thread_ids.values()))
         try:
             await supabase.table("threads").update({"updated_at": "now()"}) \
-                .eq("id", thread_id).execute()
+                .in_("id", touched).execute()
         except Exception as e:
             logger.debug(f"Thread timestamp bump failed: {e}")
 
+        logger.debug(f"Transcript flush: {len(rows)} message(s) across {len(touched)} thread(s)")
+
+    async def _resolve_thread(self, tenant: TenantContext) -> str:
+        customer_id = await self.get_or_create_customer(
+            tenant.shop_id, tenant.sender_id, page_access_token=tenant.page_access_token
+        )
+        return await self.get_or_create_thread(tenant.shop_id, customer_id)
+
+    async def shutdown(self) -> None:
+        """Flush buffered transcript rows. Called during app shutdown."""
+        await self._transcript.drain()
+
+    def stats(self) -> dict:
+        """Write-behind counters for /internal/metrics."""
+        return {"transcript": self._transcript.stats()}
+
     async def fetch_recent_transcript(
         self, shop_id: str, psid: str, limit: int = 12
     ) -> list[dict]:
@@ -236,38 +451,16 @@ class PersistenceService:
         dicts, starting with a user message (Gemini requirement).
         """
         try:
-            supabase = await get_supabase()
-            cust = await supabase.table("customers") \
-                .select("id") \
-                .eq("shop_id", shop_id) \
-                .eq("messenger_psid", psid) \
-                .limit(1) \
-                .execute()
-            if not cust.data:
-                return []
-            customer_id = cust.data[0]["id"]
-
-            thread = await supabase.table("threads") \
-                .select("id") \
-                .eq("shop_id", shop_id) \
-                .eq("customer_id", customer_id) \
-                .order("updated_at", desc=True) \
-                .limit(1) \
-                .execute()
-            if not thread.data:
-                return []
-
-            msgs = await supabase.table("messages") \
-                .select("sender_type, content") \
-                .eq("thread_id", thread.data[0]["id"]) \
-                .order("created_at", desc=True) \
-                .limit(limit) \
-                .execute()
-            if not msgs.data:
+            snapshot = await self.bootstrap_conversation(shop_id, psid)
+            if snapshot is not None:
+                rows = snapshot.get("messages") or []
+            else:
+                rows = await self._fetch_transcript_rows(shop_id, psid, limit)
+            if not rows:
                 return []
 
             history = []
-            for m in reversed(msgs.data):  # oldest first
+            for m in reversed(rows[:limit]):  # oldest first
                 role = "user" if m["sender_type"] == "customer" else "model"
                 text = m["content"]
                 if m["sender_type"] == "human":
@@ -283,5 +476,168 @@ class PersistenceService:
             logger.warning(f"[{psid}] Transcript rehydration failed: {e}")
             return []
 
+    async def _fetch_transcript_rows(self, shop_id: str, psid: str, limit: int) -> list[dict]:
+        """Legacy chain: customers → latest thread → newest-first messages."""
+        supabase = await get_supabase()
+        cust = await supabase.table("customers") \
+            .select("id") \
+            .eq("shop_id", shop_id) \
+            .eq("messenger_psid", psid) \
+            .limit(1) \
+            .execute()
+        if not cust.data:
+            return []
+        customer_id = cust.data[0]["id"]
+
+        thread = await supabase.table("threads") \
+            .select("id") \
+            .eq("shop_id", shop_id) \
+            .eq("customer_id", customer_id) \
+            .order("updated_at", desc=True) \
+            .limit(1) \
+            .execute()
+        if not thread.data:
+            return []
+
+        msgs = await self._recent_messages(supabase, thread.data[0]["id"], limit)
+        return msgs.data or []
+
+    # ─────────────────────────────────────────────────────────────────────
+    #  Conversation bootstrap (one RPC for a cold conversation)
+    # ─────────────────────────────────────────────────────────────────────
+
+    async def bootstrap_conversation(self, shop_id: str, psid: str) -> dict | None:
+        """Return {customer, thread, messages} for this conversation in ONE round trip.
+
+        customer: {id, name, preferred_sizes, last_delivery_address,
+        contact_number} or None; thread: the active (non-closed) thread
+        {id, status} or None; messages: newest-first {sender_type, content}
+        of the latest thread. Fills the customer/thread/takeover caches as a
+        side effect. Returns None when the RPC is unavailable or failed —
+        callers then use their legacy queries.
+        """
+        if not self._bootstrap_supported:
+            return None
+        cache_key = (shop_id, psid)
+        if cache_key in _bootstrap_cache:
+            return _bootstrap_cache[cache_key]
+        try:
+            return await self._single_flight(
+                ("bootstrap",) + cache_key,
+                lambda: self._run_bootstrap(shop_id, psid),
+            )
+        except Exception as e:
+            if "conversation_bootstrap" in str(e) or "PGRST202" in str(e):
+                self._bootstrap_supported = False
+                logger.warning(
+                    f"conversation_bootstrap RPC failed ({e}) — using the per-table "
+                    "queries. Run the 20261020_conversation_bootstrap migration."
+                )
+            else:
+                logger.warning(f"[{psid}] Conversation bootstrap failed: {e}")
+            return None
+
+    async def _run_bootstrap(self, shop_id: str, psid: str) -> dict:
+        supabase = await get_supabase()
+        result = await supabase.rpc("conversation_bootstrap", {
+            "p_shop_id": shop_id,
+            "p_psid": psid,
+            "p_message_limit": 12,
+        }).execute()
+        snapshot = result.data or {}
+        if isinstance(snapshot, list):  # older PostgREST wraps scalar results
+            snapshot = snapshot[0] if snapshot else {}
+
+        customer = snapshot.get("customer") or None
+        thread = snapshot.get("thread") or None
+        snapshot = {
+            "customer": customer,
+            "thread": thread,
+            "messages": snapshot.get("messages") or [],
+        }
+
+        if customer:
+            _customer_cache[(shop_id, psid)] = customer["id"]
+            _psid_by_customer[customer["id"]] = psid
+            if thread:
+                _thread_cache[(shop_id, customer["id"])] = thread["id"]
+        _takeover_cache[(shop_id, psid)] = bool(thread) and thread.get("status") == "human_active"
+        _bootstrap_cache[(shop_id, psid)] = snapshot
+        return snapshot
+
+    async def find_customer_id(self, shop_id: str, psid: str) -> str | None:
+        """customers.id for this (shop, PSID) WITHOUT creating one (None if new)."""
+        cached = _customer_cache.get((shop_id, psid))
+        if cached:
+            return cached
+        snapshot = await self.bootstrap_conversation(shop_id, psid)
+        if snapshot is not None:
+            return (snapshot["customer"] or {}).get("id")
+
+        supabase = await get_supabase()
+        cust = await supabase.table("customers") \
+            .select("id") \
+            .eq("shop_id", shop_id) \
+            .eq("messenger_psid", psid) \
+            .limit(1) \
+            .execute()
+        if not cust.data:
+            return None
+        _customer_cache[(shop_id, psid)] = cust.data[0]["id"]
+        _psid_by_customer[cust.data[0]["id"]] = psid
+        return cust.data[0]["id"]
+
+    async def get_customer_profile(self, shop_id: str, psid: str) -> dict | None:
+        """Profile fields (name, preferred_sizes, last_delivery_address,
+        contact_number) for this customer, or None if there's no row yet."""
+        snapshot = await self.bootstrap_conversation(shop_id, psid)
+        if snapshot is not None:
+            return snapshot["customer"]
+
+        supabase = await get_supabase()
+        result = await supabase.table("customers") \
+            .select("name, preferred_sizes, last_delivery_address, contact_number") \
+            .eq("messenger_psid", psid) \
+            .eq("shop_id", shop_id) \
+            .maybe_single() \
+            .execute()
+        return result.data if result and result.data else None
+
+    @staticmethod
+    def invalidate_profile(shop_id: str, psid: str) -> None:
+        """Drop the bootstrap snapshot after a profile write (e.g. confirm_order)."""
+        _bootstrap_cache.pop((shop_id, psid), None)
+
+    async def _recent_messages(self, supabase, thread_id: str, limit: int):
+        """Newest-first messages of a thread, in conversation (seq) order.
+
+        Every writer gets a seq (the bot in process, others from the column
+        default); a NULL left over from before the migration sorts as the
+        oldest, then by created_at.
+        """
+        if self._seq_supported:
+            try:
+                return await supabase.table("messages") \
+                    .select("sender_type, content") \
+                    .eq("thread_id", thread_id) \
+                    .order("seq", desc=True, nullsfirst=False) \
+                    .order("created_at", desc=True) \
+                    .limit(limit) \
+                    .execute()
+            except Exception as e:
+                if "seq" not in str(e):
+                    raise
+                self._seq_supported = False
+                logger.warning(
+                    f"messages ordered by seq failed ({e}) — falling back to created_at. "
+                    "Run the 20261019_messages_seq migration."
+                )
+        return await supabase.table("messages") \
+            .select("sender_type, content") \
+            .eq("thread_id", thread_id) \
+            .order("created_at", desc=True) \
+            .limit(limit) \
+            .execute()
+
 
 persistence_service = PersistenceService()
@@ -0,0 +1,68 @@
+"""Canonical form of a customer / model search query.
+
+Used as the key of the query-embedding cache (and by anything else that
+needs "the same search" to compare equal): NFKC, casefolded, punctuation
+trimmed, whitespace collapsed, and common Banglish spelling variants of the
+same word folded onto one spelling.
+
+Deliberately conservative — two queries may only normalize to the same
+text if they MEAN the same thing, because they then share one embedding.
+Translations (lal → red) are out of scope; spelling variants (punjabi →
+panjabi) are in.
+"""
+
+import re
+import unicodedata
+
+# Variant spelling -> canonical spelling. Keys and values are lowercase,
+# single tokens (t-shirt is handled by the hyphen rule below). A key must
+# never be an English word with another meaning ("ace", "pic") — that query
+# would then share the embedding of a different one.
+_BANGLISH_SPELLINGS: dict[str, str] = {
+    # garments
+    "punjabi": "panjabi", "panjabee": "panjabi", "punjabee": "panjabi", "panjaby": "panjabi",
+    "sari": "saree", "shari": "saree", "sharee": "saree", "shaari": "saree",
+    "kurtee": "kurti", "kurty": "kurti",
+    "shalwar": "salwar", "selwar": "salwar",
+    "kamiz": "kameez", "kameej": "kameez", "kamij": "kameez",
+    "urna": "orna", "dopatta": "dupatta",
+    "lungee": "lungi",
+    "fotua": "fatua", "fotuya": "fatua", "fatuya": "fatua",
+    "borka": "burqa", "borkha": "burqa", "burka": "burqa", "burkha": "burqa",
+    "hijaab": "hijab", "hizab": "hijab",
+    "zama": "jama",
+    "zuta": "juta", "jutta": "juta",
+    "sandel": "sandal", "sandle": "sandal",
+    "tshirt": "t-shirt", "teeshirt": "t-shirt", "tshirts": "t-shirt",
+    "poloshirt": "polo-shirt",
+    "jins": "jeans", "jeens": "jeans",
+    "gengi": "genji", "ganji": "genji",
+    # common shopping words
+    "daam": "dam", "dham": "dam",
+    "kotoh": "koto", "kto": "koto", "koeto": "koto",
+    "ase": "ache", "achhe": "ache", "asey": "ache",
+    "nei": "nai", "nae": "nai",
+    "saiz": "size", "sise": "size",
+    "colour": "color", "kalar": "color", "coler": "color",
+    "sobi": "chobi", "chobe": "chobi",
+}
+
+_SPACE_RE = re.compile(r"\s+")
+# "t shirt" / "t - shirt" → "t-shirt"
+_HYPHEN_JOIN_RE = re.compile(r"\b(t|polo)\s*-?\s*(shirt)s?\b")
+
+
+def normalize_query(text: str) -> str:
+    """Return the canonical form of a search query ('' for blank input)."""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    # Punctuation/symbols → space. Category-based, not \W: Bangla vowel signs
+    # are combining marks and must survive.
+    text = "".join(
+        " " if unicodedata.category(ch)[0] in "PS" and ch not in "-'" else ch
+        for ch in text
+    )
+    text = _HYPHEN_JOIN_RE.sub(r"\1-\2", text)
+    tokens = [_BANGLISH_SPELLINGS.get(tok, tok) for tok in _SPACE_RE.split(text) if tok.strip("-'")]
+    return " ".join(tok.strip("-'") for tok in tokens)
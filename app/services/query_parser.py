@@ -0,0 +1,275 @@
+"""Rule-based extraction of price / size / color filters from a search query.
+
+"sneakers under 2000" and "XL black polo" used to go verbatim into the
+search RPC; the top 5 hits then often held wrong sizes or over-budget items
+and the model spent another turn re-searching. parse_query() pulls the
+structured part out:
+
+  - price bounds — "under 2000", "<2000", "2k er niche", "২০০০ টাকার মধ্যে",
+    "above 1500", "1500+", "1000-2000 tk", "price 1000 to 2000",
+    "budget 1500";
+  - sizes — XS … 3XL (and small / medium / large), "size 42";
+  - colors — English, Banglish (lal, kalo, nil …) and Bangla (লাল, কালো …).
+
+Prices are matched on the raw query (normalize_query drops < > + ৳). The
+remaining text is what gets embedded (normalized) and keyword-matched (raw,
+so it still matches product names as stored) — price words and numbers only
+add noise. Colors stay in the text too — they are what a product NAME
+usually carries. filter_products() then applies the filters to
+search_catalog's grouped output, variant by variant.
+
+Only what the parser is sure about becomes a filter: a bare "m" or "42" is
+left alone, a number glued to a word or followed by a unit ("256gb",
+"100 ml") is never a price, and words that are also model names ("air max
+90", "pro max") or a bare "100 to 200" need a price word or ৳/tk next to
+them. A product that does not declare a size / color at all is kept rather
+than guessed away.
+"""
+
+import re
+import unicodedata
+from dataclasses import dataclass, field
+
+from app.services.query_normalizer import normalize_query
+
+# canonical color -> spellings that mean it (matched as whole words)
+_COLORS: dict[str, tuple[str, ...]] = {
+    "black": ("black", "kalo", "kala", "কালো"),
+    "white": ("white", "sada", "shada", "সাদা"),
+    "red": ("red", "lal", "লাল"),
+    "blue": ("blue", "nil", "neel", "নীল", "নিল"),
+    "navy": ("navy",),
+    "green": ("green", "sobuj", "shobuj", "সবুজ"),
+    "yellow": ("yellow", "holud", "হলুদ"),
+    "pink": ("pink", "golapi", "গোলাপি", "গোলাপী"),
+    "orange": ("orange", "komola", "কমলা"),
+    "purple": ("purple", "beguni", "বেগুনি", "বেগুনী"),
+    "gray": ("gray", "grey", "ash", "dhusor", "ধূসর", "ছাই"),
+    "brown": ("brown", "badami", "kheyeri", "khoyeri", "বাদামি", "বাদামী", "খয়েরি"),
+    "maroon": ("maroon", "meroon"),
+    "beige": ("beige", "cream", "off-white", "offwhite"),
+    "gold": ("gold", "golden", "sonali", "সোনালি"),
+    "silver": ("silver", "rupali", "রুপালি"),
+}
+_COLOR_OF: dict[str, str] = {alias: color for color, aliases in _COLORS.items() for alias in aliases}
+
+# canonical size -> spellings
+_SIZES: dict[str, tuple[str, ...]] = {
+    "xs": ("xs", "xsmall", "extra-small"),
+    "s": ("small",),
+    "m": ("medium", "midium"),
+    "l": ("large",),
+    "xl": ("xl", "extra-large"),
+    "xxl": ("xxl", "2xl"),
+    "xxxl": ("xxxl", "3xl"),
+}
+_SIZE_OF: dict[str, str] = {alias: size for size, aliases in _SIZES.items() for alias in aliases}
+# Letters that are only a size right after a size word ("size m", "saiz l")
+_SIZE_WORDS = ("size", "সাইজ")
+_LETTER_SIZES = {"s", "m", "l", "xs", "xl", "xxl", "xxxl", "2xl", "3xl"}
+
+# A number on its own: not part of a word ("s21", "256gb") unless glued to a
+# currency, not a decimal fragment, not followed by a unit ("100 ml").
+_UNITS = (
+    r"gb|tb|mb|ml|ltr|litre|liter|cm|mm|km|inch|inches|ft|feet|kg|gm|gram|grams|mah|watt|hz|mp"
+    r"|pcs|pc|piece|pieces|cc"
+)
+_NUM = (
+    r"(?:(?<![\w.])|(?<=tk)|(?<=bdt)|(?<=৳))(\d+(?:\.\d+)?)(?:\s*(k)\b)?"
+    r"(?!\.\d)(?=[^\w]|$|tk|taka|bdt|টাকা|er\b|এর)"
+    r"(?!\s*(?:" + _UNITS + r")\b)"
+)
+_CURRENCY = r"(?:\s*(?:tk|taka|takar|bdt|৳|টাকা|টাকার))?"
+_AMOUNT = r"(?:(?:৳|tk|bdt)\.?\s*)?" + _NUM + _CURRENCY
+# Counts as "next to" an amount: makes an ambiguous match a price
+_PRICE_HINT_RE = re.compile(r"tk|taka|bdt|৳|টাকা|price|dam|daam|dham|দাম|budget|মূল্য", re.IGNORECASE)
+# (pattern, needs a price hint) — "max" / "min" / "plus" are also model names
+_UPPER = (
+    (r"(?:under|below|less than|within|upto|up to|budget|<=?)\s*" + _AMOUNT, False),
+    (r"\b(?:max|maximum)\s*" + _AMOUNT, True),
+    (_AMOUNT + r"\s*(?:er|এর)?\s*(?:moddhe|modhe|niche|kom|or less|and below|মধ্যে|মধ্য|নিচে|কম)", False),
+    (_AMOUNT + r"\s*max\b", True),
+)
+_LOWER = (
+    (r"(?:above|over|more than|at least|>=?)\s*" + _AMOUNT, False),
+    (r"\b(?:min|minimum)\s*" + _AMOUNT, True),
+    (_AMOUNT + r"\s*(?:er|এর)?\s*(?:upore|opore|beshi|besi|or more|and above|\+|উপরে|বেশি)", False),
+    (_AMOUNT + r"\s*plus\b", True),
+)
+# A bare "100 to 200" is a price only with a price word or currency in it
+_RANGE = (
+    (
+        r"(?:(?:price|dam|daam|dham|দাম|budget|মূল্য)\s*)?(?:between|from)?\s*"
+        + _AMOUNT + r"\s*(?:-|to|and|theke|থেকে)\s*" + _AMOUNT,
+        True,
+    ),
+)
+_UPPER_RE = [(re.compile(p, re.IGNORECASE), hint) for p, hint in _UPPER]
+_LOWER_RE = [(re.compile(p, re.IGNORECASE), hint) for p, hint in _LOWER]
+_RANGE_RE = [(re.compile(p, re.IGNORECASE), hint) for p, hint in _RANGE]
+_SIZE_NUMBER_RE = re.compile(r"(?:size|saiz|sise|সাইজ)\s*(\d{1,2})\b", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+# Smaller numbers are quantities or sizes, not taka amounts
+_MIN_PRICE = 50
+
+
+@dataclass
+class ParsedQuery:
+    """A search query split into free text and structured filters."""
+
+    text: str       # normalized — what gets embedded
+    raw_text: str   # the query as typed minus the filter phrases — full-text search
+    min_price: float | None = None
+    max_price: float | None = None
+    sizes: set[str] = field(default_factory=set)
+    colors: set[str] = field(default_factory=set)
+
+    @property
+    def has_filters(self) -> bool:
+        return bool(self.sizes or self.colors or self.min_price is not None or self.max_price is not None)
+
+    def describe(self) -> str:
+        """Compact form for logs: 'price<=2000 size=xl color=black'."""
+        parts = []
+        if self.min_price is not None:
+            parts.append(f"price>={self.min_price:g}")
+        if self.max_price is not None:
+            parts.append(f"price<={self.max_price:g}")
+        if self.sizes:
+            parts.append("size=" + "/".join(sorted(self.sizes)))
+        if self.colors:
+            parts.append("color=" + "/".join(sorted(self.colors)))
+        return " ".join(parts)
+
+
+def _amount(number: str, thousands: str | None) -> float | None:
+    value = float(number)  # \d also matches Bangla digits; float() reads them
+    value = value * 1000 if thousands else value
+    return value if value >= _MIN_PRICE else None
+
+
+def _search(regexes: list, text: str) -> re.Match | None:
+    for regex, needs_hint in regexes:
+        for match in regex.finditer(text):
+            if not needs_hint or _PRICE_HINT_RE.search(match.group(0)):
+                return match
+    return None
+
+
+def parse_query(query: str) -> ParsedQuery:
+    """Split a search query into remaining text and price/size/color filters."""
+    raw = _SPACE_RE.sub(" ", unicodedata.normalize("NFKC", query or "")).strip()
+    parsed = ParsedQuery(text=normalize_query(raw), raw_text=raw)
+    if not parsed.text:
+        return parsed
+
+    def cut(match: re.Match) -> None:
+        nonlocal raw
+        raw = raw[:match.start()] + " " + raw[match.end():]
+
+    match = _search(_RANGE_RE, raw)
+    if match:
+        low, high = _amount(*match.group(1, 2)), _amount(*match.group(3, 4))
+        if low is not None and high is not None:
+            parsed.min_price, parsed.max_price = min(low, high), max(low, high)
+            cut(match)
+    if parsed.max_price is None:
+        match = _search(_UPPER_RE, raw)
+        if match and _amount(*match.group(1, 2)) is not None:
+            parsed.max_price = _amount(*match.group(1, 2))
+            cut(match)
+    if parsed.min_price is None:
+        match = _search(_LOWER_RE, raw)
+        if match and _amount(*match.group(1, 2)) is not None:
+            parsed.min_price = _amount(*match.group(1, 2))
+            cut(match)
+
+    match = _SIZE_NUMBER_RE.search(raw)
+    if match:
+        parsed.sizes.add(str(int(match.group(1))))
+        cut(match)
+
+    # Decided per raw token on its normalized form, so the raw text loses
+    # exactly what the normalized text does
+    tokens = raw.split()
+    folded = [normalize_query(t) for t in tokens]
+    kept: list[int] = []
+    for i, token in enumerate(folded):
+        after_size_word = i > 0 and folded[i - 1] in _SIZE_WORDS
+        before_size_word = i + 1 < len(folded) and folded[i + 1] in _SIZE_WORDS
+        if token in _SIZE_OF:
+            parsed.sizes.add(_SIZE_OF[token])
+            continue
+        if token in _LETTER_SIZES and (after_size_word or before_size_word):
+            parsed.sizes.add(_SIZE_OF.get(token, token))
+            continue
+        parsed.colors.update(_colors_in(token))
+        kept.append(i)
+    # Drop a size word left dangling by the filter it introduced
+    if parsed.sizes:
+        kept = [i for i in kept if folded[i] not in _SIZE_WORDS]
+    parsed.raw_text = " ".join(tokens[i] for i in kept)
+    parsed.text = normalize_query(parsed.raw_text)
+    return parsed
+
+
+# ── Applying the filters to grouped search results ────────────────────
+
+def _price(value) -> float | None:
+    try:
+        return float(str(value).replace(",", "")) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def _attribute(variant: dict, *needles: str) -> str | None:
+    """Casefolded value of the first attribute whose key contains a needle."""
+    for key, value in variant.items():
+        folded = key.casefold()
+        if any(n in folded for n in needles):
+            return normalize_query(str(value))
+    return None
+
+
+def _colors_in(text: str) -> set[str]:
+    return {_COLOR_OF[t] for t in text.split() if t in _COLOR_OF}
+
+
+def _sizes_in(text: str) -> set[str]:
+    tokens = text.replace("/", " ").split()
+    return {_SIZE_OF.get(t, t) for t in tokens}
+
+
+def _variant_matches(variant: dict, product: dict, parsed: ParsedQuery) -> bool:
+    if parsed.min_price is not None or parsed.max_price is not None:
+        price = _price(variant.get("price", product.get("price")))
+        if price is not None:
+            if parsed.max_price is not None and price > parsed.max_price:
+                return False
+            if parsed.min_price is not None and price < parsed.min_price:
+                return False
+    if parsed.sizes:
+        size = _attribute(variant, "size", "সাইজ")
+        if size is not None and not (_sizes_in(size) & parsed.sizes):
+            return False
+    if parsed.colors:
+        color = _attribute(variant, "color", "colour", "রং", "rong")
+        declared = _colors_in(color) if color is not None else set()
+        if not declared:
+            # No color attribute — the product name usually carries it
+            declared = _colors_in(normalize_query(f"{product.get('name', '')} {product.get('description', '')}"))
+        if declared and not (declared & parsed.colors):
+            return False
+    return True
+
+
+def filter_products(products: list[dict], parsed: ParsedQuery) -> list[dict]:
+    """Keep only variants matching the filters; drop products left with none."""
+    if not parsed.has_filters:
+        return products
+    kept = []
+    for product in products:
+        variants = [v for v in product.get("variants") or [] if _variant_matches(v, product, parsed)]
+        if variants:
+            kept.append({**product, "variants": variants})
+    return kept
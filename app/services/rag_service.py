@@ -2,64 +2,100 @@
 
 This service handles:
   - Generating text embeddings via gemini-embedding-2 (768-dim)
-  - Vector similarity search via Supabase RPC (pgvector)
+  - Caching query embeddings by normalized query text (embedding_cache)
+    and batching concurrent misses into one request (embedding_batcher)
+  - Vector similarity search via Supabase RPC (pgvector), from query text
+    or from a customer photo (search_by_image)
 
 It does NOT handle LLM response generation — that's the agent's job.
 """
 
-import json
+import asyncio
+import re
+import time
+from collections import Counter
 
 from google.genai import types
+from app.core.config import settings
 from app.core.dependencies import genai_client, get_supabase
 from app.core.logging_config import get_logger
+from app.services.catalog_index import catalog_index
+from app.services.catalog_mirror import catalog_mirror
+from app.services.catalog_rows import group_variants
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.services.embedding_cache import EmbeddingCache
+from app.services.lexical_index import STOPWORDS
+from app.services.query_normalizer import normalize_query
+from app.services.query_parser import ParsedQuery, filter_products, parse_query
+from app.services.search_cache import search_cache
 
 logger = get_logger(__name__)
 
 EMBEDDING_MODEL = "gemini-embedding-2"
 EMBEDDING_DIMENSIONS = 768
 
-# Attribute schemas differ per store (clothing has size/stock/fabric, another
-# shop may have voltage/warranty/flavor) — so pass EVERY key to the agent and
-# only bound the size: values truncated, at most _MAX_ATTR_KEYS keys.
-_MAX_ATTR_VALUE_CHARS = 80
-_MAX_ATTR_KEYS = 16
+# Legacy default for callers of _search_rpc that ask for one page.
+MATCH_COUNT = 5
 
+def _flatten_families(families: list[dict]) -> tuple[list[str], list[dict]]:
+    """match_product_families output → (names best-first, variant rows).
 
-def _compact_attributes(attrs) -> dict:
-    """Bound a product's attributes JSON for the agent without assuming a schema."""
-    if not isinstance(attrs, dict):
-        return {}
-    out = {}
-    for key, value in attrs.items():
-        if value is None or value == "":
+    Every row of a family is labelled with the family's first name, so
+    group_variants keeps case/spacing variants of one name together.
+    """
+    names: list[str] = []
+    rows: list[dict] = []
+    for family in families:
+        members = family.get("rows") or []
+        if not members:
             continue
-        if key == "additional_images":
-            continue  # exposed at product level as more_image_urls (untruncated)
-        if isinstance(value, (dict, list)):
-            value = json.dumps(value, ensure_ascii=False)
-        if isinstance(value, str) and key != "product_url" and len(value) > _MAX_ATTR_VALUE_CHARS:
-            value = value[:_MAX_ATTR_VALUE_CHARS] + "…"
-        out[str(key)] = value
-        if len(out) >= _MAX_ATTR_KEYS:
-            break
-    return out
-
-
-def _extra_images(attrs) -> list[str]:
-    """Extra gallery URLs from attributes.additional_images, if the store has them."""
-    if not isinstance(attrs, dict):
-        return []
-    raw = attrs.get("additional_images")
-    if isinstance(raw, str):
-        raw = [u.strip() for u in raw.replace(",", " ").split() if u.strip()]
-    if not isinstance(raw, list):
-        return []
-    return [u for u in raw if isinstance(u, str) and u.startswith("http")][:3]
+        name = members[0]["name"]
+        if name in names:
+            continue
+        names.append(name)
+        rows.extend({**row, "name": name} for row in members)
+    return names, rows
+
+
+def _search_depth(parsed: ParsedQuery) -> int:
+    """Products ranked per search. With price/size/color filters the search
+    runs deeper so enough survive the variant filtering."""
+    return settings.search_result_depth * (3 if parsed.has_filters else 1)
+
+
+def _apply_filters(products: list[dict], parsed: ParsedQuery) -> list[dict]:
+    """Query filters applied to grouped results, at most SEARCH_RESULT_DEPTH kept.
+
+    Nothing matching at all → the unfiltered matches, so the model can say
+    "not in XL, but …" instead of "nothing found".
+    """
+    if parsed.has_filters:
+        products = filter_products(products, parsed) or products
+    return products[:settings.search_result_depth]
 
 
 class RagService:
     """Service for embedding generation and vector search via Supabase."""
 
+    def __init__(self) -> None:
+        self._query_cache = EmbeddingCache(
+            max_bytes=settings.query_embedding_cache_mb * 1024 * 1024,
+            path=settings.query_embedding_cache_path or None,
+            max_disk_rows=settings.query_embedding_cache_disk_rows,
+            max_disk_age=settings.query_embedding_cache_disk_days * 86400,
+        )
+        self._embedder = EmbeddingBatcher(
+            EMBEDDING_MODEL, EMBEDDING_DIMENSIONS,
+            window_ms=settings.embedding_batch_window_ms,
+            max_texts=settings.embedding_batch_max_texts,
+        )
+        # Which path answered each search: cached / hybrid / lexical / failed,
+        # plus how often the lexical hedge was started at all, and photo
+        # searches (image)
+        self._paths: Counter = Counter()
+        # Flipped off (with a warning) if the match_product_families RPC is missing
+        self._families_supported = True
+
     async def initialize(self):
         """Verify connectivity — lightweight startup check."""
         logger.info("RagService initialized (Supabase pgvector + gemini-embedding-2)")
@@ -68,92 +104,280 @@ class RagService:
         """
         Search products via Supabase pgvector similarity, grouped by variant.
 
-        Generates a 768-dim embedding for the query text, calls the Supabase
-        RPC `match_products_hybrid` (FTS + cosine similarity), then expands
-        each hit into its full variant family: in this catalog every size is
-        a separate products row sharing the same name, and the RPC returns
-        neither `attributes` (size/color/stock) nor the sibling sizes — so a
-        second query fetches all rows with the matched names.
+        Generates a 768-dim embedding for the query text and calls the
+        Supabase RPC `match_product_families` (FTS + cosine similarity),
+        which returns each hit expanded into its full variant family: in
+        this catalog every size is a separate products row sharing the same
+        name (products.variant_group_id). Before that migration it falls
+        back to `match_products_hybrid` + a second query for the sibling
+        rows and their attributes.
+
+        Shops held by the in-memory catalog_index skip both round trips:
+        vector and BM25 keyword rankings are fused in process and variant
+        rows come from memory.
+
+        Results are cached per (shop, normalized query) until the shop's
+        catalog changes (search_cache).
+
+        Hedged: a slow or failing embedding call no longer means "no
+        products" — a keyword-only search (_search_lexical) races it and is
+        served if the hybrid result misses SEARCH_DEADLINE_MS.
+
+        Price bounds, sizes and colors in the query (query_parser) are
+        searched without the price/size words and then applied to the
+        variants; if nothing survives the filters the unfiltered matches are
+        returned so the model can offer the nearest alternatives.
+
+        The ranked list is SEARCH_RESULT_DEPTH products deep, best first:
+        agent_service shows the first page and keeps the rest behind a
+        cursor, so "show more" follow-ups need no second search.
 
         Returns one dict per product NAME:
           name, price, description, image_url, all_image_urls (internal,
           for whitelisting), variants[{product_id, size, color, stock, ...}]
         """
+        cached = search_cache.get(shop_id, query)
+        if cached is not None:
+            self._paths["cached"] += 1
+            logger.info(f"Catalog search: {len(cached)} products for \"{query[:60]}\" (shop={shop_id}, cached)")
+            return cached
+        version = search_cache.version(shop_id)
+        parsed = parse_query(query)
+
+        # Hedge: if the embedding-backed search hasn't answered within
+        # SEARCH_HEDGE_DELAY_MS (or failed), a lexical-only search starts in
+        # parallel; past SEARCH_DEADLINE_MS the lexical result is served.
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        hybrid = asyncio.create_task(self._search_hybrid(parsed, query, shop_id))
+        lexical: asyncio.Task | None = None
+        await asyncio.wait({hybrid}, timeout=settings.search_hedge_delay_ms / 1000)
+        if not hybrid.done() or hybrid.result() is None:
+            self._paths["hedged"] += 1
+            lexical = asyncio.create_task(self._search_lexical(parsed, query, shop_id))
+            remaining = settings.search_deadline_ms / 1000 - (loop.time() - started)
+            if not hybrid.done() and remaining > 0:
+                await asyncio.wait({hybrid}, timeout=remaining)
+
+        if hybrid.done() and hybrid.result() is not None:
+            if lexical is not None:
+                lexical.cancel()
+            products, source = hybrid.result()
+            search_cache.put(shop_id, query, version, products)
+            path = "hybrid"
+        else:
+            hybrid.cancel()
+            try:
+                products = await asyncio.wait_for(lexical, timeout=settings.search_lexical_timeout_ms / 1000)
+            except Exception as e:
+                logger.error(f"Lexical fallback search failed: {e}")
+                products = None
+            # Degraded answer — served, never cached
+            source = "lexical"
+            path = "lexical" if products is not None else "failed"
+            products = products or []
+        self._paths[path] += 1
+        filters = f", {parsed.describe()}" if parsed.has_filters else ""
+
+        elapsed_ms = (loop.time() - started) * 1000
+        if not products:
+            logger.info(f"Catalog search: 0 matches for \"{query[:60]}\" (shop={shop_id}, {source}{filters}, {elapsed_ms:.0f}ms)")
+            return []
+        logger.info(
+            f"Catalog search: {len(products)} products "
+            f"({sum(len(p['variants']) for p in products)} variants) "
+            f"for \"{query[:60]}\" (shop={shop_id}, {source}{filters}, {elapsed_ms:.0f}ms)"
+        )
+        return products
+
+    async def _search_hybrid(self, parsed: ParsedQuery, query: str, shop_id: str) -> tuple[list[dict], str] | None:
+        """Embedding-backed search: (products, source), or None if it failed."""
+        search_text = parsed.text or query
+        match_count = _search_depth(parsed)
         try:
-            query_embedding = await self.get_text_embedding(text=query)
+            query_embedding = await self.get_query_embedding(search_text)
             if not query_embedding:
                 logger.warning("No embedding generated for catalog search")
-                return []
-
-            # Call Supabase RPC function for hybrid search (FTS + pgvector)
-            supabase = await get_supabase()
-            result = await supabase.rpc("match_products_hybrid", {
-                "query_text": query,
-                "query_embedding": query_embedding,
-                "match_count": 5,
-                "filter_shop_id": shop_id,
-            }).execute()
-
-            # Unique matched names, best-match order
-            names: list[str] = []
-            for row in (result.data or []):
-                n = row.get("name")
-                if n and n not in names:
-                    names.append(n)
-            if not names:
-                logger.info(f"Catalog search: 0 matches for \"{query[:60]}\" (shop={shop_id})")
-                return []
-
-            # Fetch ALL size/variant rows for the matched names, with attributes
-            variant_rows = await supabase.table("products") \
-                .select("id, name, price, description, image_url, attributes") \
-                .eq("shop_id", shop_id) \
-                .in_("name", names) \
-                .execute()
-
-            grouped: dict[str, dict] = {}
-            for row in (variant_rows.data or []):
-                name = row["name"]
-                group = grouped.setdefault(name, {
-                    "name": name,
-                    "price": row.get("price"),
-                    "description": row.get("description", ""),
-                    "image_url": row.get("image_url") or "",
-                    "more_image_urls": [],
-                    "all_image_urls": [],
-                    "variants": [],
-                })
-                if row.get("image_url"):
-                    if not group["image_url"]:
-                        group["image_url"] = row["image_url"]
-                    if row["image_url"] not in group["all_image_urls"]:
-                        group["all_image_urls"].append(row["image_url"])
-                # Gallery images from attributes — usable with send_product_image
-                if not group["more_image_urls"]:
-                    extra = _extra_images(row.get("attributes"))
-                    group["more_image_urls"] = extra
-                    group["all_image_urls"].extend(u for u in extra if u not in group["all_image_urls"])
-
-                if len(group["variants"]) >= 12:
-                    continue  # runaway safety — no real product has more sizes
-                variant = {"product_id": row["id"], **_compact_attributes(row.get("attributes"))}
-                if row.get("price") is not None and row["price"] != group["price"]:
-                    variant["price"] = row["price"]
-                group["variants"].append(variant)
-
-            # Preserve best-match order from the RPC
-            products = [grouped[n] for n in names if n in grouped]
-
-            logger.info(
-                f"Catalog search: {len(products)} products "
-                f"({sum(len(p['variants']) for p in products)} variants) "
-                f"for \"{query[:60]}\" (shop={shop_id})"
-            )
-            return products
+                return None
 
+            indexed = catalog_index.search(shop_id, search_text, query_embedding, match_count)
+            if indexed is not None:
+                names, variant_rows = indexed
+                source = "index"
+            else:
+                # Full-text search matches stored names: the query as typed, not the folded text
+                names, variant_rows = await self._search_rpc(
+                    parsed.raw_text or query, query_embedding, shop_id, match_count,
+                )
+                source = "rpc"
+            products = group_variants(names, variant_rows) if names else []
+            return _apply_filters(products, parsed), source
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"RAG catalog search failed: {e}", exc_info=True)
+            return None
+
+    async def _search_lexical(self, parsed: ParsedQuery, query: str, shop_id: str) -> list[dict]:
+        """Keyword-only search that needs no embedding.
+
+        BM25 in memory when catalog_index or catalog_mirror holds the shop,
+        otherwise an ilike match on name/description over PostgREST, ranked
+        by how many query words each product name contains.
+        """
+        search_text = parsed.text or query
+        match_count = _search_depth(parsed)
+        indexed = catalog_index.search_lexical(shop_id, search_text, match_count)
+        if indexed is None:
+            mirror = catalog_mirror.get(shop_id)
+            if mirror is not None:
+                indexed = mirror.search_lexical(search_text, match_count)
+        if indexed is not None:
+            return _apply_filters(group_variants(*indexed), parsed)
+
+        # ilike compares against names as stored: the words as typed, plus
+        # the folded spelling where it differs ("punjabi" and "panjabi")
+        words: list[str] = []
+        for typed in (parsed.raw_text or query).casefold().replace("-", " ").split():
+            for w in (typed.strip("!?;:\"'“”‘’…"), normalize_query(typed)):
+                if w and w not in STOPWORDS and w not in words:
+                    words.append(w)
+        # PostgREST or-filter syntax: keep the pattern free of , . ( ) %
+        words = [re.sub(r"[,.()%*]", "", w) for w in words]
+        words = [w for w in words if len(w) >= 2][:8]
+        if not words:
+            return []
+        supabase = await get_supabase()
+        result = await supabase.table("products") \
+            .select("id, name, price, description, image_url, attributes") \
+            .eq("shop_id", shop_id) \
+            .or_(",".join(f"name.ilike.*{w}*,description.ilike.*{w}*" for w in words)) \
+            .limit(match_count * 12) \
+            .execute()
+        rows = result.data or []
+        best: dict[str, int] = {}
+        for row in rows:
+            name = row["name"]
+            lowered = name.casefold()
+            best[name] = max(best.get(name, 0), sum(w in lowered for w in words))
+        names = sorted(best, key=best.__getitem__, reverse=True)[:match_count]
+        return _apply_filters(group_variants(names, rows), parsed)
+
+    async def _search_rpc(
+        self, query: str, query_embedding: list[float], shop_id: str, match_count: int = MATCH_COUNT,
+    ) -> tuple[list[str], list[dict]]:
+        """Ranked names + their variant rows from the DB.
+
+        One round trip through match_product_families (families grouped by
+        products.variant_group_id in SQL); the legacy two-query path runs
+        until that migration is applied.
+        """
+        supabase = await get_supabase()
+        if self._families_supported:
+            try:
+                result = await supabase.rpc("match_product_families", {
+                    "query_text": query,
+                    "query_embedding": query_embedding,
+                    "match_count": match_count,
+                    "filter_shop_id": shop_id,
+                }).execute()
+                return _flatten_families(result.data or [])
+            except Exception as e:
+                if "match_product_families" not in str(e):
+                    raise
+                self._families_supported = False
+                logger.warning(
+                    f"match_product_families unavailable ({e}) — run the "
+                    "20261019_product_variant_families.sql migration. Using the two-query search."
+                )
+
+        # Call Supabase RPC function for hybrid search (FTS + pgvector)
+        result = await supabase.rpc("match_products_hybrid", {
+            "query_text": query,
+            "query_embedding": query_embedding,
+            "match_count": match_count,
+            "filter_shop_id": shop_id,
+        }).execute()
+
+        # Unique matched names, best-match order
+        names: list[str] = []
+        for row in (result.data or []):
+            n = row.get("name")
+            if n and n not in names:
+                names.append(n)
+        if not names:
+            return [], []
+
+        # Fetch ALL size/variant rows for the matched names, with attributes
+        mirror = catalog_mirror.get(shop_id)
+        if mirror is not None:
+            return names, mirror.rows_named(names)
+        variant_rows = await supabase.table("products") \
+            .select("id, name, price, description, image_url, attributes") \
+            .eq("shop_id", shop_id) \
+            .in_("name", names) \
+            .execute()
+        return names, variant_rows.data or []
+
+    async def get_query_embedding(self, query: str) -> list[float]:
+        """Embedding of a search query, served from the cache when possible.
+
+        The NORMALIZED text is what gets embedded, so every spelling that
+        normalizes alike gets the identical vector whether or not it hit.
+        """
+        normalized = normalize_query(query) or query
+        key = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{normalized}"
+        cached = self._query_cache.get(key)
+        if cached is not None:
+            return cached
+        # Misses from parallel search_products calls share one embed request
+        embedding = await self._embedder.embed(normalized)
+        if embedding:
+            self._query_cache.set(key, embedding)
+        return embedding
+
+    async def search_by_image(self, image_bytes: bytes, mime_type: str, shop_id: str) -> list[dict]:
+        """Catalog products that LOOK like a customer photo, grouped by variant.
+
+        The photo is embedded with the same multimodal model the product
+        webhook uses for text + image product vectors, and matched by vector
+        similarity alone (no query text). Not cached: photos rarely repeat.
+        Returns [] on any failure — the agent then works from the photo itself.
+        """
+        started = time.perf_counter()
+        embedding = await self.get_image_embedding(image_bytes, mime_type)
+        if not embedding:
+            return []
+        match_count = settings.visual_search_matches
+        try:
+            indexed = catalog_index.search(shop_id, "", embedding, match_count)
+            if indexed is not None:
+                names, variant_rows = indexed
+                source = "index"
+            else:
+                names, variant_rows = await self._search_rpc("", embedding, shop_id, match_count)
+                source = "rpc"
+        except Exception as e:
+            logger.error(f"Visual catalog search failed: {e}", exc_info=True)
             return []
+        products = group_variants(names, variant_rows)[:match_count] if names else []
+        self._paths["image"] += 1
+        logger.info(
+            f"Visual search: {len(products)} products for a customer photo "
+            f"(shop={shop_id}, {source}, {(time.perf_counter() - started) * 1000:.0f}ms)"
+        )
+        return products
+
+    def stats(self) -> dict:
+        """Cache counters for /internal/metrics."""
+        return {
+            "query_embeddings": self._query_cache.stats(),
+            "embedding_batches": self._embedder.stats(),
+            "catalog_index": catalog_index.stats(),
+            "catalog_mirror": catalog_mirror.stats(),
+            "search_results": search_cache.stats(),
+            "search_paths": dict(self._paths),
+        }
 
     async def get_text_embedding(self, text: str) -> list[float]:
         """Generate 768-dim embedding using gemini-embedding-2."""
@@ -168,5 +392,20 @@ class RagService:
             logger.error(f"Embedding generation error: {repr(e)}")
             return []
 
+    async def get_image_embedding(self, image_bytes: bytes, mime_type: str) -> list[float]:
+        """768-dim embedding of an image alone, in the product vectors' space."""
+        try:
+            result = await genai_client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=types.Content(parts=[
+                    types.Part(inline_data=types.Blob(mime_type=mime_type, data=image_bytes)),
+                ]),
+                config=types.EmbedContentConfig(output_dimensionality=EMBEDDING_DIMENSIONS),
+            )
+            return result.embeddings[0].values
+        except Exception as e:
+            logger.error(f"Image embedding generation error: {repr(e)}")
+            return []
+
 
 rag_service = RagService()
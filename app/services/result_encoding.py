@@ -0,0 +1,69 @@
+"""Token-compact encoding of search_products results for the model.
+
+A tool result stays in the conversation history and is re-billed on every
+later turn, so its size matters far more than its one-off cost suggests.
+search_catalog's grouped products are re-shaped before they reach the model:
+
+  - short keys:   n name · p price · d description · img image handle ·
+                  more extra image handles · attrs · v variants · id;
+  - attributes every variant shares (fabric, color, product_url …) move
+    into the product's `attrs` header once instead of repeating per variant;
+    each variant keeps only what differs (size, stock …) plus its id;
+  - image URLs become short per-conversation handles ("img3"): the model
+    never needs the URL itself, send_product_image resolves the handle
+    server-side (agent_service._allowed_images), which is also what makes
+    non-catalog URLs impossible to send.
+
+PLATFORM_RULES explains the format to the model. estimate_tokens() is a
+bytes/4 heuristic — good enough to report savings, not for billing.
+"""
+
+import json
+from collections.abc import Callable
+
+_DESCRIPTION_CHARS = 100
+
+
+def estimate_tokens(payload) -> int:
+    """Rough token count of a JSON-serializable payload."""
+    return len(json.dumps(payload, ensure_ascii=False).encode("utf-8")) // 4
+
+
+def _shared_attributes(variants: list[dict]) -> dict:
+    """Attributes with the same value in every variant (never the id)."""
+    if not variants:
+        return {}
+    first = {k: v for k, v in variants[0].items() if k != "product_id"}
+    return {
+        k: v for k, v in first.items()
+        if all(k in other and other[k] == v for other in variants[1:])
+    }
+
+
+def encode_products(products: list[dict], handle_for: Callable[[str], str]) -> list[dict]:
+    """Compact form of search_catalog products; handle_for maps URL → handle."""
+    encoded = []
+    for product in products:
+        variants = product.get("variants") or []
+        shared = _shared_attributes(variants) if len(variants) > 1 else {}
+        item: dict = {"n": product.get("name")}
+        if product.get("price") is not None:
+            item["p"] = product["price"]
+        description = product.get("description")
+        if isinstance(description, str) and description:
+            item["d"] = description[:_DESCRIPTION_CHARS] + ("..." if len(description) > _DESCRIPTION_CHARS else "")
+        if product.get("image_url"):
+            item["img"] = handle_for(product["image_url"])
+        more = [handle_for(url) for url in product.get("more_image_urls") or []]
+        if more:
+            item["more"] = more
+        if shared:
+            item["attrs"] = shared
+        item["v"] = [
+            {"id": v.get("product_id"), **{
+                k: val for k, val in v.items() if k != "product_id" and k not in shared
+            }}
+            for v in variants
+        ]
+        encoded.append(item)
+    return encoded
@@ -18,13 +18,13 @@ Policy:
     redirect(s); we don't spam apologies back at spam.
   - Strikes expire after STRIKE_TTL_SECONDS (fresh start after a break).
 
-In-process state — consistent with the single-worker constraint shared by
-batching, memory, and rate limiting (move to Redis together, if ever).
+Strike counts live on the shared state backend (STATE_BACKEND) together
+with memory, drafts and rate limits, so several workers count one
+conversation's strikes in the same place.
 """
 
-from cachetools import TTLCache
-
 from app.core.logging_config import get_logger
+from app.core.state_store import get_state_store
 
 logger = get_logger(__name__)
 
@@ -38,7 +38,7 @@ STRIKE_TTL_SECONDS = 30 * 60
 DEFAULT_MUTE_THRESHOLD = 3
 
 # "{shop_id}:{sender_id}" -> consecutive hard-off-topic strike count
-_strikes: TTLCache = TTLCache(maxsize=5000, ttl=STRIKE_TTL_SECONDS)
+_strikes = get_state_store("offtopic_strikes", ttl=STRIKE_TTL_SECONDS, maxsize=5000)
 
 
 class ScopeGuard:
@@ -70,8 +70,7 @@ class ScopeGuard:
                 logger.info(f"[{conversation_key}] 🚧 Back on topic — off-topic strikes reset")
             return text
 
-        strikes = (_strikes.get(conversation_key) or 0) + 1
-        _strikes[conversation_key] = strikes
+        strikes = _strikes.update(conversation_key, lambda n: (n or 0) + 1)
 
         if strikes > threshold:
             logger.info(
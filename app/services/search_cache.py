@@ -0,0 +1,91 @@
+"""Per-shop search-result cache with catalog-version invalidation.
+
+A shop gets the same few dozen queries all day. search_catalog's grouped
+output is cached under (shop_id, normalize_query(query)) together with the
+shop's catalog VERSION at the time of the search. Every catalog change
+(catalog_events: product webhook INSERT / UPDATE / DELETE, broadcast to
+shard workers) bumps that shop's version, so an entry computed before a
+price, stock or product change is never served — it reads as stale and is
+dropped.
+
+Entries are deep-copied in and out: callers mutate result dicts
+(agent_service pops all_image_urls).
+
+Counters: hits, misses, stale (invalidated by a version bump), hit_rate,
+and version_bumps (catalog churn) in total and per shop.
+"""
+
+import copy
+
+from cachetools import TTLCache
+
+from app.core.config import settings
+from app.services import catalog_events
+from app.services.catalog_events import CatalogChange
+from app.services.query_normalizer import normalize_query
+
+
+class SearchResultCache:
+
+    def __init__(self) -> None:
+        # (shop_id, normalized query) -> (catalog version, products)
+        self._entries: TTLCache = TTLCache(
+            maxsize=settings.search_cache_max_entries, ttl=settings.search_cache_ttl
+        )
+        self._versions: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.version_bumps = 0
+        catalog_events.subscribe(self._on_change)
+
+    @staticmethod
+    def _key(shop_id: str, query: str) -> tuple[str, str]:
+        return shop_id, normalize_query(query) or query
+
+    def get(self, shop_id: str, query: str) -> list[dict] | None:
+        key = self._key(shop_id, query)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        version, products = entry
+        if version != self._versions.get(shop_id, 0):
+            self._entries.pop(key, None)
+            self.stale += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(products)
+
+    def version(self, shop_id: str) -> int:
+        """Current catalog version — read BEFORE searching, pass to put()."""
+        return self._versions.get(shop_id, 0)
+
+    def put(self, shop_id: str, query: str, version: int, products: list[dict]) -> None:
+        # A change that landed while the search ran makes the result stale already
+        if version != self._versions.get(shop_id, 0):
+            return
+        self._entries[self._key(shop_id, query)] = (version, copy.deepcopy(products))
+
+    def bump(self, shop_id: str) -> None:
+        self._versions[shop_id] = self._versions.get(shop_id, 0) + 1
+        self.version_bumps += 1
+
+    def _on_change(self, change: CatalogChange) -> None:
+        self.bump(change.shop_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self._entries),
+            "version_bumps": self.version_bumps,
+            "shop_versions": dict(self._versions),
+        }
+
+
+search_cache = SearchResultCache()
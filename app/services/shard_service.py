@@ -0,0 +1,336 @@
+"""Conversation-affinity sharding across worker processes.
+
+Shared state (STATE_BACKEND=sqlite) lets several processes read the same
+drafts and strikes, but MessageBatcher's ordering guarantees are
+per-process: two workers would debounce the same '{shop_id}:{sender_id}'
+independently and race each other's replies.
+
+Multi-process mode (SHARD_WORKERS > 0) fixes that with affinity instead of
+locks:
+  - The uvicorn process becomes a thin INGEST: it verifies the webhook,
+    dedupes mids, resolves the tenant, then consistent-hashes the
+    conversation key onto a fixed worker.
+  - Each WORKER is a spawned process with its own event loop, serving
+    newline-delimited JSON events on a Unix socket. It owns its
+    conversations' batching, locks and memory exactly as the single-process
+    app does — nothing on the hot path crosses a process boundary except
+    one local socket write.
+
+Consistent hashing (virtual nodes on a ring) keeps the key → worker mapping
+stable, so a conversation never migrates mid-burst.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict
+
+from app.core.config import settings
+from app.core.logging_config import get_logger, setup_logging
+from app.core.tenant_context import TenantContext
+
+logger = get_logger(__name__)
+
+# Virtual nodes per worker — smooths the key distribution over the ring.
+_VNODES_PER_WORKER = 64
+
+# How long the ingest waits for a freshly spawned worker's socket to appear.
+_CONNECT_TIMEOUT = 10.0
+
+# A message is never handled outside its owning worker: dispatch is retried
+# with these pauses (the worker may be respawning), then the message is dropped.
+_DISPATCH_RETRY_DELAYS = (0.5, 1.0, 2.0)
+
+# Event ids a worker remembers, so a resend after a write whose success was
+# unknown (connection died mid-drain) is not handled twice.
+_SEEN_EVENTS_MAX = 10000
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class ShardRing:
+    """Consistent-hash ring mapping conversation keys to worker indexes."""
+
+    def __init__(self, worker_count: int, vnodes: int = _VNODES_PER_WORKER) -> None:
+        points = sorted(
+            (_hash(f"worker-{w}#{v}"), w)
+            for w in range(worker_count)
+            for v in range(vnodes)
+        )
+        self._hashes = [h for h, _ in points]
+        self._workers = [w for _, w in points]
+
+    def worker_for(self, key: str) -> int:
+        idx = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._workers[idx]
+
+
+def _socket_path(index: int) -> str:
+    return os.path.join(settings.shard_socket_dir, f"worker-{index}.sock")
+
+
+class ShardService:
+    """Ingest-side dispatcher: owns the worker processes and their sockets."""
+
+    def __init__(self) -> None:
+        self._ring: ShardRing | None = None
+        self._processes: dict[int, multiprocessing.process.BaseProcess] = {}
+        self._writers: dict[int, asyncio.StreamWriter] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """True in the ingest process once workers have been started."""
+        return self._ring is not None
+
+    def start(self) -> None:
+        """Spawn SHARD_WORKERS worker processes. Called from the app lifespan."""
+        count = settings.shard_workers
+        if count <= 0:
+            return
+        os.makedirs(settings.shard_socket_dir, exist_ok=True)
+        self._ring = ShardRing(count)
+        for index in range(count):
+            self._spawn(index)
+        logger.info(f"Sharded mode: {count} conversation worker(s) under {settings.shard_socket_dir}")
+
+    def _spawn(self, index: int) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        proc = ctx.Process(
+            target=run_worker, args=(index, _socket_path(index)),
+            name=f"daamkoto-worker-{index}", daemon=True,
+        )
+        proc.start()
+        self._processes[index] = proc
+
+    async def _writer_for(self, index: int) -> asyncio.StreamWriter:
+        lock = self._locks.setdefault(index, asyncio.Lock())
+        async with lock:
+            writer = self._writers.get(index)
+            if writer is not None and not writer.is_closing():
+                return writer
+
+            proc = self._processes.get(index)
+            if proc is None or not proc.is_alive():
+                logger.error(f"Shard worker {index} is not running — respawning")
+                self._spawn(index)
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + _CONNECT_TIMEOUT
+            while True:
+                try:
+                    _, writer = await asyncio.open_unix_connection(_socket_path(index))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if loop.time() >= deadline:
+                        raise
+                    await asyncio.sleep(0.1)
+            self._writers[index] = writer
+            return writer
+
+    async def _send(self, index: int, event: dict) -> None:
+        line = json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n"
+        for attempt in (1, 2):
+            try:
+                writer = await self._writer_for(index)
+                writer.write(line)
+                await writer.drain()
+                return
+            except (OSError, ConnectionError) as e:
+                stale = self._writers.pop(index, None)
+                if stale is not None:
+                    stale.close()
+                if attempt == 2:
+                    raise
+                logger.warning(f"Shard worker {index} connection lost ({e}) — reconnecting")
+
+    async def _dispatch(self, key: str, event: dict) -> int:
+        index = self._ring.worker_for(key)
+        await self._send(index, {"key": key, **event})
+        return index
+
+    async def dispatch_message(self, tenant: TenantContext, message: dict) -> None:
+        """Forward one Messenger message to the worker that owns its conversation.
+
+        Retried on failure; raises once every attempt failed. Never falls
+        back to handling it here — that would break conversation affinity.
+        """
+        key = f"{tenant.shop_id}:{tenant.sender_id}"
+        event = {
+            "kind": "message", "tenant": asdict(tenant), "message": message,
+            "event_id": message.get("mid") or uuid.uuid4().hex,
+        }
+        for delay in (*_DISPATCH_RETRY_DELAYS, None):
+            try:
+                index = await self._dispatch(key, event)
+                break
+            except Exception as e:
+                if delay is None:
+                    raise
+                logger.warning(f"[{tenant.sender_id}] Shard dispatch failed ({e}) — retrying in {delay}s")
+                await asyncio.sleep(delay)
+        logger.debug(f"[{tenant.sender_id}] Dispatched to shard worker {index}")
+
+    async def dispatch_thread_status(self, shop_id: str, psid: str, thread_id: str, status: str) -> None:
+        """Forward a pushed thread status change to the conversation's worker."""
+        await self._dispatch(f"{shop_id}:{psid}", {
+            "kind": "thread_status",
+            "shop_id": shop_id, "psid": psid, "thread_id": thread_id, "status": status,
+        })
+
+    async def broadcast(self, key: str, event: dict) -> None:
+        """Send one event to EVERY worker (catalog changes, ...)."""
+        await asyncio.gather(*(
+            self._send(index, {"key": key, **event}) for index in list(self._processes)
+        ))
+
+    async def stop(self) -> None:
+        """Close sockets and stop workers (each drains its own batcher on SIGTERM)."""
+        if not self.enabled:
+            return
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+        for proc in self._processes.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self._processes.values():
+            await asyncio.to_thread(proc.join, settings.shard_shutdown_timeout)
+            if proc.is_alive():
+                logger.warning(f"{proc.name} did not exit in time — killing")
+                proc.kill()
+        self._processes.clear()
+        self._ring = None
+
+
+# ── Worker process ───────────────────────────────────────────────────────
+
+def run_worker(index: int, socket_path: str) -> None:
+    """Entry point of a spawned conversation worker."""
+    setup_logging()
+    try:
+        asyncio.run(_worker_main(index, socket_path))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_main(index: int, socket_path: str) -> None:
+    # Imported here: the worker process owns the whole reply pipeline, the
+    # ingest process never needs it loaded through this module. The router
+    # goes first — it's the import root app.main uses (handlers package ↔
+    # batching_service would otherwise import each other half-initialized).
+    from app.services.handlers.message_router import message_router  # noqa: F401
+    from app.services.agent_service import agent_service
+    from app.services.batching_service import message_batcher
+    from app.services.budget_service import budget_service
+    from app.services.persistence_service import persistence_service
+    from app.services.rag_service import rag_service
+    from app.services.usage_service import usage_service
+    from app.core.task_supervisor import task_supervisor
+
+    agent_service.initialize()
+    await rag_service.initialize()
+
+    # Per-conversation chain: events for one key are handled strictly in
+    # arrival order, different keys run concurrently.
+    tails: dict[str, asyncio.Task] = {}
+    seen_events: OrderedDict[str, None] = OrderedDict()
+
+    async def _run_after(prev: asyncio.Task | None, event: dict) -> None:
+        if prev is not None:
+            await asyncio.gather(prev, return_exceptions=True)
+        await _handle_event(event)
+
+    def _on_done(key: str, task: asyncio.Task) -> None:
+        if tails.get(key) is task:
+            del tails[key]
+        if not task.cancelled() and task.exception():
+            logger.error(f"Shard event failed: {task.exception()}", exc_info=task.exception())
+
+    async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logger.warning("Shard worker received a malformed event — skipped")
+                    continue
+                event_id = event.get("event_id")
+                if event_id is not None:
+                    if event_id in seen_events:
+                        logger.info(f"Shard worker {index}: duplicate event {event_id} — skipped")
+                        continue
+                    seen_events[event_id] = None
+                    if len(seen_events) > _SEEN_EVENTS_MAX:
+                        seen_events.popitem(last=False)
+                key = _event_key(event)
+                task = asyncio.create_task(_run_after(tails.get(key), event))
+                tails[key] = task
+                task.add_done_callback(lambda t, k=key: _on_done(k, t))
+        except asyncio.CancelledError:
+            pass  # worker shutting down — queued events are awaited in _worker_main
+        finally:
+            writer.close()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = await asyncio.start_unix_server(_serve, path=socket_path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info(f"Shard worker {index} listening on {socket_path} (pid={os.getpid()})")
+    await stop.wait()
+
+    logger.info(f"Shard worker {index} shutting down...")
+    server.close()
+    await server.wait_closed()
+    if tails:
+        await asyncio.gather(*tails.values(), return_exceptions=True)
+    await message_batcher.shutdown()
+    await task_supervisor.drain(settings.background_drain_timeout)
+    await persistence_service.shutdown()
+    await usage_service.shutdown()
+    await budget_service.shutdown()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+
+def _event_key(event: dict) -> str:
+    return str(event.get("key"))
+
+
+async def _handle_event(event: dict) -> None:
+    from app.services.handlers.message_router import message_router
+
+    kind = event.get("kind")
+    if kind == "message":
+        tenant = TenantContext(**event["tenant"])
+        await message_router.route_message(
+            sender_id=tenant.sender_id,
+            message=event["message"],
+            tenant=tenant,
+        )
+    elif kind == "thread_status":
+        from app.services.persistence_service import persistence_service
+        persistence_service.apply_thread_status(
+            event["shop_id"], event["psid"], event["thread_id"], event["status"]
+        )
+    elif kind == "catalog":
+        from app.services.catalog_events import CatalogChange, notify
+        notify(CatalogChange(**event["change"]))
+    else:
+        logger.warning(f"Shard worker: unknown event kind {kind!r}")
+
+
+shard_service = ShardService()
@@ -1,23 +1,57 @@
-"""Fire-and-forget LLM token-usage logging to the Supabase llm_usage table.
+"""Fire-and-forget LLM token-usage logging to Supabase.
 
 One row per LLM run — agent replies (kind='chat') and background history
-summarizations (kind='summary'). Never blocks or fails the reply path: if
-the table doesn't exist yet (migration not run) the first failure logs a
-warning with the hint, later ones only debug.
+summarizations (kind='summary'). Never blocks or fails the reply path.
+
+Rows are buffered in process (write-behind) and every USAGE_FLUSH_INTERVAL
+seconds one flush:
+  - bulk-inserts the raw rows into llm_usage (one request, not one per run)
+  - folds them into per-shop / provider / model / kind / minute counters and
+    adds those to llm_usage_rollup through the increment_llm_usage_rollup
+    RPC, so the dashboard reads pre-aggregated cost series instead of
+    scanning raw rows
+
+Chat rows also carry tool_tokens_saved: the estimated tokens the compact
+search-result encoding (result_encoding) kept out of that run's history.
+
+If a table or the RPC doesn't exist yet (migration not run) the first
+failure logs a warning with the hint, later ones only debug. Any other
+failure of the raw insert goes back to the write-behind buffer to be
+retried, and the rollup runs only once the raw rows are in.
 """
 
-import asyncio
+from datetime import datetime, timezone
 
+from app.core.config import settings
 from app.core.dependencies import get_supabase
 from app.core.logging_config import get_logger
+from app.core.write_behind import WriteBehindBuffer
 
 logger = get_logger(__name__)
 
 _warned_once = False
 
+# Counters summed into llm_usage_rollup (plus a run count).
+_ROLLUP_FIELDS = (
+    "prompt_tokens", "completion_tokens", "total_tokens", "turns", "latency_ms", "tool_tokens_saved",
+)
+
 
 class UsageService:
 
+    def __init__(self) -> None:
+        self._buffer = WriteBehindBuffer(
+            "llm_usage",
+            self._flush,
+            interval=settings.usage_flush_interval,
+            max_items=settings.usage_flush_max_rows,
+        )
+        # Flipped off (with a warning) if the rollup RPC is missing
+        self._rollup_supported = True
+        # Flipped off (with a warning) if llm_usage has no tool_tokens_saved column
+        self._savings_column_supported = True
+        self.tool_tokens_saved = 0
+
     def log_bg(
         self,
         *,
@@ -33,6 +67,7 @@ class UsageService:
         message_chars: int = 0,
         reply_chars: int = 0,
         latency_ms: int = 0,
+        tool_tokens_saved: int = 0,
     ) -> None:
         """Queue one usage row; returns immediately."""
         row = {
@@ -49,30 +84,106 @@ class UsageService:
             "message_chars": int(message_chars or 0),
             "reply_chars": int(reply_chars or 0),
             "latency_ms": int(latency_ms or 0),
+            "tool_tokens_saved": int(tool_tokens_saved or 0),
+            # Stamped now, not at flush time — the buffer may hold it a while
+            "created_at": datetime.now(timezone.utc).isoformat(),
         }
-        task = asyncio.create_task(self._insert(row))
-        task.add_done_callback(self._on_done)
+        self.tool_tokens_saved += row["tool_tokens_saved"]
+        self._buffer.add(row)
 
-    @staticmethod
-    async def _insert(row: dict) -> None:
+    async def _flush(self, rows: list[dict]) -> None:
         supabase = await get_supabase()
-        await supabase.table("llm_usage").insert(row).execute()
+        raw_rows = rows if self._savings_column_supported else [_without_savings(r) for r in rows]
+        try:
+            try:
+                await supabase.table("llm_usage").insert(raw_rows).execute()
+            except Exception as e:
+                if not self._savings_column_supported or "tool_tokens_saved" not in str(e):
+                    raise
+                self._savings_column_supported = False
+                logger.warning(
+                    f"llm_usage.tool_tokens_saved missing ({e}) — run the "
+                    "20261019_tool_tokens_saved.sql migration. Writing rows without it."
+                )
+                await supabase.table("llm_usage").insert([_without_savings(r) for r in rows]).execute()
+        except Exception as e:
+            if not _table_missing(e):
+                # Transient / row error: the buffer retries (or bisects) these
+                # rows, and they are rolled up once the insert goes through.
+                raise
+            self._warn(
+                f"llm_usage insert of {len(rows)} row(s) failed ({e}) — run the "
+                "20260719_llm_usage.sql migration."
+            )
+            return  # the rollup only ever counts rows that are in llm_usage
 
-    @staticmethod
-    def _on_done(task: asyncio.Task) -> None:
-        global _warned_once
-        if task.cancelled():
+        if not self._rollup_supported:
             return
-        exc = task.exception()
-        if exc:
-            if not _warned_once:
-                _warned_once = True
+        try:
+            await supabase.rpc(
+                "increment_llm_usage_rollup", {"p_rows": _rollup(rows)}
+            ).execute()
+        except Exception as e:
+            if "increment_llm_usage_rollup" in str(e) or "llm_usage_rollup" in str(e):
+                self._rollup_supported = False
                 logger.warning(
-                    f"llm_usage insert failed ({exc}) — run the 20260719_llm_usage.sql "
-                    "migration. Further failures logged at debug."
+                    f"llm_usage rollup unavailable ({e}) — run the 20261019_llm_usage_rollup.sql "
+                    "migration. Raw llm_usage rows are still written."
                 )
             else:
-                logger.debug(f"llm_usage insert failed: {exc}")
+                logger.error(f"llm_usage rollup flush failed: {e}")
+
+    @staticmethod
+    def _warn(message: str) -> None:
+        global _warned_once
+        if not _warned_once:
+            _warned_once = True
+            logger.warning(f"{message} Further failures logged at debug.")
+        else:
+            logger.debug(message)
+
+    async def shutdown(self) -> None:
+        """Flush buffered usage rows. Called during app shutdown."""
+        await self._buffer.drain()
+
+    def stats(self) -> dict:
+        """Write-behind counters for /internal/metrics."""
+        return {"llm_usage": self._buffer.stats(), "tool_tokens_saved": self.tool_tokens_saved}
+
+
+def _table_missing(error: Exception) -> bool:
+    """True if the error says llm_usage itself doesn't exist (PostgREST / Postgres)."""
+    message = str(error)
+    return "llm_usage" in message and any(
+        marker in message for marker in ("PGRST205", "42P01", "does not exist", "Could not find the table")
+    )
+
+
+def _without_savings(row: dict) -> dict:
+    return {k: v for k, v in row.items() if k != "tool_tokens_saved"}
+
+
+def _rollup(rows: list[dict]) -> list[dict]:
+    """Sum raw rows into one increment per (shop, provider, model, kind, minute)."""
+    buckets: dict[tuple, dict] = {}
+    for row in rows:
+        minute = datetime.fromisoformat(row["created_at"]).replace(second=0, microsecond=0)
+        key = (row["shop_id"], row["provider"], row["model"], row["kind"], minute)
+        agg = buckets.get(key)
+        if agg is None:
+            agg = buckets[key] = {
+                "shop_id": row["shop_id"],
+                "provider": row["provider"],
+                "model": row["model"],
+                "kind": row["kind"],
+                "bucket": minute.isoformat(),
+                "runs": 0,
+                **{f: 0 for f in _ROLLUP_FIELDS},
+            }
+        agg["runs"] += 1
+        for f in _ROLLUP_FIELDS:
+            agg[f] += row[f]
+    return list(buckets.values())
 
 
 usage_service = UsageService()
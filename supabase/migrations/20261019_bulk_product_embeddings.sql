@@ -0,0 +1,29 @@
+-- Bulk write of product embeddings.
+--
+-- embedding_pipeline embeds products in batches (webhook inserts arriving
+-- together, bulk catalog imports) and writes each batch back in one call
+-- instead of one UPDATE per product.
+--
+-- p_rows: [{id, embedding: [768 floats] | null, embedding_status}]
+-- A null embedding (failed product) leaves the stored vector untouched.
+-- Returns the number of rows updated.
+
+create or replace function public.bulk_update_product_embeddings(p_rows jsonb)
+returns integer
+language sql
+security definer
+set search_path = public
+as $$
+    with updated as (
+        update products p set
+            embedding        = coalesce(x.embedding::vector, p.embedding),
+            embedding_status = x.embedding_status
+        from jsonb_to_recordset(p_rows) as x(id uuid, embedding text, embedding_status text)
+        where p.id = x.id
+        returning 1
+    )
+    select count(*)::integer from updated;
+$$;
+
+revoke all on function public.bulk_update_product_embeddings(jsonb) from public, anon, authenticated;
+grant execute on function public.bulk_update_product_embeddings(jsonb) to service_role;
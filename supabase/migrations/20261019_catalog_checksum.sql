@@ -0,0 +1,31 @@
+-- Per-shop catalog checksum for the in-process catalog mirror.
+--
+-- catalog_mirror keeps each active shop's product rows in memory and applies
+-- product webhooks to them. Every reconcile interval it asks for the
+-- checksum of all shops it holds in one call and reloads only the shops
+-- whose checksum moved — a missed or reordered webhook is repaired within
+-- one interval without re-reading unchanged catalogs.
+--
+-- The checksum covers exactly the columns the mirror keeps.
+
+create or replace function public.catalog_checksum(p_shop_ids uuid[])
+returns table (shop_id uuid, row_count bigint, checksum text)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    select p.shop_id,
+           count(*) as row_count,
+           md5(string_agg(
+               md5(concat_ws('|', p.id::text, p.name, p.price::text, p.description,
+                             p.image_url, p.attributes::text)),
+               '' order by p.id
+           )) as checksum
+    from products p
+    where p.shop_id = any(p_shop_ids)
+    group by p.shop_id;
+$$;
+
+revoke all on function public.catalog_checksum(uuid[]) from public, anon, authenticated;
+grant execute on function public.catalog_checksum(uuid[]) to service_role;
@@ -0,0 +1,35 @@
+-- Content hash stored with each product embedding.
+--
+-- embedding_pipeline hashes what an embedding is computed from (model,
+-- name/description/attribute text without stock/price, image URL and its
+-- ETag/Last-Modified) and stores it next to the vector. An UPDATE whose
+-- hash matches the stored one keeps the existing vector — price or stock
+-- edits no longer cost an embedding call and an image download.
+--
+-- Replaces bulk_update_product_embeddings to write the hash as well.
+
+alter table public.products
+    add column if not exists embedding_hash text;
+
+create or replace function public.bulk_update_product_embeddings(p_rows jsonb)
+returns integer
+language sql
+security definer
+set search_path = public
+as $$
+    with updated as (
+        update products p set
+            embedding        = coalesce(x.embedding::vector, p.embedding),
+            embedding_status = x.embedding_status,
+            embedding_hash   = case when x.embedding is null then p.embedding_hash else x.embedding_hash end
+        from jsonb_to_recordset(p_rows) as x(
+            id uuid, embedding text, embedding_status text, embedding_hash text
+        )
+        where p.id = x.id
+        returning 1
+    )
+    select count(*)::integer from updated;
+$$;
+
+revoke all on function public.bulk_update_product_embeddings(jsonb) from public, anon, authenticated;
+grant execute on function public.bulk_update_product_embeddings(jsonb) to service_role;
@@ -0,0 +1,56 @@
+-- Per-minute LLM usage rollups for the dashboard cost series.
+--
+-- The bot aggregates usage in process and, on every flush, adds one
+-- increment per (shop, provider, model, kind, minute) through
+-- increment_llm_usage_rollup. Raw rows keep going to llm_usage.
+
+create table if not exists public.llm_usage_rollup (
+    shop_id uuid not null,
+    bucket timestamptz not null,          -- minute, UTC
+    provider text not null,
+    model text not null,
+    kind text not null,                   -- 'chat' | 'summary'
+    runs bigint not null default 0,
+    prompt_tokens bigint not null default 0,
+    completion_tokens bigint not null default 0,
+    total_tokens bigint not null default 0,
+    turns bigint not null default 0,
+    latency_ms bigint not null default 0, -- summed; divide by runs for the mean
+    primary key (shop_id, bucket, provider, model, kind)
+);
+
+create index if not exists llm_usage_rollup_shop_bucket_idx
+    on public.llm_usage_rollup (shop_id, bucket desc);
+
+alter table public.llm_usage_rollup enable row level security;
+
+-- p_rows: [{shop_id, bucket, provider, model, kind, runs, prompt_tokens,
+--           completion_tokens, total_tokens, turns, latency_ms}, ...]
+create or replace function public.increment_llm_usage_rollup(p_rows jsonb)
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+    insert into llm_usage_rollup as r (
+        shop_id, bucket, provider, model, kind,
+        runs, prompt_tokens, completion_tokens, total_tokens, turns, latency_ms
+    )
+    select shop_id, date_trunc('minute', bucket), provider, model, kind,
+           runs, prompt_tokens, completion_tokens, total_tokens, turns, latency_ms
+    from jsonb_to_recordset(p_rows) as x(
+        shop_id uuid, bucket timestamptz, provider text, model text, kind text,
+        runs bigint, prompt_tokens bigint, completion_tokens bigint,
+        total_tokens bigint, turns bigint, latency_ms bigint
+    )
+    on conflict (shop_id, bucket, provider, model, kind) do update set
+        runs              = r.runs + excluded.runs,
+        prompt_tokens     = r.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = r.completion_tokens + excluded.completion_tokens,
+        total_tokens      = r.total_tokens + excluded.total_tokens,
+        turns             = r.turns + excluded.turns,
+        latency_ms        = r.latency_ms + excluded.latency_ms;
+$$;
+
+revoke all on function public.increment_llm_usage_rollup(jsonb) from public, anon, authenticated;
+grant execute on function public.increment_llm_usage_rollup(jsonb) to service_role;
@@ -0,0 +1,12 @@
+-- Per-conversation sequence numbers for transcript rows.
+--
+-- The bot assigns seq in process at log time (microseconds since the epoch,
+-- strictly increasing per conversation), so rows sort in conversation order
+-- even when a bulk insert gives them the same created_at. Rows written before
+-- this migration keep seq NULL and sort as the oldest.
+
+alter table public.messages
+    add column if not exists seq bigint;
+
+create index if not exists messages_thread_seq_idx
+    on public.messages (thread_id, seq desc nulls last, created_at desc);
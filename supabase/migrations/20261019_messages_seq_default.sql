@@ -0,0 +1,15 @@
+-- Default seq for every messages writer.
+--
+-- Only the bot assigned seq; rows the dashboard inserts (human-agent replies
+-- after a takeover) got NULL and sorted as the oldest rows, so bootstrap and
+-- rehydration rebuilt conversations out of order or cut the human replies
+-- past the limit. The default uses the same scale as the bot's in-process
+-- seq (microseconds since the epoch), and older NULL rows are backfilled
+-- from created_at.
+
+alter table public.messages
+    alter column seq set default (extract(epoch from clock_timestamp()) * 1e6)::bigint;
+
+update public.messages
+set seq = (extract(epoch from created_at) * 1e6)::bigint
+where seq is null;
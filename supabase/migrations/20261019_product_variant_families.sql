@@ -0,0 +1,120 @@
+-- Variant families resolved inside the search RPC.
+--
+-- Every size/colour of a product is its own products row sharing the same
+-- name. search_catalog used to call match_products_hybrid and then run a
+-- second query (.in_("name", names)) to fetch siblings + attributes, joining
+-- on name strings. Now:
+--   - products.variant_group_id is derived from (shop_id, normalized name)
+--     by a trigger at write time, so grouping is a key lookup;
+--   - match_product_families ranks FAMILIES (vector ⊕ FTS, reciprocal-rank
+--     fusion like match_products_hybrid) and returns each with all its
+--     variant rows — one round trip.
+--
+-- Returns: [{variant_group_id, score, rows: [{id, name, price, description,
+--            image_url, attributes}, ...]}, ...] best first.
+
+alter table public.products
+    add column if not exists variant_group_id uuid;
+
+create or replace function public.products_set_variant_group_id()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.variant_group_id := md5(new.shop_id::text || ':' || lower(btrim(new.name)))::uuid;
+    return new;
+end;
+$$;
+
+drop trigger if exists products_variant_group_id on public.products;
+create trigger products_variant_group_id
+    before insert or update of name, shop_id on public.products
+    for each row execute function public.products_set_variant_group_id();
+
+update public.products
+set variant_group_id = md5(shop_id::text || ':' || lower(btrim(name)))::uuid
+where variant_group_id is null;
+
+create index if not exists products_shop_variant_group_idx
+    on public.products (shop_id, variant_group_id);
+
+create or replace function public.match_product_families(
+    query_text text,
+    query_embedding vector(768),
+    match_count int,
+    filter_shop_id uuid
+)
+returns jsonb
+language sql
+stable
+security definer
+set search_path = public, extensions
+as $$
+    with vector_ranked as (
+        select v.variant_group_id, row_number() over (order by v.distance) as r
+        from (
+            select p.variant_group_id, p.embedding <=> query_embedding as distance
+            from products p
+            where p.shop_id = filter_shop_id
+              and p.embedding is not null
+            order by p.embedding <=> query_embedding
+            limit match_count * 8
+        ) v
+    ),
+    text_ranked as (
+        select t.variant_group_id, row_number() over (order by t.rank desc) as r
+        from (
+            select p.variant_group_id,
+                   ts_rank_cd(
+                       to_tsvector('simple', p.name || ' ' || coalesce(p.description, '')),
+                       websearch_to_tsquery('simple', query_text)
+                   ) as rank
+            from products p
+            where p.shop_id = filter_shop_id
+              and to_tsvector('simple', p.name || ' ' || coalesce(p.description, ''))
+                  @@ websearch_to_tsquery('simple', query_text)
+            order by rank desc
+            limit match_count * 8
+        ) t
+    ),
+    fused as (
+        select variant_group_id, sum(1.0 / (60 + r)) as score
+        from (
+            select variant_group_id, min(r) as r from vector_ranked group by variant_group_id
+            union all
+            select variant_group_id, min(r) as r from text_ranked group by variant_group_id
+        ) hits
+        group by variant_group_id
+        order by score desc
+        limit match_count
+    )
+    select coalesce(jsonb_agg(
+        jsonb_build_object(
+            'variant_group_id', f.variant_group_id,
+            'score', f.score,
+            'rows', (
+                select coalesce(jsonb_agg(jsonb_build_object(
+                    'id', p.id,
+                    'name', p.name,
+                    'price', p.price,
+                    'description', p.description,
+                    'image_url', p.image_url,
+                    'attributes', p.attributes
+                ) order by p.id), '[]'::jsonb)
+                from (
+                    select *
+                    from products p
+                    where p.shop_id = filter_shop_id
+                      and p.variant_group_id = f.variant_group_id
+                    order by p.id
+                    limit 12
+                ) p
+            )
+        )
+        order by f.score desc
+    ), '[]'::jsonb)
+    from fused f;
+$$;
+
+revoke all on function public.match_product_families(text, vector, int, uuid) from public, anon, authenticated;
+grant execute on function public.match_product_families(text, vector, int, uuid) to service_role;
@@ -0,0 +1,41 @@
+-- Per-shop monthly LLM token budgets.
+--
+-- bot_settings.monthly_token_budget: tokens per calendar month (UTC);
+-- NULL = platform default (DEFAULT_MONTHLY_TOKEN_BUDGET), 0 = unlimited.
+-- The bot keeps an in-memory ledger and reconciles it periodically through
+-- shop_token_usage, which returns the month-to-date total and the limit for
+-- a batch of shops in one call. Requires 20260719_llm_usage.
+
+alter table public.bot_settings
+    add column if not exists monthly_token_budget bigint
+        check (monthly_token_budget is null or monthly_token_budget >= 0);
+
+create index if not exists llm_usage_shop_created_idx
+    on public.llm_usage (shop_id, created_at);
+
+create or replace function public.shop_token_usage(
+    p_shop_ids uuid[],
+    p_since timestamptz
+)
+returns table (shop_id uuid, total_tokens bigint, monthly_token_budget bigint)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    select s.id,
+           coalesce((
+               select sum(u.total_tokens)
+               from llm_usage u
+               where u.shop_id = s.id
+                 and u.created_at >= p_since
+           ), 0)::bigint,
+           (select b.monthly_token_budget
+            from bot_settings b
+            where b.shop_id = s.id
+            limit 1)
+    from unnest(p_shop_ids) as s(id);
+$$;
+
+revoke all on function public.shop_token_usage(uuid[], timestamptz) from public, anon, authenticated;
+grant execute on function public.shop_token_usage(uuid[], timestamptz) to service_role;
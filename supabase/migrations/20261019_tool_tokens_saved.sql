@@ -0,0 +1,43 @@
+-- Tokens saved by the compact search-result encoding, per run.
+--
+-- search_products results reach the model in a compact shape (short keys,
+-- shared attributes hoisted, image URLs replaced by handles). Each chat
+-- usage row records the estimated tokens that kept out of the history, and
+-- the per-minute rollup sums them for the dashboard.
+
+alter table public.llm_usage
+    add column if not exists tool_tokens_saved integer not null default 0;
+
+alter table public.llm_usage_rollup
+    add column if not exists tool_tokens_saved bigint not null default 0;
+
+create or replace function public.increment_llm_usage_rollup(p_rows jsonb)
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+    insert into llm_usage_rollup as r (
+        shop_id, bucket, provider, model, kind,
+        runs, prompt_tokens, completion_tokens, total_tokens, turns, latency_ms, tool_tokens_saved
+    )
+    select shop_id, date_trunc('minute', bucket), provider, model, kind,
+           runs, prompt_tokens, completion_tokens, total_tokens, turns, latency_ms,
+           coalesce(tool_tokens_saved, 0)
+    from jsonb_to_recordset(p_rows) as x(
+        shop_id uuid, bucket timestamptz, provider text, model text, kind text,
+        runs bigint, prompt_tokens bigint, completion_tokens bigint,
+        total_tokens bigint, turns bigint, latency_ms bigint, tool_tokens_saved bigint
+    )
+    on conflict (shop_id, bucket, provider, model, kind) do update set
+        runs              = r.runs + excluded.runs,
+        prompt_tokens     = r.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = r.completion_tokens + excluded.completion_tokens,
+        total_tokens      = r.total_tokens + excluded.total_tokens,
+        turns             = r.turns + excluded.turns,
+        latency_ms        = r.latency_ms + excluded.latency_ms,
+        tool_tokens_saved = r.tool_tokens_saved + excluded.tool_tokens_saved;
+$$;
+
+revoke all on function public.increment_llm_usage_rollup(jsonb) from public, anon, authenticated;
+grant execute on function public.increment_llm_usage_rollup(jsonb) to service_role;
@@ -0,0 +1,31 @@
+-- bulk_update_product_embeddings returns the ids it updated.
+--
+-- A product deleted while its embedding was being computed matches no row.
+-- embedding_pipeline used to see only a count and published the stale row
+-- and vector anyway, putting the deleted product back into the in-memory
+-- index and mirror. It now publishes only the returned ids.
+--
+-- Same body as 20261019_embedding_hash; the return type changes, so the
+-- old function is dropped first.
+
+drop function if exists public.bulk_update_product_embeddings(jsonb);
+
+create function public.bulk_update_product_embeddings(p_rows jsonb)
+returns setof uuid
+language sql
+security definer
+set search_path = public
+as $$
+    update products p set
+        embedding        = coalesce(x.embedding::vector, p.embedding),
+        embedding_status = x.embedding_status,
+        embedding_hash   = case when x.embedding is null then p.embedding_hash else x.embedding_hash end
+    from jsonb_to_recordset(p_rows) as x(
+        id uuid, embedding text, embedding_status text, embedding_hash text
+    )
+    where p.id = x.id
+    returning p.id;
+$$;
+
+revoke all on function public.bulk_update_product_embeddings(jsonb) from public, anon, authenticated;
+grant execute on function public.bulk_update_product_embeddings(jsonb) to service_role;
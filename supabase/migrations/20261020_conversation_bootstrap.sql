@@ -0,0 +1,71 @@
+-- One-round-trip conversation bootstrap for the bot.
+--
+-- Replaces the serial customers → threads → messages chains the bot used to
+-- run for a cold conversation (takeover check, transcript rehydration,
+-- customer profile, order lookups). Returns:
+--   {
+--     "customer": {id, name, preferred_sizes, last_delivery_address, contact_number} | null,
+--     "thread":   {id, status} | null,          -- active (non-closed) thread
+--     "messages": [{sender_type, content}, ...] -- newest first, latest thread
+--   }
+-- Requires 20261019_messages_seq (orders by seq) — dated after it so the
+-- migrations apply in filename order on a fresh database.
+
+create or replace function public.conversation_bootstrap(
+    p_shop_id uuid,
+    p_psid text,
+    p_message_limit int default 12
+)
+returns jsonb
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    with cust as (
+        select c.id, c.name, c.preferred_sizes, c.last_delivery_address, c.contact_number
+        from customers c
+        where c.shop_id = p_shop_id
+          and c.messenger_psid = p_psid
+        limit 1
+    ),
+    active_thread as (
+        select t.id, t.status
+        from threads t
+        join cust on t.customer_id = cust.id
+        where t.shop_id = p_shop_id
+          and t.status <> 'closed'
+        order by t.updated_at desc
+        limit 1
+    ),
+    latest_thread as (
+        select t.id
+        from threads t
+        join cust on t.customer_id = cust.id
+        where t.shop_id = p_shop_id
+        order by t.updated_at desc
+        limit 1
+    ),
+    recent as (
+        select m.sender_type, m.content, m.seq, m.created_at
+        from messages m
+        where m.thread_id = (select id from latest_thread)
+        order by m.seq desc nulls last, m.created_at desc
+        limit p_message_limit
+    )
+    select jsonb_build_object(
+        'customer', (select to_jsonb(cust) from cust),
+        'thread',   (select to_jsonb(active_thread) from active_thread),
+        'messages', coalesce(
+            (select jsonb_agg(
+                        jsonb_build_object('sender_type', r.sender_type, 'content', r.content)
+                        order by r.seq desc nulls last, r.created_at desc
+                    )
+             from recent r),
+            '[]'::jsonb
+        )
+    );
+$$;
+
+revoke all on function public.conversation_bootstrap(uuid, text, int) from public, anon, authenticated;
+grant execute on function public.conversation_bootstrap(uuid, text, int) to service_role;
@@ -0,0 +1,61 @@
+"""Price / size / color extraction in query_parser.
+
+Run: python -m pytest tests/test_query_parser.py  (or python -m tests.test_query_parser)
+"""
+
+from app.services.query_parser import parse_query
+
+
+def _filters(query: str) -> tuple:
+    parsed = parse_query(query)
+    return parsed.text, parsed.min_price, parsed.max_price
+
+
+def test_model_names_are_not_prices():
+    assert _filters("nike air max 90") == ("nike air max 90", None, None)
+    assert _filters("iphone 15 pro max 256gb") == ("iphone 15 pro max 256gb", None, None)
+    assert _filters("galaxy s21 plus") == ("galaxy s21 plus", None, None)
+
+
+def test_units_are_not_prices():
+    assert _filters("perfume 100 to 200 ml") == ("perfume 100 to 200 ml", None, None)
+    assert _filters("tv 55 inch under 40000") == ("tv 55 inch", None, 40000)
+
+
+def test_bare_range_needs_a_price_word_or_currency():
+    assert _filters("shoes 100 to 200") == ("shoes 100 to 200", None, None)
+    assert _filters("1000-2000 tk shoes") == ("shoes", 1000, 2000)
+    assert _filters("price 1000 to 2000 saree") == ("saree", 1000, 2000)
+
+
+def test_symbol_price_syntax():
+    assert _filters("sneakers <2000") == ("sneakers", None, 2000)
+    assert _filters("polo 1500+") == ("polo", 1500, None)
+    assert _filters("kurti <= 1500৳") == ("kurti", None, 1500)
+    assert _filters("৳1500 max bag") == ("bag", None, 1500)
+
+
+def test_price_words():
+    assert _filters("sneakers under 2000") == ("sneakers", None, 2000)
+    assert _filters("2k er niche panjabi") == ("panjabi", None, 2000)
+    assert _filters("২০০০ টাকার মধ্যে শাড়ি") == ("শাড়ি", None, 2000)
+
+
+def test_raw_text_keeps_spelling_for_full_text_search():
+    parsed = parse_query("Punjabi size 42 under 2000tk")
+    assert parsed.raw_text == "Punjabi"
+    assert parsed.text == "panjabi"
+    assert parsed.sizes == {"42"} and parsed.max_price == 2000
+
+
+def test_sizes_and_colors():
+    parsed = parse_query("XL black polo")
+    assert parsed.text == "black polo"
+    assert parsed.sizes == {"xl"} and parsed.colors == {"black"}
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+    print("ok")